@@ -4,7 +4,8 @@ def args_(fn, param):
     # arguments for getBlobsTable
     argkws_d = {'skeletons_file':fn['skeletons'], 
                 'masked_image_file':fn['masked_image'],
-                'strel_size' : param.p_dict['strel_size']
+                'strel_size' : param.p_dict['strel_size'],
+                'roi_cache_file' : fn['roi_cache'] if param.p_dict['use_roi_cache'] else ''
                 }
 
     #arguments used by AnalysisPoints.py
@@ -13,6 +14,8 @@ def args_(fn, param):
         'argkws': argkws_d,
         'input_files' : [fn['skeletons'], fn['masked_image']],
         'output_files': [fn['skeletons']],
+        #ROIs cache shared with SKE_CREATE and INT_PROFILE, it is deleted at the end of the analysis
+        'tmp_files' : [fn['roi_cache']] if param.p_dict['use_roi_cache'] else [],
         'requirements' : ['SKE_INIT'],
     }
 
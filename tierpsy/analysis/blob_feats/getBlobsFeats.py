@@ -7,7 +7,7 @@ import pandas as pd
 import tables
 
 from tierpsy.analysis.ske_create.getSkeletonsTables import getWormMask
-from tierpsy.analysis.ske_create.helperIterROI import generateMoviesROI
+from tierpsy.analysis.ske_create.helperIterROI import generateMoviesROI, TrajectoriesColumns, cacheMoviesROI
 from tierpsy.helper.misc import TABLE_FILTERS
 
 
@@ -63,7 +63,12 @@ def _getBlobFeatures(blob_cnt, blob_mask, roi_image, roi_corner):
     return mask_feats
 
 
-def getBlobsFeats(skeletons_file, masked_image_file, strel_size):
+def getBlobsFeats(skeletons_file, masked_image_file, strel_size, roi_cache_file = ''):
+    '''
+    roi_cache_file -- if given, the ROIs are also saved into this file, so SKE_CREATE and INT_PROFILE 
+                      do not have to decode the masked video again. It is not used with background subtraction.
+                      The caller is responsible of deleting it (see the tmp_files of BLOB_FEATS).
+    '''
     # extract the base name from the masked_image_file. This is used in the
     # progress status.
     base_name = masked_image_file.rpartition('.')[0].rpartition(os.sep)[-1]
@@ -82,11 +87,17 @@ def getBlobsFeats(skeletons_file, masked_image_file, strel_size):
         bgnd_param = dd._v_attrs['bgnd_param']
         bgnd_param = json.loads(bgnd_param.decode("utf-8"))
 
+    #column-store view of the table to avoid building a pandas row for each ROI
+    traj_cols = TrajectoriesColumns(trajectories_data, 
+                                    ['frame_number', 'coord_x', 'coord_y', 'roi_size', 'threshold', 'area'])
+
     #get generators to get the ROI for each frame
     ROIs_generator = generateMoviesROI(masked_image_file, 
-                                         trajectories_data,
+                                         traj_cols,
                                          bgnd_param = bgnd_param,
                                          progress_prefix = progress_prefix)
+    if roi_cache_file and len(bgnd_param) == 0:
+        ROIs_generator = cacheMoviesROI(ROIs_generator, roi_cache_file, traj_cols)
 
     def _gen_rows_blocks():
         block_size = 1000
@@ -105,12 +116,12 @@ def getBlobsFeats(skeletons_file, masked_image_file, strel_size):
     def _roi2feats(block):
         #from a
         output= []
-        for irow, (roi_image, roi_corner) in block:
-            row_data = trajectories_data.loc[irow]
+        irows = traj_cols.get_positions([irow for irow, _ in block])
+        for ipos, (irow, (roi_image, roi_corner)) in zip(irows, block):
             blob_mask, blob_cnt, _ = getWormMask(roi_image,
-                                                 row_data['threshold'],
+                                                 float(traj_cols['threshold'][ipos]),
                                                  strel_size,
-                                                 min_blob_area=row_data['area'] / 2,
+                                                 min_blob_area=float(traj_cols['area'][ipos]) / 2,
                                                  is_light_background = is_light_background)
             feats = _getBlobFeatures(blob_cnt, blob_mask, roi_image, roi_corner)
 
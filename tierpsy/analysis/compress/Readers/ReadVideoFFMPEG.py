@@ -91,19 +91,38 @@ class ReadVideoFFMPEG:
                 self.vid_time_pos.append(float(timestamp))
 
 
-    def read(self):
-        # retrieve an image as numpy array
-        raw_image = self.proc.stdout.read(self.tot_pix)
-        if len(raw_image) < self.tot_pix:
-            return (0, [])
-
-        image = np.fromstring(raw_image, dtype='uint8')
-        image = image.reshape(self.height, self.width)
+    def readinto(self, image):
+        '''
+        Read the next frame directly into image, a preallocated C-contiguous uint8 
+        array of shape (height, width), without intermediate copies.
+        Returns 1 if a complete frame was read and 0 otherwise.
+        '''
+        assert image.dtype == np.uint8 and image.size == self.tot_pix
+        buf = memoryview(image).cast('B')
+        
+        n_read = 0
+        while n_read < self.tot_pix:
+            n = self.proc.stdout.readinto(buf[n_read:])
+            if not n:
+                break
+            n_read += n
+        
+        if n_read < self.tot_pix:
+            return 0
 
         # i need to read this here because otherwise the err buff will get
         # full.
         self.get_timestamp()
 
+        return 1
+
+    def read(self):
+        # retrieve an image as numpy array
+        image = np.empty((self.height, self.width), dtype=np.uint8)
+        ret = self.readinto(image)
+        if ret == 0:
+            return (0, [])
+
         return (1, image)
 
     def release(self):
@@ -15,7 +15,7 @@ def args_(fn, param):
     p = param.p_dict
     # getROIMask
     mask_param_f = ['mask_min_area', 'mask_max_area', 'thresh_block_size', 
-        'thresh_C', 'dilation_size', 'keep_border_data', 'is_light_background']
+        'thresh_C', 'dilation_size', 'keep_border_data', 'is_light_background', 'mask_engine']
     mask_param = {x.replace('mask_', ''):p[x] for x in mask_param_f}
 
     # bgnd subtraction
@@ -25,6 +25,10 @@ def args_(fn, param):
     if bgnd_param_mask['buff_size']<=0 or bgnd_param_mask['frame_gap']<=0:
         bgnd_param_mask = {}
     
+    # image datasets codec and chunks
+    compression_param_f = ['compression_codec', 'compression_level', 'compression_chunk_frames']
+    compression_param = {x.replace('compression_', ''):p[x] for x in compression_param_f}
+
     # FOV splitting
     fovsplitter_param_f = ['MWP_total_n_wells', 'MWP_whichsideup', 'MWP_well_shape']
     if not all(k in p for k in fovsplitter_param_f):
@@ -47,6 +51,9 @@ def args_(fn, param):
             'microns_per_pixel' : p['microns_per_pixel'],
             'is_extract_timestamp': p['is_extract_timestamp'],
             'fovsplitter_param': fovsplitter_param,
+            'compression_param': compression_param,
+            'n_cores_used': p['n_cores_used'],
+            'queue_size': p['compression_queue_size'],
         }
 
     argkws_d = {
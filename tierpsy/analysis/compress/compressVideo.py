@@ -5,6 +5,9 @@ Created on Thu Apr  2 13:19:58 2015
 @author: ajaver
 """
 import os
+from functools import partial
+from queue import Queue
+from threading import Thread, Semaphore
 
 import cv2
 import tables
@@ -18,6 +21,169 @@ from tierpsy.helper.misc import TimeCounter, print_flush, TABLE_FILTERS
 from tierpsy.analysis.split_fov.helper import parse_camera_serial
 from tierpsy.analysis.split_fov.FOVMultiWellsSplitter import FOVMultiWellsSplitter
 
+IMG_CODECS = ['zlib', 'blosc:lz4', 'blosc:zstd']
+DFLT_COMPRESSION_PARAM = dict(codec = 'zlib', level = 5, chunk_frames = 1)
+
+MASK_ENGINES = ['CONTOURS', 'COMPONENTS']
+
+def _getBlobsMaskContours(bw, min_area, max_area, keep_border_data):
+    '''
+    Fill the blobs in the binary image bw that are between min_area and max_area 
+    and (if keep_border_data is false) do not touch the image border. 
+    Each contour given by findContours (including holes) is tested individually.
+    '''
+    # Objects that touch the limit of the image are removed. I use -2 because
+    # openCV findCountours remove the border pixels
+    IM_LIMX = bw.shape[0] - 2
+    IM_LIMY = bw.shape[1] - 2
+
+    # find the contour of the connected objects (much faster than labeled
+    # images)
+    contours, hierarchy = cv2.findContours(
+        bw.copy(), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[-2:]
+
+
+    # find good contours: between max_area and min_area, and do not touch the
+    # image border
+    goodIndex = []
+    for ii, contour in enumerate(contours):
+        if not keep_border_data:
+            # eliminate blobs that touch a border
+            keep = not np.any(contour == 1) and \
+                not np.any(contour[:, :, 0] ==  IM_LIMY)\
+                and not np.any(contour[:, :, 1] == IM_LIMX)
+        else:
+            keep = True
+
+        if keep:
+            area = cv2.contourArea(contour)
+            if (area >= min_area) and (area <= max_area):
+                goodIndex.append(ii)
+
+    # typically there are more bad contours therefore it is cheaper to draw
+    # only the valid contours
+    mask = np.zeros(bw.shape, dtype=np.uint8)
+    for ii in goodIndex:
+        cv2.drawContours(mask, contours, ii, 1, cv2.FILLED)
+    
+    return mask
+
+def _getComponentsParents(labels, other_labels):
+    '''
+    Get the label in other_labels of the pixel at the left of the first pixel 
+    (in raster order) of each component in labels. This pixel belongs to the 
+    component that encloses it. Components starting at the first column get -1.
+    '''
+    # the first pixel of a component must be the first of a run in its row
+    is_run_start = np.ones(labels.shape, bool)
+    is_run_start[:, 1:] = labels[:, 1:] != labels[:, :-1]
+    run_start_ind = np.flatnonzero(is_run_start)
+    
+    comp_ids, first_run = np.unique(labels.ravel()[run_start_ind], return_index=True)
+    first_ind = run_start_ind[first_run]
+    
+    parents = np.full(labels.max() + 1, -1, np.int64)
+    is_inside = (first_ind % labels.shape[1]) > 0
+    parents[comp_ids[is_inside]] = other_labels.ravel()[first_ind[is_inside] - 1]
+    return parents
+
+def _getBlobsMaskComponents(bw, min_area, max_area, keep_border_data):
+    '''
+    Equivalent to _getBlobsMaskContours using connected components instead of testing and drawing each contour.
+    The blobs (8-connectivity) and their holes (4-connectivity) form the same tree as the one given by 
+    cv2.findContours(RETR_TREE). The area and the border test of each node are calculated from its contour
+    exactly as in _getBlobsMaskContours, but for all the contours at once using array operations,
+    and the mask is built with a single lookup-table index.
+    '''
+    im_h, im_w = bw.shape
+    n_blobs, blob_labels, blob_stats, _ = cv2.connectedComponentsWithStats(
+        bw, connectivity=8, ltype=cv2.CV_32S)
+    n_bgnd, bgnd_labels, bgnd_stats, _ = cv2.connectedComponentsWithStats(
+        cv2.bitwise_not(bw), connectivity=4, ltype=cv2.CV_32S)
+    
+    # the nodes of the tree are the blobs [0, n_blobs) followed by the background regions [n_blobs, n_blobs + n_bgnd).
+    # label 0 is the background in blob_labels and the blobs in bgnd_labels, they are not valid nodes
+    is_node = np.ones(n_blobs + n_bgnd, bool)
+    is_node[[0, n_blobs]] = False
+    # background regions that touch the image border are not holes
+    left = bgnd_stats[:, cv2.CC_STAT_LEFT]
+    top = bgnd_stats[:, cv2.CC_STAT_TOP]
+    right = left + bgnd_stats[:, cv2.CC_STAT_WIDTH] - 1
+    bottom = top + bgnd_stats[:, cv2.CC_STAT_HEIGHT] - 1
+    is_node[n_blobs:] &= ~((left == 0) | (top == 0) | (right == im_w - 1) | (bottom == im_h - 1))
+    
+    parents = np.full(n_blobs + n_bgnd, -1, np.int64)
+    blob_parents = _getComponentsParents(blob_labels, bgnd_labels)
+    good = (blob_parents > 0) & is_node[n_blobs + blob_parents.clip(0)]
+    parents[:n_blobs][good] = n_blobs + blob_parents[good]
+    hole_parents = _getComponentsParents(bgnd_labels, blob_labels)
+    good = (hole_parents > 0) & is_node[n_blobs:]
+    parents[n_blobs:][good] = hole_parents[good]
+    
+    # depth of each node in the tree
+    depth = np.zeros(parents.size, np.int64)
+    ancestor = parents.copy()
+    has_ancestor = ancestor >= 0
+    while np.any(has_ancestor):
+        depth[has_ancestor] += 1
+        ancestor[has_ancestor] = parents[ancestor[has_ancestor]]
+        has_ancestor = ancestor >= 0
+    
+    # Each node has one contour: the outer contour of a blob or the contour of a hole.
+    # CHAIN_APPROX_NONE keeps the starting point of each contour. It is the first pixel in raster order of a blob,
+    # while the pixel at the right of the starting point of a hole contour belongs to the hole.
+    areas = np.zeros(n_blobs + n_bgnd)
+    touch_border = np.zeros(n_blobs + n_bgnd, bool)
+    contours, hierarchy = cv2.findContours(bw, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_NONE)[-2:]
+    if len(contours) > 0:
+        cnt_sizes = np.array([x.shape[0] for x in contours])
+        cnt_ini = np.concatenate(([0], np.cumsum(cnt_sizes)[:-1]))
+        cnt_fin = cnt_ini + cnt_sizes - 1
+        points = np.concatenate(contours)[:, 0].astype(np.int64)
+        xx, yy = points[:, 0], points[:, 1]
+        
+        is_hole_cnt = hierarchy[0][:, 3] >= 0
+        x0, y0 = xx[cnt_ini], yy[cnt_ini]
+        cnt_node = blob_labels[y0, x0].astype(np.int64)
+        cnt_node[is_hole_cnt] = n_blobs + bgnd_labels[y0[is_hole_cnt], x0[is_hole_cnt] + 1]
+        
+        # the contours are closed, get the next and the previous point of each point
+        next_ind = np.arange(1, points.shape[0] + 1)
+        next_ind[cnt_fin] = cnt_ini
+        prev_ind = np.arange(-1, points.shape[0] - 1)
+        prev_ind[cnt_ini] = cnt_fin
+        
+        # shoelace formula (same as cv2.contourArea)
+        cross = xx*yy[next_ind] - xx[next_ind]*yy
+        areas[cnt_node] = np.abs(np.add.reduceat(cross, cnt_ini))/2
+        
+        # _getBlobsMaskContours only tests the points kept by CHAIN_APPROX_SIMPLE,
+        # i.e. the points where the contour changes direction
+        is_vertex = np.any(points - points[prev_ind] != points[next_ind] - points, axis=1)
+        is_vertex |= np.repeat(cnt_sizes < 3, cnt_sizes)
+        is_lim = is_vertex & ((xx == 1) | (yy == 1) | (xx == im_w - 2) | (yy == im_h - 2))
+        touch_border[cnt_node] = np.logical_or.reduceat(is_lim, cnt_ini)
+
+    is_good = is_node & (areas >= min_area) & (areas <= max_area)
+    if not keep_border_data:
+        is_good &= ~touch_border
+    
+    # filling a node also fills all its descendants
+    is_filled = is_good.copy()
+    for dd in range(1, depth.max() + 1):
+        nodes = np.flatnonzero((depth == dd) & is_node)
+        is_filled[nodes] |= is_filled[parents[nodes]]
+    
+    blobs_lut = is_filled[:n_blobs].astype(np.uint8)
+    bgnd_lut = is_filled[n_blobs:].astype(np.uint8)
+    mask = blobs_lut[blob_labels] | bgnd_lut[bgnd_labels]
+    
+    # the contour of a hole is drawn over the blob pixels that surround it
+    if len(contours) > 0:
+        is_drawn = np.repeat(is_hole_cnt & is_filled[cnt_node], cnt_sizes)
+        mask[yy[is_drawn], xx[is_drawn]] = 1
+    
+    return mask
 
 def getROIMask(
         image,
@@ -27,7 +193,8 @@ def getROIMask(
         thresh_C,
         dilation_size,
         keep_border_data,
-        is_light_background):
+        is_light_background,
+        engine = 'CONTOURS'):
     '''
     Calculate a binary mask to mark areas where it is possible to find worms.
     Objects with less than min_area or more than max_area pixels are rejected.
@@ -37,12 +204,12 @@ def getROIMask(
         > thresh_block_size -- block size used by openCV adaptiveThreshold
         > dilation_size -- size of the structure element to dilate the mask
         > keep_border_data -- (bool) if false it will reject any blob that touches the image border
+        > engine -- method used to select the blobs. CONTOURS tests each contour given by findContours, 
+                    COMPONENTS uses connected components and array operations (faster with many blobs).
 
     '''
-    # Objects that touch the limit of the image are removed. I use -2 because
-    # openCV findCountours remove the border pixels
-    IM_LIMX = image.shape[0] - 2
-    IM_LIMY = image.shape[1] - 2
+    if engine not in MASK_ENGINES:
+        raise ValueError('Invalid mask engine "{}". Valid options {}.'.format(engine, MASK_ENGINES))
 
     #this value must be at least 3 in order to work with the blocks
     thresh_block_size = max(3, thresh_block_size)
@@ -73,35 +240,10 @@ def getROIMask(
             thresh_block_size,
             thresh_C)
 
-    # find the contour of the connected objects (much faster than labeled
-    # images)
-
-    contours, hierarchy = cv2.findContours(
-        mask.copy(), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[-2:]
-
-
-    # find good contours: between max_area and min_area, and do not touch the
-    # image border
-    goodIndex = []
-    for ii, contour in enumerate(contours):
-        if not keep_border_data:
-            # eliminate blobs that touch a border
-            keep = not np.any(contour == 1) and \
-                not np.any(contour[:, :, 0] ==  IM_LIMY)\
-                and not np.any(contour[:, :, 1] == IM_LIMX)
-        else:
-            keep = True
-
-        if keep:
-            area = cv2.contourArea(contour)
-            if (area >= min_area) and (area <= max_area):
-                goodIndex.append(ii)
-
-    # typically there are more bad contours therefore it is cheaper to draw
-    # only the valid contours
-    mask = np.zeros(image.shape, dtype=image.dtype)
-    for ii in goodIndex:
-        cv2.drawContours(mask, contours, ii, 1, cv2.FILLED)
+    if engine == 'CONTOURS':
+        mask = _getBlobsMaskContours(mask, min_area, max_area, keep_border_data)
+    else:
+        mask = _getBlobsMaskComponents(mask, min_area, max_area, keep_border_data)
 
     # drawContours left an extra line if the blob touches the border. It is
     # necessary to remove it
@@ -138,10 +280,37 @@ def reduceBuffer(Ibuff, is_light_background):
     else:
         return np.max(Ibuff, axis=0)
 
-def createImgGroup(fid, name, tot_frames, im_height, im_width, is_expandable=True):
+def getImgFilters(codec='zlib', level=5):
+    '''
+    pytables filters used to store the images.
+        > codec -- compression library: zlib, blosc:lz4 or blosc:zstd
+        > level -- compression level (0-9)
+    '''
+    if codec not in IMG_CODECS:
+        raise ValueError('Invalid codec "{}". Valid options {}.'.format(codec, IMG_CODECS))
+
+    return tables.Filters(
+        complevel=level,
+        complib=codec,
+        shuffle=True,
+        fletcher32=True)
+
+def createImgGroup(fid, name, tot_frames, im_height, im_width, is_expandable=True, 
+                    codec='zlib', level=5, chunk_frames=1):
+    '''
+    Create an image dataset. The frames are stored in chunks of chunk_frames images.
+    Chunks larger than one frame are faster to read as a block (e.g. a whole buffer), 
+    but slower to read as individual frames.
+    '''
     parentnode, _, name = name.rpartition('/')
     parentnode += '/'
 
+    chunk_frames = max(1, int(chunk_frames))
+    if not is_expandable:
+        chunk_frames = min(chunk_frames, tot_frames)
+    chunkshape = (chunk_frames, im_height, im_width)
+    filters = getImgFilters(codec, level)
+    
     if is_expandable:
         img_dataset = fid.create_earray(
                         parentnode,
@@ -150,11 +319,9 @@ def createImgGroup(fid, name, tot_frames, im_height, im_width, is_expandable=Tru
                         shape =(0,
                              im_height,
                              im_width),
-                        chunkshape=(1,
-                             im_height,
-                             im_width),
+                        chunkshape=chunkshape,
                         expectedrows=tot_frames,
-                        filters=TABLE_FILTERS
+                        filters=filters
                         )
     else:
         img_dataset = fid.create_carray(
@@ -164,7 +331,8 @@ def createImgGroup(fid, name, tot_frames, im_height, im_width, is_expandable=Tru
                         shape =(tot_frames,
                              im_height,
                              im_width),
-                        filters=TABLE_FILTERS
+                        chunkshape=chunkshape if chunk_frames > 1 else None,
+                        filters=filters
                         )
 
     img_dataset._v_attrs["CLASS"] = np.string_("IMAGE")
@@ -172,18 +340,32 @@ def createImgGroup(fid, name, tot_frames, im_height, im_width, is_expandable=Tru
     img_dataset._v_attrs["IMAGE_WHITE_IS_ZERO"] = np.array(0, dtype="uint8")
     img_dataset._v_attrs["DISPLAY_ORIGIN"] = np.string_("UL")  # not rotated
     img_dataset._v_attrs["IMAGE_VERSION"] = np.string_("1.2")
+    
+    #record the compression profile so it can be recovered without decoding the filters
+    img_dataset._v_attrs["compression_codec"] = np.string_(codec)
+    img_dataset._v_attrs["compression_level"] = level
+    img_dataset._v_attrs["chunk_frames"] = img_dataset.chunkshape[0]
 
     return img_dataset
 
 def initMasksGroups(fid, expected_frames, im_height, im_width, 
-    attr_params, save_full_interval, is_expandable=True):
+    attr_params, save_full_interval, is_expandable=True, compression_param={}):
+    '''
+    compression_param -- dictionary with the codec, level and chunk_frames used for /mask.
+                         /full_data uses the same codec and level but it is always saved
+                         with a chunk per frame since its frames are read individually.
+    '''
+    compression_param = {**DFLT_COMPRESSION_PARAM, **compression_param}
 
     # open node to store the compressed (masked) data
-    mask_dataset = createImgGroup(fid, "/mask", expected_frames, im_height, im_width, is_expandable)
+    mask_dataset = createImgGroup(fid, "/mask", expected_frames, im_height, im_width, is_expandable,
+                                  **compression_param)
     
 
     tot_save_full = (expected_frames // save_full_interval) + 1
-    full_dataset = createImgGroup(fid, "/full_data", tot_save_full, im_height, im_width, is_expandable)
+    full_dataset = createImgGroup(fid, "/full_data", tot_save_full, im_height, im_width, is_expandable,
+                                  codec = compression_param['codec'],
+                                  level = compression_param['level'])
     full_dataset._v_attrs['save_interval'] = save_full_interval
     
 
@@ -207,12 +389,176 @@ def initMasksGroups(fid, expected_frames, im_height, im_width,
     
     return mask_dataset, full_dataset, mean_intensity
 
+def _readBuffers(vid, buffer_size, max_frame, ring_size=1):
+    '''
+    Read the video and group the frames in stacks of buffer_size images.
+    Yields (frame_number, Ibuff, norm_ranges), where frame_number is the
+    number of frames read up to the last image in Ibuff.
+    The buffers are slots of a preallocated ring of ring_size buffers, so a yielded buffer 
+    is only valid until ring_size more buffers are read.
+    If the reader has a readinto method, the frames are written directly into the buffer.
+    '''
+    ring = np.empty((ring_size, buffer_size, vid.height, vid.width), dtype=np.uint8)
+    is_readinto = hasattr(vid, 'readinto') and vid.dtype == np.uint8
+    
+    frame_number = 0
+    n_buffers = 0
+    Ibuff = None
+    while frame_number < max_frame:
+        # buffer index
+        ind_buff = frame_number % buffer_size
+
+        # get a new buffer when the index correspond to 0
+        if ind_buff == 0:
+            Ibuff = ring[n_buffers % ring_size]
+            n_buffers += 1
+            norm_ranges = []
+
+        if is_readinto:
+            ret = vid.readinto(Ibuff[ind_buff])
+            image = Ibuff[ind_buff]
+        else:
+            ret, image = vid.read()
+        
+        if ret == 0:
+            break
+
+        # increase frame number
+        frame_number += 1
+
+        # opencv can give an artificial rgb image. Let's get it back to
+        # gray scale.
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+        if image.dtype != np.uint8:
+            # normalise image intensities if the data type is other
+            # than uint8
+            image, img_norm_range = normalizeImage(image)
+            norm_ranges.append(img_norm_range)
+
+        #limit the image range to 1 to 255, 0 is a reserved value for the background
+        assert image.dtype == np.uint8
+        np.clip(image, 1, 255, out=Ibuff[ind_buff])
+
+        if ind_buff == buffer_size - 1:
+            yield frame_number, Ibuff, norm_ranges
+            Ibuff = None
+
+    n_remaining = frame_number % buffer_size
+    if Ibuff is not None and n_remaining > 0:
+        # close the buffer
+        yield frame_number, Ibuff[:n_remaining], norm_ranges
+
+def _maskBuffer(frame_number, Ibuff, Ibuff_b, norm_ranges,
+                mask_param, save_full_interval, fovsplitter=None):
+    '''
+    Calculate the mask of a buffer and apply it to Ibuff (in place).
+    The full frames and the mean intensities are extracted before masking.
+    '''
+    frame_numbers = np.arange(frame_number - Ibuff.shape[0] + 1, frame_number + 1)
+
+    # Add a full frame every save_full_interval
+    full_imgs = Ibuff[frame_numbers % save_full_interval == 1]
+
+    mean_int = np.array([np.mean(img) for img in Ibuff])
+    assert np.all(mean_int >= 0)
+
+    #calculate the max/min in the of the buffer
+    img_reduce = reduceBuffer(Ibuff_b, mask_param['is_light_background'])
+
+    mask = getROIMask(img_reduce, **mask_param)
+
+    Ibuff *= mask
+
+    # now apply the well_mask if is MWP
+    if fovsplitter is not None:
+        fovsplitter.apply_wells_mask(Ibuff) # Ibuff will be modified after this
+
+    return frame_number, Ibuff, full_imgs, mean_int, norm_ranges
+
+def _iterPipelined(buffers_iter, mask_func, n_workers, queue_size):
+    '''
+    Threaded equivalent of `(mask_func(*x) for x in buffers_iter)`.
+    A reader thread consumes buffers_iter and n_workers threads apply mask_func.
+    The results are yielded in the reading order, so the caller can act as the single writer.
+    At most queue_size buffers are held in memory at any time.
+    '''
+    read_queue = Queue()
+    masked_queue = Queue()
+    free_slots = Semaphore(max(1, queue_size))
+    errors = []
+
+    def _abort(e):
+        # wake up every thread that could be waiting for a free slot or a buffer to mask,
+        # they will find the error and stop
+        errors.append(e)
+        for _ in range(max(1, queue_size)):
+            free_slots.release()
+        for _ in range(n_workers):
+            read_queue.put(None)
+
+    def _reader():
+        try:
+            for ind, args in enumerate(buffers_iter):
+                free_slots.acquire()
+                if errors:
+                    break
+                read_queue.put((ind, args))
+        except Exception as e:
+            _abort(e)
+        finally:
+            for _ in range(n_workers):
+                read_queue.put(None)
+
+    def _masker():
+        try:
+            while True:
+                item = read_queue.get()
+                if item is None or errors:
+                    break
+                ind, args = item
+                masked_queue.put((ind, mask_func(*args)))
+        except Exception as e:
+            _abort(e)
+        finally:
+            masked_queue.put(None)
+
+    threads = [Thread(target=_reader, daemon=True)]
+    threads += [Thread(target=_masker, daemon=True) for _ in range(n_workers)]
+    for t in threads:
+        t.start()
+
+    try:
+        # reassemble the buffers in the order they were read
+        next_ind = 0
+        pending = {}
+        n_finished = 0
+        while n_finished < n_workers:
+            item = masked_queue.get()
+            if item is None:
+                n_finished += 1
+                continue
+
+            ind, output = item
+            pending[ind] = output
+            while next_ind in pending:
+                yield pending.pop(next_ind)
+                next_ind += 1
+                free_slots.release()
+
+        if errors:
+            raise errors[0]
+    finally:
+        if any(t.is_alive() for t in threads):
+            # the consumer stopped early (most likely an error while writing), stop the threads
+            _abort(RuntimeError('Compression pipeline closed.'))
 
 
 def compressVideo(video_file, masked_image_file, mask_param,  expected_fps=25,
                   microns_per_pixel=None, bgnd_param ={}, buffer_size=-1,
                   save_full_interval=-1, max_frame=1e32, is_extract_timestamp=False,
-                  fovsplitter_param={}):
+                  fovsplitter_param={}, compression_param={}, n_cores_used=1, queue_size=4):
     '''
     Compresses video by selecting pixels that are likely to have worms on it and making the rest of
     the image zero. By creating a large amount of redundant data, any lossless compression
@@ -227,6 +573,11 @@ def compressVideo(video_file, masked_image_file, mask_param,  expected_fps=25,
      save_full_interval -- have often a full image is saved
      max_frame -- last frame saved (default a very large number, so it goes until the end of the video)
      mask_param -- parameters used to calculate the mask
+     compression_param -- codec, level and chunk_frames used to store the images (see initMasksGroups)
+     n_cores_used -- if larger than one, the reading, masking and writing of the buffers are overlapped
+                     using a reader thread, n_cores_used masking threads and a single writer.
+                     The output is identical to the serial version.
+     queue_size -- maximum number of buffers held in memory by the parallel version
     '''
 
     #get the default values if there is any bad parameter
@@ -277,12 +628,6 @@ def compressVideo(video_file, masked_image_file, mask_param,  expected_fps=25,
         print_flush(base_name + ' Initializing background subtraction.')
         bgnd_subtractor = BackgroundSubtractorVideo(video_file, **bgnd_param)
 
-    # intialize some variables
-    max_intensity, min_intensity = np.nan, np.nan
-    frame_number = 0
-    full_frame_number = 0
-    image_prev = np.zeros([])
-    
     # Initialise FOV splitting if needed
     if is_fov_tosplit:
         # masked video does not exist yet so have to initialise from data  
@@ -327,7 +672,7 @@ def compressVideo(video_file, masked_image_file, mask_param,  expected_fps=25,
             )
         mask_dataset, full_dataset, mean_intensity = initMasksGroups(mask_fid, 
             expected_frames, vid.height, vid.width,
-            attr_params, save_full_interval)
+            attr_params, save_full_interval, compression_param = compression_param)
         
         if is_bgnd_subtraction:
             bg_dataset = createImgGroup(mask_fid, "/bgnd", 1, vid.height, vid.width, is_expandable=False)
@@ -345,86 +690,43 @@ def compressVideo(video_file, masked_image_file, mask_param,  expected_fps=25,
                                         filters=TABLE_FILTERS
                                         )
     
-        while frame_number < max_frame:
-
-            ret, image = vid.read()
-            if ret != 0:
-                # increase frame number
-                frame_number += 1
-
-                # opencv can give an artificial rgb image. Let's get it back to
-                # gray scale.
-                if image.ndim == 3:
-                    image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-
-                if image.dtype != np.uint8:
-                    # normalise image intensities if the data type is other
-                    # than uint8
-                    image, img_norm_range = normalizeImage(image)
-                    normalization_range.append(img_norm_range)
-
-                #limit the image range to 1 to 255, 0 is a reserved value for the background
-                assert image.dtype == np.uint8
-                image = np.clip(image, 1,255)
-
-                # Add a full frame every save_full_interval
-                if frame_number % save_full_interval == 1:
-                    full_dataset.append(image[np.newaxis, :, :])
-                    full_frame_number += 1
-
-                # buffer index
-                ind_buff = (frame_number - 1) % buffer_size
-
-                # initialize the buffer when the index correspond to 0
-                if ind_buff == 0:
-                    Ibuff = np.zeros(
-                        (buffer_size, vid.height, vid.width), dtype=np.uint8)
-
-                # add image to the buffer
-                Ibuff[ind_buff, :, :] = image.copy()
-                mean_int = np.mean(image)
-                assert mean_int >= 0
-                mean_intensity.append(np.array([mean_int]))
-
-            else:
-                # sometimes the last image is all zeros, control for this case
-                if np.all(Ibuff[ind_buff] == 0):
-                    frame_number -= 1
-                    ind_buff -= 1
-
-                # close the buffer
-                Ibuff = Ibuff[:ind_buff + 1]
-
-            # mask buffer and save data into the hdf5 file
-            if (ind_buff == buffer_size - 1 or ret == 0) and Ibuff.size > 0:                
+        # the buffers are reused once they are written. In the parallel version 
+        # there can be up to queue_size buffers waiting plus the one being read.
+        ring_size = max(1, queue_size) + 1 if n_cores_used > 1 else 1
+
+        def _buffers_iter():
+            for frame_number, Ibuff, norm_ranges in _readBuffers(vid, buffer_size, max_frame, ring_size):
+                # the background subtractor keeps an internal state,
+                # so it must be applied in the same order the frames are read
                 if is_bgnd_subtraction:
                     Ibuff_b  = bgnd_subtractor.apply(Ibuff, frame_number)
                 else:
                     Ibuff_b = Ibuff
-                
-                #calculate the max/min in the of the buffer
-                img_reduce = reduceBuffer(Ibuff_b, mask_param['is_light_background'])
-
-                mask = getROIMask(img_reduce, **mask_param)
-                
-                Ibuff *= mask
-
-                # now apply the well_mask if is MWP
-                if is_fov_tosplit:
-                    fovsplitter.apply_wells_mask(Ibuff) # Ibuff will be modified after this
-                    
-                # add buffer to the hdf5 file
-                frame_first_buff = frame_number - Ibuff.shape[0]
-                mask_dataset.append(Ibuff)
-
-            if frame_number % 500 == 0:
+                yield frame_number, Ibuff, Ibuff_b, norm_ranges
+
+        mask_func = partial(_maskBuffer,
+                            mask_param = mask_param,
+                            save_full_interval = save_full_interval,
+                            fovsplitter = fovsplitter if is_fov_tosplit else None)
+
+        if n_cores_used > 1:
+            masked_buffers = _iterPipelined(_buffers_iter(), mask_func, n_cores_used, queue_size)
+        else:
+            masked_buffers = (mask_func(*x) for x in _buffers_iter())
+
+        for frame_number, Ibuff, full_imgs, mean_int, norm_ranges in masked_buffers:
+            # add buffer to the hdf5 file
+            if full_imgs.shape[0] > 0:
+                full_dataset.append(full_imgs)
+            mean_intensity.append(mean_int)
+            if norm_ranges:
+                normalization_range.append(np.array(norm_ranges))
+            mask_dataset.append(Ibuff)
+
+            if frame_number // 500 > (frame_number - Ibuff.shape[0]) // 500:
                 # calculate the progress and put it in a string
                 progress_str = progressTime.get_str(frame_number)
                 print_flush(base_name + ' ' + progress_str)
-                
-            # finish process
-            if ret == 0:
-                break
 
         # close the video
         vid.release()
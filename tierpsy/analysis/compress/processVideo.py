@@ -70,7 +70,7 @@ def _isValidSource(original_file):
         return False
         
     
-def reformatRigMaskedVideo(original_file, new_file, plugin_param_file, expected_fps, microns_per_pixel):
+def reformatRigMaskedVideo(original_file, new_file, plugin_param_file, expected_fps, microns_per_pixel, compression_param={}):
     plugin_params = _getWormEnconderParams(plugin_param_file)
      
     base_name = original_file.rpartition('.')[0].rpartition(os.sep)[-1]
@@ -92,7 +92,7 @@ def reformatRigMaskedVideo(original_file, new_file, plugin_param_file, expected_
                 is_light_background = True
                 )
         mask_new, full_new, _ =  initMasksGroups(fid_new, tot_frames, im_height, im_width, 
-        attr_params, save_full_interval, is_expandable=False)
+        attr_params, save_full_interval, is_expandable=False, compression_param=compression_param)
         mask_new.attrs['plugin_params'] = json.dumps(plugin_params)
         
         img_buff_ini = mask_old[:buffer_size]
@@ -136,8 +136,10 @@ def processVideo(video_file, masked_image_file, compress_vid_param):
         plugin_param_file = os.path.join(os.path.dirname(video_file), 'wormencoder.ini')
         expected_fps = compress_vid_param['expected_fps'] 
         microns_per_pixel = compress_vid_param['microns_per_pixel'] 
+        compression_param = compress_vid_param.get('compression_param', {})
 
-        reformatRigMaskedVideo(video_file, masked_image_file, plugin_param_file, expected_fps=expected_fps, microns_per_pixel=microns_per_pixel)
+        reformatRigMaskedVideo(video_file, masked_image_file, plugin_param_file, 
+            expected_fps=expected_fps, microns_per_pixel=microns_per_pixel, compression_param=compression_param)
     else:
         compressVideo(video_file, masked_image_file, **compress_vid_param)
 
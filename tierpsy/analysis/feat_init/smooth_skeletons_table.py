@@ -254,6 +254,7 @@ def smooth_skeletons_table(skeletons_file,
             
     
         tot_skeletons = 0
+        worms_index = []
         for ind_n, (worm_index, worm_data) in enumerate(trajectories_data_g):
             if worm_data['was_skeletonized'].sum() < 2:
                 continue
@@ -290,6 +291,7 @@ def smooth_skeletons_table(skeletons_file,
             #%%
             skeleton_id = np.arange(wormN.skeleton.shape[0]) + tot_skeletons
             tot_skeletons = skeleton_id[-1] + 1
+            worms_index.append((worm_index, skeleton_id[0], tot_skeletons))
             row_ind = worm_data.index[dat_index.values]
             trajectories_data.loc[row_ind, 'skeleton_id'] = skeleton_id
             #%%
@@ -302,6 +304,17 @@ def smooth_skeletons_table(skeletons_file,
             #display progress
             _display_progress(ind_n + 1)
             
+        #save the first and last+1 skeleton_id of each worm, so their coordinates can be read by slices
+        worms_index = np.array(worms_index,
+                               dtype = [('worm_index_joined', np.int32),
+                                        ('skeleton_id_start', np.int32),
+                                        ('skeleton_id_stop', np.int32)])
+        fid_features.create_table(
+                w_node,
+                'worms_index',
+                obj = worms_index,
+                filters = TABLE_FILTERS)
+        
         #save trajectories data
         newT = fid_features.create_table(
                 '/',
@@ -22,7 +22,8 @@ def args_(fn, param):
         'argkws': {
                   'features_file': fn['featuresN'],
                   'derivate_delta_time': param.p_dict['feat_derivate_delta_time'],
-                  'fovsplitter_param': fovsplitter_param
+                  'fovsplitter_param': fovsplitter_param,
+                  'n_cores_used': param.p_dict['n_cores_used']
                   },
         'input_files' : [fn['featuresN']],
         'output_files': [fn['featuresN']],
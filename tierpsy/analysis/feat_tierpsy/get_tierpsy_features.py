@@ -5,20 +5,154 @@ Created on Tue Sep  5 18:31:24 2017
 
 @author: ajaver
 """
+import os
 import numpy as np
 import pandas as pd
 import tables
+import multiprocessing as mp
+from functools import partial
 
-from tierpsy.features.tierpsy_features import get_timeseries_features, timeseries_all_columns
+from tierpsy.features.tierpsy_features import get_timeseries_features_batch, timeseries_all_columns
 from tierpsy.features.tierpsy_features.summary_stats import get_summary_stats
+from tierpsy.features.tierpsy_features.food import FoodContourIndex
 
 from tierpsy.helper.misc import TimeCounter, print_flush, get_base_name, TABLE_FILTERS
 from tierpsy.helper.params import read_fps, read_ventral_side
 
 from tierpsy.analysis.split_fov.FOVMultiWellsSplitter import FOVMultiWellsSplitter
 
-def save_timeseries_feats_table(features_file, derivate_delta_time, fovsplitter_param={}):
-    timeseries_features = []
+def _read_worms_index(features_file, trajectories_data):
+    '''
+    Read the first and last+1 skeleton_id of each worm saved by FEAT_INIT in /coordinates/worms_index.
+    Older files do not have it, so it is calculated from the trajectories_data.
+    '''
+    with tables.File(features_file, 'r') as fid:
+        if '/coordinates/worms_index' in fid:
+            worms_index = fid.get_node('/coordinates/worms_index')[:]
+            return {w : (ini, fin) for w, ini, fin in
+                    zip(worms_index['worm_index_joined'], worms_index['skeleton_id_start'], worms_index['skeleton_id_stop'])}
+
+    valid = trajectories_data[trajectories_data['skeleton_id'] >= 0]
+    worms_index = valid.groupby('worm_index_joined').agg({'skeleton_id' : ['min', 'max']})['skeleton_id']
+    return {w : (ini, fin + 1) for w, ini, fin in zip(worms_index.index, worms_index['min'], worms_index['max'])}
+
+def _get_worms_blocks(worms_args, worms_index, read_buffer_rows):
+    '''
+    Group consecutive worms in blocks of contiguous /coordinates/* rows, so several worms are read at once.
+    A block has at most read_buffer_rows rows unless a single worm is larger.
+    Yield (ini, fin, [worm_args, ...]).
+    '''
+    ini, fin = 0, 0
+    block = []
+    for worm_args in worms_args:
+        worm_index = worm_args[0]
+        if worm_index in worms_index:
+            w_ini, w_fin = worms_index[worm_index]
+            if fin > ini and max(fin, w_fin) - min(ini, w_ini) > read_buffer_rows:
+                yield ini, fin, block
+                ini, fin = 0, 0
+                block = []
+
+            if fin > ini:
+                ini, fin = min(ini, w_ini), max(fin, w_fin)
+            else:
+                ini, fin = w_ini, w_fin
+        #worms without skeletons do not need any row so they can go in any block
+        block.append(worm_args)
+
+    if block:
+        yield ini, fin, block
+
+def _read_coordinates_block(fid, ini, fin):
+    '''
+    Read the rows ini:fin of the /coordinates/* arrays (None if the array does not exist).
+    '''
+    block = []
+    for p in ('skeletons', 'widths', 'dorsal_contours', 'ventral_contours'):
+        node_str = '/coordinates/' + p
+        if node_str in fid:
+            block.append(fid.get_node(node_str)[ini:fin])
+        else:
+            block.append(None)
+    return block
+
+def _get_worm_coordinates(block, block_ini, skel_id):
+    '''
+    Select the coordinates of a worm from a block read by _read_coordinates_block.
+    Frames without skeleton (skeleton_id == -1) are set to nan.
+    '''
+    #deal with any nan in the skeletons
+    good_id = skel_id>=0
+    skel_id_val = skel_id[good_id] - block_ini
+    traj_size = skel_id.size
+
+    args = []
+    for dd in block:
+        if dd is not None:
+            dat = np.full((traj_size, *dd.shape[1:]), np.nan)
+            dat[good_id] = dd[skel_id_val]
+        else:
+            dat = None
+
+        args.append(dat)
+    return args
+
+def _get_block_feats_records(args, worm_offsets, timestamp, worm_indexes, well_names, **feats_params):
+    '''
+    Calculate the timeseries features of a batch of worms concatenated along the first axis
+    and return them as records with the fields of /timeseries_data.
+    '''
+    feats = get_timeseries_features_batch(*args,
+                                         worm_offsets = worm_offsets,
+                                         timestamp = timestamp,
+                                         **feats_params
+                                         )
+    worm_sizes = np.diff(worm_offsets)
+    
+    #move the worm_index and well_name to the first columns
+    feat_dtypes = [(x, np.float32) for x in timeseries_all_columns]
+    feat_dtypes = [('worm_index', np.int32),
+                   ('timestamp', np.int32),
+                   ('well_name', 'S3')] + feat_dtypes
+    
+    records = np.empty(feats.size, feat_dtypes)
+    records['worm_index'] = np.repeat(worm_indexes, worm_sizes)
+    records['well_name'] = np.repeat(np.array(well_names, 'S3'), worm_sizes)
+    for col in feats.dtype.names:
+        records[col] = feats[col]
+    return records
+
+#file handler used by each process of the pool
+_worker_fid = None
+def _init_feats_worker(features_file):
+    global _worker_fid
+    _worker_fid = tables.File(features_file, 'r')
+
+def _calc_block_feats(block_args, fid = None, **feats_params):
+    #if fid is not given (process pool) use the file opened by _init_feats_worker
+    ini, fin, worms_args = block_args
+    block = _read_coordinates_block(_worker_fid if fid is None else fid, ini, fin)
+
+    worm_indexes, skel_ids, timestamps, well_names = zip(*worms_args)
+    worm_offsets = np.cumsum([0] + [x.size for x in skel_ids])
+    
+    args = _get_worm_coordinates(block, ini, np.concatenate(skel_ids))
+    feats = _get_block_feats_records(args,
+                                     worm_offsets,
+                                     np.concatenate(timestamps),
+                                     worm_indexes,
+                                     well_names,
+                                     **feats_params)
+    return len(worms_args), feats
+
+def save_timeseries_feats_table(features_file, derivate_delta_time, fovsplitter_param={}, n_cores_used=1, read_buffer_rows=10000):
+    '''
+    Calculate the tierpsy timeseries features of each worm and save them in /timeseries_data.
+
+    n_cores_used - if larger than one the worms are processed by a pool of processes. Each process
+    reads its own worm coordinates and the results are appended in the worm order.
+    read_buffer_rows - the coordinates of consecutive worms are read together in slices of about this number of rows.
+    '''
     fps = read_fps(features_file)
     
     # initialise class for splitting fov
@@ -48,6 +182,7 @@ def save_timeseries_feats_table(features_file, derivate_delta_time, fovsplitter_
     
     with pd.HDFStore(features_file, 'r') as fid:
         trajectories_data = fid['/trajectories_data']
+    worms_index = _read_worms_index(features_file, trajectories_data)
     
     trajectories_data_g = trajectories_data.groupby('worm_index_joined')
     progress_timer = TimeCounter('')
@@ -62,14 +197,18 @@ def save_timeseries_feats_table(features_file, derivate_delta_time, fovsplitter_
             ' Total time:' +
             progress_timer.get_time_str())
     
-    _display_progress(0)
-    with tables.File(features_file, 'r+') as fid:
-        
-        for gg in ['/timeseries_data', '/event_durations', '/timeseries_features']:
-            if gg in fid:
-                fid.remove_node(gg)
-                
-        
+    def _worms_args():
+        for worm_index, worm_data in trajectories_data_g:
+            if is_fov_tosplit:
+                well_name = fovsplitter.find_well_from_trajectories_data(worm_data)
+            else:
+                well_name = 'n/a'
+            
+            skel_id = worm_data['skeleton_id'].values
+            timestamp = worm_data['timestamp_raw'].values.astype(np.int32)
+            yield worm_index, skel_id, timestamp, well_name
+    
+    def _save_feats(fid, feats_generator):
         feat_dtypes = [(x, np.float32) for x in timeseries_all_columns]
             
         feat_dtypes = [('worm_index', np.int32),
@@ -82,78 +221,60 @@ def save_timeseries_feats_table(features_file, derivate_delta_time, fovsplitter_
                 obj = np.recarray(0, feat_dtypes),
                 filters = TABLE_FILTERS)
         
+        ind_n = 0
+        for n_worms, feats in feats_generator:
+            timeseries_features.append(feats)
+            ind_n += n_worms
+            _display_progress(ind_n - 1)
+    
+    _display_progress(0)
+    with tables.File(features_file, 'r+') as fid:
+        
+        for gg in ['/timeseries_data', '/event_durations', '/timeseries_features']:
+            if gg in fid:
+                fid.remove_node(gg)
+                
         if '/food_cnt_coord' in fid:
-            food_cnt = fid.get_node('/food_cnt_coord')[:]
+            #build the food contour index once and share it between all the worms
+            food_cnt = FoodContourIndex(fid.get_node('/food_cnt_coord')[:], is_smooth_cnt = False)
         else:
             food_cnt = None
     
-        #If i find the ventral side in the multiworm case this has to change
-        ventral_side = read_ventral_side(features_file)
-            
-        for ind_n, (worm_index, worm_data) in enumerate(trajectories_data_g):
-
-            skel_id = worm_data['skeleton_id'].values
-            
-            #deal with any nan in the skeletons
-            good_id = skel_id>=0
-            skel_id_val = skel_id[good_id]
-            traj_size = skel_id.size
-
-            args = []
-            for p in ('skeletons', 'widths', 'dorsal_contours', 'ventral_contours'):
-                
-                node_str = '/coordinates/' + p
-                if node_str in fid:
-                    node = fid.get_node(node_str)
-                    dat = np.full((traj_size, *node.shape[1:]), np.nan)
-                    if skel_id_val.size > 0:
-                        if len(node.shape) == 3:
-                            dd = node[skel_id_val, :, :]
-                        else:
-                            dd = node[skel_id_val, :]
-                        dat[good_id] = dd
-                else:
-                    dat = None
-                
-                args.append(dat)
-
-            timestamp = worm_data['timestamp_raw'].values.astype(np.int32)
-            
-            feats = get_timeseries_features(*args, 
-                                           timestamp = timestamp,
-                                           food_cnt = food_cnt,
-                                           fps = fps,
-                                           ventral_side = ventral_side,
-                                           derivate_delta_time = derivate_delta_time
-                                           )
-            #save timeseries features data
-            feats = feats.astype(np.float32)
-            feats['worm_index'] = worm_index
-            if is_fov_tosplit:
-                feats['well_name'] = fovsplitter.find_well_from_trajectories_data(worm_data)
-            else:
-                feats['well_name'] = 'n/a'
-            # cast well_name to the correct type 
-            # (before shuffling columns, so it remains the last entry)
-            # needed because for some reason this does not work:
-            # feats['well_name'] = feats['well_name'].astype('S3')
-            feats['_well_name'] = feats['well_name'].astype('S3')
-            feats.drop(columns='well_name', inplace=True)
-            feats.rename(columns={'_well_name':'well_name'}, inplace=True)
-            
-            #move the last fields to the first columns
-            cols = feats.columns.tolist()
-            cols = cols[-2:] + cols[:-2]
-            cols[1], cols[2] = cols[2], cols[1]
-            
-            feats = feats[cols]
+    #If i find the ventral side in the multiworm case this has to change
+    ventral_side = read_ventral_side(features_file)
+    
+    feats_params = dict(food_cnt = food_cnt,
+                        fps = fps,
+                        ventral_side = ventral_side,
+                        derivate_delta_time = derivate_delta_time
+                        )
+    
+    worms_blocks = _get_worms_blocks(_worms_args(), worms_index, read_buffer_rows)
+    if n_cores_used > 1:
+        # the features file cannot be open for writing while the workers are reading it,
+        # so the table is written in a temporary file and copied at the end
+        tmp_file = os.path.splitext(features_file)[0] + '_timeseries.tmp'
+        calc_block_feats = partial(_calc_block_feats, **feats_params)
+        
+        try:
+            p = mp.Pool(n_cores_used, initializer = _init_feats_worker, initargs = (features_file,))
+            try:
+                with tables.File(tmp_file, 'w') as fid_tmp:
+                    _save_feats(fid_tmp, p.imap(calc_block_feats, worms_blocks))
+            finally:
+                p.terminate()
+                p.join()
             
-            feats['worm_index'] = feats['worm_index'].astype(np.int32)
-            feats['timestamp'] = feats['timestamp'].astype(np.int32)
-            feats = feats.to_records(index=False)
+            with tables.File(features_file, 'r+') as fid, tables.File(tmp_file, 'r') as fid_tmp:
+                fid_tmp.get_node('/timeseries_data').copy(fid.root)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
     
-            timeseries_features.append(feats)
-            _display_progress(ind_n)
+    else:
+        with tables.File(features_file, 'r+') as fid:
+            calc_block_feats = partial(_calc_block_feats, fid = fid, **feats_params)
+            _save_feats(fid, map(calc_block_feats, worms_blocks))
             
 
 def save_feats_stats(features_file, derivate_delta_time):
@@ -231,9 +352,9 @@ def save_feats_stats(features_file, derivate_delta_time):
 
 
             
-def get_tierpsy_features(features_file, derivate_delta_time = 1/3, fovsplitter_param={}):
+def get_tierpsy_features(features_file, derivate_delta_time = 1/3, fovsplitter_param={}, n_cores_used=1):
     #I am adding this so if I add the parameters to calculate the features i can pass it to this function
-    save_timeseries_feats_table(features_file, derivate_delta_time, fovsplitter_param)
+    save_timeseries_feats_table(features_file, derivate_delta_time, fovsplitter_param, n_cores_used)
     save_feats_stats(features_file, derivate_delta_time)
     
 
@@ -13,7 +13,8 @@ def args_(fn, param):
         'smooth_win': 11,
         'pol_degree': 3,
         'width_percentage': p['int_avg_width_frac'],
-        'save_maps': p['int_save_maps']
+        'save_maps': p['int_save_maps'],
+        'roi_cache_file': fn['roi_cache'] if p['use_roi_cache'] else ''
         }
 
     requirements = ['SKE_CREATE']
@@ -6,15 +6,18 @@ Created on Mon Jun  1 22:15:48 2015
 """
 
 import os
+from functools import lru_cache
 
 import numpy as np
 import pandas as pd
 import tables
 from scipy.interpolate import RectBivariateSpline
 from scipy.interpolate import interp1d
+from scipy.linalg import solve_banded
+from scipy.ndimage import map_coordinates
 from scipy.signal import savgol_filter
 
-from tierpsy.analysis.ske_create.helperIterROI import getWormROI
+from tierpsy.analysis.ske_create.helperIterROI import generateMoviesROI, TrajectoriesColumns
 
 from tierpsy.helper.params import min_num_skel_defaults
 from tierpsy.helper.misc import TimeCounter, print_flush, save_modified_table
@@ -88,6 +91,116 @@ def getStraightenWormInt(worm_img, skeleton, half_width, width_resampling):
     return straighten_worm, grid_x, grid_y
 
 
+def smoothSkeletonsBatch(
+        skeletons,
+        length_resampling=131,
+        smooth_win=11,
+        pol_degree=3):
+    '''
+    Same as smoothSkeletons for an array of skeletons with shape (n_skeletons, n_points, 2).
+    '''
+    skeletons = savgol_filter(skeletons, smooth_win, pol_degree, axis=1)
+
+    n_points = skeletons.shape[1]
+    ii = np.arange(n_points)
+    ii_new = np.linspace(0, n_points - 1, length_resampling)
+
+    # linear interpolation using the same formula as interp1d
+    lo = np.clip(np.searchsorted(ii, ii_new) - 1, 0, n_points - 2)
+    hi = lo + 1
+    slope = (skeletons[:, hi] - skeletons[:, lo]) / (ii[hi] - ii[lo])[:, np.newaxis]
+    skel_new = slope * (ii_new - ii[lo])[:, np.newaxis] + skeletons[:, lo]
+    return skel_new
+
+
+@lru_cache(maxsize=None)
+def _notAKnotMatrix(n):
+    '''
+    Matrix (n + 2, n) that transforms n equally spaced values into the coefficients c[-1], ..., c[n]
+    of the uniform cubic B-spline equal to their not-a-knot interpolating spline. It is the same
+    spline used by RectBivariateSpline (FITPACK with s=0).
+    '''
+    # banded matrix with 4 diagonals on each side
+    ab = np.zeros((9, n + 2))
+    # interpolation conditions (c[i-1] + 4*c[i] + c[i+1])/6 = y[i]
+    ab[3, 2:] = 1
+    ab[4, 1:-1] = 4
+    ab[5, :-2] = 1
+    # not-a-knot conditions (the third derivative is continuous at x=1 and x=n-2)
+    for j, val in enumerate([1, -4, 6, -4, 1]):
+        ab[4 - j, j] = val
+        ab[8 - j, n - 3 + j] = val
+
+    rhs = np.zeros((n + 2, n))
+    rhs[1:-1] = 6*np.eye(n)
+    return solve_banded((4, 4), ab, rhs)
+
+
+def _getSplineMosaic(worm_imgs):
+    '''
+    Place the cubic B-spline coefficients of each ROI side by side so all the ROIs can be interpolated
+    by a single call to map_coordinates (prefilter=False). Each block contains the coefficients
+    c[-1], ..., c[n] along each dimension plus a zero row/column. Return the mosaic and the
+    column of the first pixel of each ROI (the first pixel row is always 1).
+    '''
+    coeffs = [None]*len(worm_imgs)
+
+    # the ROIs with the same shape are transformed together
+    shapes = [img.shape for img in worm_imgs]
+    for shape in set(shapes):
+        inds = [ii for ii, x in enumerate(shapes) if x == shape]
+        imgs = np.array([worm_imgs[ii] for ii in inds], np.float64)
+        shape_coeffs = _notAKnotMatrix(shape[0]) @ imgs @ _notAKnotMatrix(shape[1]).T
+        for ii, coeff in zip(inds, shape_coeffs):
+            coeffs[ii] = coeff
+
+    mosaic = np.zeros((max(x.shape[0] for x in coeffs) + 1, sum(x.shape[1] + 1 for x in coeffs)))
+    offsets = np.zeros(len(coeffs))
+    ini = 0
+    for ii, coeff in enumerate(coeffs):
+        mosaic[:coeff.shape[0], ini:ini + coeff.shape[1]] = coeff
+        offsets[ii] = ini + 1
+        ini += coeff.shape[1] + 1
+    return mosaic, offsets
+
+
+def getStraightenWormIntBatch(worm_imgs, skeletons, half_widths, width_resampling):
+    '''
+    Straighten all the worms in a frame. Same as getStraightenWormInt but the sampling grids
+    are calculated for all the worms at once, and the ROIs are interpolated by a single call
+    to map_coordinates. The interpolation uses the same spline as RectBivariateSpline, and the points outside
+    a ROI are moved to its border (like RectBivariateSpline.ev).
+        worm_imgs - list with the image containing each worm
+        skeletons - array (n_worms, length_resampling, 2) with the skeletons in the ROIs coordinates
+        half_widths - half width of each worm
+        width_resampling - number of data points used in the intensity map along the worm width
+    Return an array (n_worms, width_resampling, length_resampling).
+    '''
+    assert not np.any(np.isnan(skeletons))
+
+    dX = np.diff(skeletons[..., 0], axis=1)
+    dY = np.diff(skeletons[..., 1], axis=1)
+
+    skel_angles = np.arctan2(dY, dX)
+    skel_angles = np.concatenate((skel_angles[:, :1], skel_angles), axis=1)
+    perp_angles = skel_angles - np.pi / 2
+
+    r_ind = np.linspace(-half_widths, half_widths, width_resampling, axis=1)
+
+    grid_x = skeletons[:, np.newaxis, :, 0] + r_ind[:, :, np.newaxis] * np.cos(perp_angles)[:, np.newaxis, :]
+    grid_y = skeletons[:, np.newaxis, :, 1] + r_ind[:, :, np.newaxis] * np.sin(perp_angles)[:, np.newaxis, :]
+
+    # map the grids into the mosaic coordinates
+    mosaic, offsets = _getSplineMosaic(worm_imgs)
+    max_y = np.array([img.shape[0] - 1 for img in worm_imgs])[:, np.newaxis, np.newaxis]
+    max_x = np.array([img.shape[1] - 1 for img in worm_imgs])[:, np.newaxis, np.newaxis]
+    mosaic_y = np.clip(grid_y, 0, max_y) + 1
+    mosaic_x = np.clip(grid_x, 0, max_x) + offsets[:, np.newaxis, np.newaxis]
+
+    straighten_worms = map_coordinates(mosaic, [mosaic_y.ravel(), mosaic_x.ravel()], order=3, prefilter=False)
+    return straighten_worms.reshape(grid_x.shape)
+
+
 def getWidthWinLimits(width_resampling, width_percentage):
     # let's calculate the window along the minor axis of the skeleton to be
     # average, as a percentage of the total interpolated width
@@ -141,6 +254,99 @@ def setIntMapIndexes(skeletons_file, min_num_skel):
     return trajectories_data_valid
 
 
+def _readSortedRows(arr, rows):
+    '''
+    Read the (sorted) rows of an hdf5 array. The rows are grouped in runs of nearby rows 
+    (closer than the array chunk size) and each run is read with a single slice.
+    '''
+    output = np.empty((rows.size, *arr.shape[1:]), arr.dtype)
+    if rows.size == 0:
+        return output
+
+    max_gap = arr.chunkshape[0] if arr.chunkshape is not None else 1
+    run_limits = np.flatnonzero(np.diff(rows) > max_gap) + 1
+    run_limits = np.concatenate(([0], run_limits, [rows.size]))
+    for ini, fin in zip(run_limits[:-1], run_limits[1:]):
+        first_row = rows[ini]
+        run_data = arr[first_row:rows[fin - 1] + 1]
+        output[ini:fin] = run_data[rows[ini:fin] - first_row]
+    return output
+
+
+class _IntMapsWriter():
+    '''
+    Write-behind buffer for the intensity arrays. The rows are accumulated in blocks of block_size
+    contiguous int_map_id, and a block is written as soon as all its rows were calculated.
+    If the buffered blocks exceed max_buffer_mb, the block with the fewest pending rows is written
+    and its remaining rows are written one by one.
+    '''
+    def __init__(self, int_arrays, block_size=1000, max_buffer_mb=256):
+        self.int_arrays = int_arrays
+        self.block_size = block_size
+
+        self.tot_rows = int_arrays[0].shape[0]
+        row_bytes = sum(arr.atom.itemsize*int(np.prod(arr.shape[1:])) for arr in int_arrays)
+        self.max_blocks = max(1, int(max_buffer_mb*2**20 // (block_size*row_bytes)))
+
+        n_blocks = int(np.ceil(self.tot_rows/block_size))
+        self.n_pending = np.full(n_blocks, block_size, np.int64)
+        self.n_pending[-1] = self.tot_rows - (n_blocks - 1)*block_size
+
+        self.buffers = {}
+        self.flushed_blocks = set()
+
+    def _block_limits(self, iblock):
+        ini = iblock*self.block_size
+        return ini, min(ini + self.block_size, self.tot_rows)
+
+    def _write_block(self, iblock):
+        buff = self.buffers.pop(iblock)
+        ini, fin = self._block_limits(iblock)
+        for arr, arr_buff in zip(self.int_arrays, buff):
+            arr[ini:fin] = arr_buff
+
+    def _get_buffer(self, iblock):
+        if iblock not in self.buffers:
+            if len(self.buffers) >= self.max_blocks:
+                #write the block that is closest to be finished to keep the memory bounded
+                ifull = min(self.buffers, key = lambda x : self.n_pending[x])
+                self._write_block(ifull)
+                self.flushed_blocks.add(ifull)
+
+            ini, fin = self._block_limits(iblock)
+            self.buffers[iblock] = [np.full((fin - ini, *arr.shape[1:]), np.nan, arr.atom.dtype)
+                                    for arr in self.int_arrays]
+        return self.buffers[iblock]
+
+    def add(self, int_map_ids, int_values):
+        '''
+        Save the rows int_map_ids. int_values is a list with the values of each of the arrays.
+        '''
+        blocks_ids = int_map_ids // self.block_size
+        for iblock in np.unique(blocks_ids):
+            good = blocks_ids == iblock
+            if iblock in self.flushed_blocks:
+                for arr, val in zip(self.int_arrays, int_values):
+                    for int_map_id, row_val in zip(int_map_ids[good], val[good]):
+                        arr[int_map_id] = row_val
+            else:
+                buff = self._get_buffer(iblock)
+                irows = int_map_ids[good] - iblock*self.block_size
+                for arr_buff, val in zip(buff, int_values):
+                    arr_buff[irows] = val[good]
+
+            self.n_pending[iblock] -= np.sum(good)
+            if self.n_pending[iblock] == 0:
+                if iblock in self.buffers:
+                    self._write_block(iblock)
+                self.flushed_blocks.discard(iblock)
+
+    def close(self):
+        #write the blocks that still have rows missing (e.g. frames not found in the video)
+        for iblock in list(self.buffers):
+            self._write_block(iblock)
+
+
 def getIntensityProfile(
         masked_image_file,
         skeletons_file,
@@ -151,7 +357,14 @@ def getIntensityProfile(
         smooth_win=11,
         pol_degree=3,
         width_percentage=0.5,
-        save_maps=False):
+        save_maps=False,
+        roi_cache_file='',
+        skel_block_rows=10000):
+    '''
+    roi_cache_file -- ROIs saved by BLOB_FEATS. If it is valid, it is used instead of the masked video. 
+                      The file is deleted at the end.
+    skel_block_rows -- approximated number of skeletons read ahead in a single read.
+    '''
     
     min_num_skel = min_num_skel_defaults(skeletons_file, min_num_skel=min_num_skel)
 
@@ -195,20 +408,21 @@ def getIntensityProfile(
             worm_int_avg_tab = int_file_id.create_array(
                 "/", "straighten_worm_intensity_median", obj=np.zeros(0))
             worm_int_avg_tab._v_attrs['has_finished'] = 1
+        if roi_cache_file and os.path.exists(roi_cache_file):
+            os.remove(roi_cache_file)
         return
 
-    with tables.File(masked_image_file, 'r')  as mask_fid, \
-            tables.File(skeletons_file, 'r') as ske_file_id, \
+    with tables.File(skeletons_file, 'r') as ske_file_id, \
             tables.File(intensities_file, "r+") as int_file_id:
 
-        # pointer to the compressed videos
-        mask_dataset = mask_fid.get_node("/mask")
-
         # pointer to skeletons
         skel_tab = ske_file_id.get_node('/skeleton')
-        skel_width_tab = ske_file_id.get_node('/width_midbody')
+        skel_width = ske_file_id.get_node('/width_midbody')[:]
 
-        filters = tables.Filters(complevel=5, complib='zlib', shuffle=True)
+        # use chunks of several rows (about 32kb) so the intensities can be written (and read) in blocks
+        def _chunkshape(row_shape):
+            chunk_rows = max(1, 2**15 // (2*int(np.prod(row_shape))))
+            return (min(tot_rows, chunk_rows), *row_shape)
 
         # we are using Float16 to save space, I am assuing the intensities are
         # between uint8
@@ -219,14 +433,13 @@ def getIntensityProfile(
                 dflt=np.nan),
             (tot_rows,
              length_resampling),
-            chunkshape=(
-                1,
-                length_resampling),
+            chunkshape=_chunkshape((length_resampling,)),
             filters=table_filters)
 
         worm_int_avg_tab._v_attrs['has_finished'] = 0
         worm_int_avg_tab.attrs['width_win_ind'] = width_win_ind
 
+        int_arrays = [worm_int_avg_tab]
         if save_maps:
             worm_int_tab = int_file_id.create_carray(
                 "/",
@@ -236,60 +449,82 @@ def getIntensityProfile(
                 (tot_rows,
                  length_resampling,
                  width_resampling),
-                chunkshape=(
-                    1,
-                    length_resampling,
-                    width_resampling),
+                chunkshape=_chunkshape((length_resampling, width_resampling)),
                 filters=table_filters)
+            int_arrays.append(worm_int_tab)
+
+        int_writer = _IntMapsWriter(int_arrays)
+
+        #column-store view of the table to avoid building a pandas row for each ROI
+        traj_cols = TrajectoriesColumns(trajectories_data_valid, 
+            ['frame_number', 'coord_x', 'coord_y', 'roi_size', 'skeleton_id', 'int_map_id'])
+
+        # the skeletons are read in blocks of frames with about skel_block_rows rows
+        skel_block_frames = max(1, int(skel_block_rows * len(traj_cols.frames) / tot_rows))
+        block_skel_ids = np.zeros(0, np.int64)
+        block_last_frame = -1
 
-        grouped_frames = trajectories_data_valid.groupby('frame_number')
         # variables used to report progress
         base_name = skeletons_file.rpartition(
             '.')[0].rpartition(os.sep)[-1].rpartition('_')[0]
-        progressTime = TimeCounter('Obtaining intensity maps.', len(grouped_frames))
-
-        for frame, frame_data in grouped_frames:
-            img = mask_dataset[frame, :, :]
-            for ii, row_data in frame_data.iterrows():
-                skeleton_id = int(row_data['skeleton_id'])
-                worm_index = int(row_data['worm_index_joined'])
-                int_map_id = int(row_data['int_map_id'])
-
-                # read ROI and skeleton, and put them in the same coordinates
-                # map
-                worm_img, roi_corner = getWormROI(
-                    img, row_data['coord_x'], row_data['coord_y'], row_data['roi_size'])
-                skeleton = skel_tab[skeleton_id, :, :] - roi_corner
-
-                half_width = skel_width_tab[skeleton_id] / 2
-                assert not np.isnan(skeleton[0, 0])
-
-                skel_smooth = smoothSkeletons(
-                    skeleton,
-                    length_resampling=length_resampling,
-                    smooth_win=smooth_win,
-                    pol_degree=pol_degree)
-                straighten_worm, grid_x, grid_y = getStraightenWormInt(
-                    worm_img, skel_smooth, half_width=half_width, width_resampling=width_resampling)
-
-                # if you use the mean it is better to do not use float16
-                int_avg = np.median(
-                    straighten_worm[
-                        width_win_ind[0]:width_win_ind[1],
-                        :],
-                    axis=0)
-
-                worm_int_avg_tab[int_map_id] = int_avg
-
-                # only save the full map if it is specified by the user
-                if save_maps:
-                    worm_int_tab[int_map_id] = straighten_worm.T
-
-            if frame % 500 == 0:
-                progress_str = progressTime.get_str(frame)
-                print_flush(base_name + ' ' + progress_str)
-
+        
+        #the ROIs are extracted without background subtraction
+        ROIs_generator = generateMoviesROI(masked_image_file, 
+                                           traj_cols,
+                                           progress_prefix = base_name + ' Obtaining intensity maps.',
+                                           roi_cache_file = roi_cache_file)
+        
+        for worms_in_frame in ROIs_generator:
+            if len(worms_in_frame) == 0:
+                continue
+
+            irows = traj_cols.get_positions(list(worms_in_frame.keys()))
+            frame_number = traj_cols['frame_number'][irows[0]]
+
+            if frame_number > block_last_frame:
+                # read ahead the skeletons of the next block of frames in a single read
+                block_last_frame = frame_number + skel_block_frames - 1
+                block_rows = traj_cols.frames_range_rows(frame_number, block_last_frame)
+                block_skel_ids = np.sort(traj_cols['skeleton_id'][block_rows].astype(np.int64))
+                block_skels = _readSortedRows(skel_tab, block_skel_ids)
+
+            skeleton_ids = traj_cols['skeleton_id'][irows].astype(np.int64)
+            int_map_ids = traj_cols['int_map_id'][irows].astype(np.int64)
+            worm_imgs, roi_corners = zip(*worms_in_frame.values())
+
+            # put the ROI and skeleton in the same coordinates map
+            skeletons = block_skels[np.searchsorted(block_skel_ids, skeleton_ids)]
+            skeletons = skeletons - np.array(roi_corners)[:, np.newaxis, :]
+            half_widths = skel_width[skeleton_ids] / 2
+
+            skel_smooth = smoothSkeletonsBatch(
+                skeletons,
+                length_resampling=length_resampling,
+                smooth_win=smooth_win,
+                pol_degree=pol_degree)
+            straighten_worms = getStraightenWormIntBatch(
+                worm_imgs, skel_smooth, half_widths=half_widths, width_resampling=width_resampling)
+
+            # if you use the mean it is better to do not use float16
+            int_avg = np.median(
+                straighten_worms[:,
+                    width_win_ind[0]:width_win_ind[1],
+                    :],
+                axis=1)
+
+            int_values = [int_avg]
+            # only save the full map if it is specified by the user
+            if save_maps:
+                int_values.append(straighten_worms.transpose(0, 2, 1))
+
+            int_writer.add(int_map_ids, int_values)
+
+        int_writer.close()
         worm_int_avg_tab._v_attrs['has_finished'] = 1
+    
+    #INT_PROFILE is the last step that uses the ROIs cache
+    if roi_cache_file and os.path.exists(roi_cache_file):
+        os.remove(roi_cache_file)
 
 if __name__ == '__main__':
     # base directory
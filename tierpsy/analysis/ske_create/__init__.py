@@ -19,7 +19,12 @@ def args_(fn, param):
         'min_blob_area': p['traj_min_area'],
         'strel_size': p['strel_size'],
         'analysis_type': p['analysis_type'],
-        'skel_args' : skel_args
+        'skel_args' : skel_args,
+        'n_cores_used' : p['n_cores_used'],
+        'pool_type' : p['ske_pool_type'],
+        'block_size' : p['ske_block_size'],
+        'max_buffer_mb' : p['ske_max_buffer_mb'],
+        'roi_cache_file' : fn['roi_cache'] if p['use_roi_cache'] else ''
         }
 
     #arguments used by AnalysisPoints.py
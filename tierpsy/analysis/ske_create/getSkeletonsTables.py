@@ -12,15 +12,19 @@ Created on Fri Mar 13 19:39:41 2015
 @author: ajaver
 """
 import json
+import multiprocessing as mp
 import os
+import queue
+import threading
+import traceback
 
 import cv2
 import numpy as np
 import pandas as pd
 import tables
 
-from tierpsy.analysis.ske_create.helperIterROI import generateMoviesROI
-from tierpsy.analysis.ske_create.segWormPython.mainSegworm import getSkeleton, resampleAll
+from tierpsy.analysis.ske_create.helperIterROI import generateMoviesROI, TrajectoriesColumns
+from tierpsy.analysis.ske_create.segWormPython.mainSegworm import getSkeletonsBatch, resampleAll
 from tierpsy.analysis.ske_create.zebrafishAnalysis import zebrafishAnalysis, zebrafishSkeleton
 from tierpsy.helper.misc import TABLE_FILTERS
 
@@ -191,8 +195,10 @@ def binaryMask2Contour(
 
 
 
-def _initSkeletonsArrays(ske_file_id, tot_rows, resampling_N, worm_midbody):
+def _initSkeletonsArrays(ske_file_id, tot_rows, resampling_N, worm_midbody, resume_key = None):
     '''initialize arrays to save the skeletons data.
+        If resume_key is given and it is the same as the one saved by a previous interrupted 
+        call, the arrays are kept and the blocks flagged in 'finished_blocks' are returned.
         Used by trajectories2Skeletons
     '''
 
@@ -209,6 +215,17 @@ def _initSkeletonsArrays(ske_file_id, tot_rows, resampling_N, worm_midbody):
     data_dims['width_midbody'] = (tot_rows,)
     data_dims['contour_area'] = (tot_rows,)
     
+    traj_dat = ske_file_id.get_node('/trajectories_data')
+    has_skeleton = traj_dat.cols.has_skeleton
+    
+    #check if there is an interrupted calculation with the same parameters
+    if resume_key is not None and all('/' + x in ske_file_id for x in data_dims):
+        skel_attrs = ske_file_id.get_node('/skeleton')._v_attrs
+        if 'finished_blocks' in skel_attrs and skel_attrs['resume_key'] == resume_key and \
+        all(ske_file_id.get_node('/' + field).shape == dims for field, dims in data_dims.items()):
+            skel_arrays = {field:ske_file_id.get_node('/' + field) for field in data_dims}
+            return skel_arrays, has_skeleton, skel_attrs['finished_blocks']
+    
     #create and reference all the arrays
     def _create_array(field, dims):
         if '/' + field in ske_file_id:
@@ -221,17 +238,336 @@ def _initSkeletonsArrays(ske_file_id, tot_rows, resampling_N, worm_midbody):
                                   filters=TABLE_FILTERS)
         
     skel_arrays = {field:_create_array(field, dims) for field, dims in data_dims.items()}
-    inram_skel_arrays = {field:np.ones(dims, dtype=np.float32)*np.nan for field, dims in data_dims.items()}
     
     # flags to mark if a frame was skeletonized
-    traj_dat = ske_file_id.get_node('/trajectories_data')
-    has_skeleton = traj_dat.cols.has_skeleton
     has_skeleton[:] = np.zeros_like(has_skeleton) #delete previous
     
-#    return skel_arrays, has_skeleton
-    return skel_arrays, has_skeleton, inram_skel_arrays
+    return skel_arrays, has_skeleton, None
+
+
+class _SkeletonsWriter():
+    '''
+    Write-behind buffer for the skeletons arrays. The results are accumulated in blocks of 
+    block_size contiguous skeleton_id, and a block is written as soon as all its rows were 
+    processed. If the buffered blocks exceed max_buffer_mb, the block with the fewest pending 
+    rows is written and its remaining rows are written one by one.
+    The finished blocks are flagged in the attribute `finished_blocks` of /skeleton, so an 
+    interrupted calculation can be resumed.
+    '''
+    def __init__(self, 
+                 ske_file_id, 
+                 skel_arrays, 
+                 has_skeleton, 
+                 midbody_ind, 
+                 block_size, 
+                 max_buffer_mb, 
+                 finished_blocks = None):
+        
+        self.ske_file_id = ske_file_id
+        self.skel_arrays = skel_arrays
+        self.has_skeleton = has_skeleton
+        self.midbody_ind = midbody_ind
+        self.block_size = block_size
+        
+        self.tot_rows = skel_arrays['skeleton'].shape[0]
+        self.row_shapes = {field:arr.shape[1:] for field, arr in skel_arrays.items()}
+        row_bytes = sum(4*int(np.prod(x)) for x in self.row_shapes.values()) + 1
+        self.max_blocks = max(1, int(max_buffer_mb*2**20 // (block_size*row_bytes)))
+        
+        n_blocks = int(np.ceil(self.tot_rows/block_size))
+        self.n_pending = np.full(n_blocks, block_size, np.int64)
+        self.n_pending[-1] = self.tot_rows - (n_blocks - 1)*block_size
+        
+        if finished_blocks is None:
+            finished_blocks = np.zeros(n_blocks, bool)
+            skel_arrays['skeleton']._v_attrs['finished_blocks'] = finished_blocks
+        self.finished_blocks = finished_blocks
+        self.n_pending[finished_blocks] = 0
+        
+        self.buffers = {}
+        self.flushed_blocks = set()
+    
+    def _block_limits(self, iblock):
+        ini = iblock*self.block_size
+        return ini, min(ini + self.block_size, self.tot_rows)
+    
+    def _write_block(self, iblock):
+        buff = self.buffers.pop(iblock)
+        ini, fin = self._block_limits(iblock)
+        for field, arr in self.skel_arrays.items():
+            arr[ini:fin] = buff[field]
+        self.has_skeleton[ini:fin] = buff['has_skeleton']
+        
+    def _get_buffer(self, iblock):
+        if iblock not in self.buffers:
+            if len(self.buffers) >= self.max_blocks:
+                #write the block that is closest to be finished to keep the memory bounded
+                ifull = min(self.buffers, key = lambda x : self.n_pending[x])
+                self._write_block(ifull)
+                self.flushed_blocks.add(ifull)
+            
+            ini, fin = self._block_limits(iblock)
+            buff = {field:np.full((fin - ini, *dims), np.nan, np.float32) for field, dims in self.row_shapes.items()}
+            buff['has_skeleton'] = np.zeros(fin - ini, bool)
+            self.buffers[iblock] = buff
+        return self.buffers[iblock]
+    
+    def add(self, skeleton_id, roi_corner, output):
+        '''
+        Save the output of _skeletonizeRows. output is None if the row does not have a valid skeleton.
+        '''
+        iblock = skeleton_id // self.block_size
+        
+        if output is not None:
+            skeleton, ske_len, cnt_side1, cnt_side2, cnt_widths, cnt_area = output
+            row_data = {
+                'skeleton_length' : ske_len,
+                'contour_width' : cnt_widths,
+                'width_midbody' : np.median(cnt_widths[self.midbody_ind[0]:self.midbody_ind[1]+1]),
+                # convert into the main image coordinates
+                'skeleton' : skeleton + roi_corner,
+                'contour_side1' : cnt_side1 + roi_corner,
+                'contour_side2' : cnt_side2 + roi_corner,
+                'contour_area' : cnt_area
+                }
+            
+            if iblock in self.flushed_blocks:
+                for field, val in row_data.items():
+                    self.skel_arrays[field][skeleton_id] = val
+                self.has_skeleton[skeleton_id] = True
+            else:
+                buff = self._get_buffer(iblock)
+                irow = skeleton_id - iblock*self.block_size
+                for field, val in row_data.items():
+                    buff[field][irow] = val
+                buff['has_skeleton'][irow] = True
+        
+        self.n_pending[iblock] -= 1
+        if self.n_pending[iblock] == 0:
+            self._finish_block(iblock)
+    
+    def _finish_block(self, iblock):
+        if iblock in self.buffers:
+            self._write_block(iblock)
+        self.flushed_blocks.discard(iblock)
+        
+        self.finished_blocks[iblock] = True
+        self.skel_arrays['skeleton']._v_attrs['finished_blocks'] = self.finished_blocks
+        self.ske_file_id.flush()
+    
+    def close(self):
+        #write the blocks that still have rows missing (e.g. frames not found in the video)
+        for iblock in list(self.buffers):
+            self._write_block(iblock)
+        
+        #the calculation finished so there is nothing to resume
+        skel_attrs = self.skel_arrays['skeleton']._v_attrs
+        for key in ['resume_key', 'finished_blocks']:
+            if key in skel_attrs:
+                del skel_attrs[key]
+        self.ske_file_id.flush()
 
 
+def _getROICorner(coord_x, coord_y, roi_size):
+    '''
+    Corner of the ROI extracted by getWormROI (the ROIs are clipped at zero).
+    '''
+    roi_center = int(roi_size) // 2
+    return np.array([max(0, int(coord_x - roi_center)), max(0, int(coord_y - roi_center))])
+
+def _getResumedPrevSkeletons(skel_arrays, has_skeleton, trajectories_data, is_finished):
+    '''
+    Get the skeletons (in ROI coordinates) used to orient the first row after each group of 
+    finished rows of a worm. The skeleton_id of a worm are contiguous and in frame order.
+    Returns a dictionary skeleton_id -> previous skeleton.
+    '''
+    worm_index = trajectories_data['worm_index_joined'].values
+    has_skel = has_skeleton[:].astype(bool)
+    
+    #rows that must be oriented using a skeleton saved in the previous call
+    is_same_worm = np.zeros(worm_index.size, bool)
+    is_same_worm[1:] = worm_index[1:] == worm_index[:-1]
+    is_first_todo = ~is_finished
+    is_first_todo[1:] &= is_finished[:-1]
+    is_first_todo &= is_same_worm
+    
+    #last row that can give a skeleton (saved or calculated in this call) before each row
+    is_source = (is_finished & has_skel) | ~is_finished
+    last_source = np.where(is_source, np.arange(worm_index.size), -1)
+    last_source = np.maximum.accumulate(last_source)
+    
+    prev_skeletons = {}
+    for skeleton_id in np.flatnonzero(is_first_todo):
+        irow = last_source[skeleton_id - 1]
+        if irow < 0 or worm_index[irow] != worm_index[skeleton_id] or not is_finished[irow]:
+            continue
+        row = trajectories_data.iloc[irow]
+        roi_corner = _getROICorner(row['coord_x'], row['coord_y'], row['roi_size'])
+        prev_skeletons[skeleton_id] = skel_arrays['skeleton'][irow].astype(np.float64) - roi_corner
+    return prev_skeletons
+
+
+def _skeletonizeRows(rows, prev_skeleton, skel_params):
+    '''
+    Calculate the skeletons of a list of rows (skeleton_id, worm_index, worm_img, roi_corner, threshold, area, prev_seed).
+    The rows of each worm must be given in frame order, since prev_skeleton[worm_index]
+    is used to orient the next skeleton. prev_seed replaces it if it is not None (used to resume).
+    The output of the rows without a valid skeleton is None.
+    -> Used by trajectories2Skeletons
+    '''
+    analysis_type, strel_size, is_light_background, resampling_N, skel_args = skel_params
+    
+    if analysis_type == "ZEBRAFISH":
+        outputs = []
+        for skeleton_id, worm_index, worm_img, roi_corner, threshold, area, prev_seed in rows:
+            outputs.append(_zebra_func(worm_img, skel_args, resampling_N))
+    else:
+        # the skeletons of all the rows are calculated together
+        worm_cnts, prev_skeletons, worm_indexes = [], [], []
+        worms_in_rows = set()
+        for skeleton_id, worm_index, worm_img, roi_corner, threshold, area, prev_seed in rows:
+            _, worm_cnt, _ = getWormMask(worm_img, 
+                                         threshold, 
+                                         strel_size,
+                                         min_blob_area=area / 2, 
+                                         is_light_background = is_light_background)
+            worm_cnts.append(worm_cnt)
+            
+            # get the previous worm skeletons to orient them (None to use the previous row of the worm)
+            if prev_seed is not None:
+                prev_skeletons.append(prev_seed)
+            elif worm_index not in worms_in_rows:
+                prev_skeletons.append(prev_skeleton.get(worm_index, np.zeros(0)))
+            else:
+                prev_skeletons.append(None)
+            worm_indexes.append(worm_index)
+            worms_in_rows.add(worm_index)
+        
+        outputs = getSkeletonsBatch(worm_cnts, 
+                                    prev_skeletons, 
+                                    resampling_N, 
+                                    worm_index = worm_indexes, 
+                                    **skel_args)
+    
+    skeletons_data = []
+    for (skeleton_id, worm_index, _, roi_corner, _, _, prev_seed), output in zip(rows, outputs):
+        if prev_seed is not None:
+            prev_skeleton[worm_index] = prev_seed
+        
+        if output is not None and output[0].size > 0:
+            prev_skeleton[worm_index] = output[0].copy()
+        else:
+            output = None
+        skeletons_data.append((skeleton_id, roi_corner, output))
+    
+    return skeletons_data
+
+def _skeletonsWorker(task_queue, result_queue, skel_params):
+    #each worker keeps the previous skeletons of the worms assigned to it
+    prev_skeleton = {}
+    try:
+        for rows in iter(task_queue.get, None):
+            result_queue.put(_skeletonizeRows(rows, prev_skeleton, skel_params))
+    except Exception:
+        result_queue.put(traceback.format_exc())
+    else:
+        result_queue.put(None)
+
+def _imapSkeletonsParallel(rows_generator, skel_params, n_cores_used, batch_size = 100, queue_size = 4, 
+                           pool_type = 'PROCESS'):
+    '''
+    Calculate the skeletons using a pool of n_cores_used processes (or threads if pool_type is THREAD). 
+    The rows are sharded by worm_index, so all the rows of a worm are processed in frame order 
+    by the same worker, and the output is the same as _skeletonizeRows. The results are yielded 
+    as they arrive.
+    rows_generator -- yields the list of rows of each frame.
+    '''
+    if pool_type == 'THREAD':
+        #the ROIs are shared with the threads (no pickling), the skeletonization releases the GIL
+        result_queue = queue.Queue()
+        task_queues = [queue.Queue(queue_size) for _ in range(n_cores_used)]
+        worker_class = threading.Thread
+    else:
+        result_queue = mp.Queue()
+        task_queues = [mp.Queue(queue_size) for _ in range(n_cores_used)]
+        worker_class = mp.Process
+    workers = [worker_class(target = _skeletonsWorker, 
+                            args = (q, result_queue, skel_params), 
+                            daemon = True) for q in task_queues]
+    for w in workers:
+        w.start()
+
+    n_finished = 0
+    def _get_results(block):
+        nonlocal n_finished
+        while True:
+            try:
+                res = result_queue.get(block = block)
+            except queue.Empty:
+                return
+            if res is None:
+                n_finished += 1
+                if n_finished == n_cores_used:
+                    return
+            elif isinstance(res, str):
+                raise RuntimeError('Error in a skeletonization worker:\n' + res)
+            else:
+                yield from res
+    
+    def _send(iworker, rows):
+        #do not block on a full queue without reading the results, otherwise an error 
+        #in a worker would never be raised
+        while True:
+            try:
+                task_queues[iworker].put(rows, timeout = 1)
+                return
+            except queue.Full:
+                yield from _get_results(block = False)
+    
+    try:
+        #new worms are assigned to the worker with the fewest rows
+        worm_worker = {}
+        n_rows = np.zeros(n_cores_used, np.int64)
+        batches = [[] for _ in range(n_cores_used)]
+        for frame_rows in rows_generator:
+            for row in frame_rows:
+                worm_index = row[1]
+                if worm_index not in worm_worker:
+                    worm_worker[worm_index] = np.argmin(n_rows)
+                iworker = worm_worker[worm_index]
+                n_rows[iworker] += 1
+                batches[iworker].append(row)
+            
+            for iworker, rows in enumerate(batches):
+                if len(rows) >= batch_size:
+                    yield from _send(iworker, rows)
+                    batches[iworker] = []
+            yield from _get_results(block = False)
+        
+        for iworker, rows in enumerate(batches):
+            if rows:
+                yield from _send(iworker, rows)
+            yield from _send(iworker, None)
+        yield from _get_results(block = True)
+        
+        for w in workers:
+            w.join()
+    finally:
+        for w, q in zip(workers, task_queues):
+            if not w.is_alive():
+                continue
+            if pool_type == 'THREAD':
+                #threads cannot be terminated, drop their pending rows and let them finish
+                while True:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        break
+                q.put(None)
+            else:
+                w.terminate()
+                w.join()
+
 
 def trajectories2Skeletons(skeletons_file, 
                             masked_image_file,
@@ -241,8 +577,23 @@ def trajectories2Skeletons(skeletons_file,
                             worm_midbody=(0.35, 0.65),
                             analysis_type="WORM", 
                             skel_args = {'num_segments' : 24, 
-                                         'head_angle_thresh' : 60}
+                                         'head_angle_thresh' : 60},
+                            n_cores_used = 1,
+                            block_size = 10000,
+                            max_buffer_mb = 1024,
+                            roi_cache_file = '',
+                            pool_type = 'PROCESS'
                             ):
+    '''
+    n_cores_used -- if larger than one the skeletons are calculated by a pool of processes. 
+                    The rows are distributed by worm_index_joined so the result is the 
+                    same as in the serial case.
+    pool_type -- PROCESS or THREAD. The threads do not need to copy the ROIs to the workers.
+    block_size -- number of contiguous skeleton_id written together into the skeletons arrays. 
+                  If the calculation is interrupted it is resumed from the finished blocks.
+    max_buffer_mb -- maximum memory used to buffer the blocks before they are written.
+    roi_cache_file -- ROIs saved by BLOB_FEATS. If it is valid, it is used instead of the masked video.
+    '''
     
     #get the index number for the width limit
     midbody_ind = (int(np.floor(
@@ -271,12 +622,6 @@ def trajectories2Skeletons(skeletons_file,
             #invert (at least if is_light_background is true)
             is_light_background = not is_light_background
 
-        
-        #get generators to get the ROI for each frame
-        ROIs_generator = generateMoviesROI(masked_image_file, 
-                                         trajectories_data, 
-                                         bgnd_param = bgnd_param,
-                                         progress_prefix = progress_prefix)
 
         # add data from the experiment info (currently only for singleworm)
         with tables.File(masked_image_file, "r") as mask_fid:  
@@ -286,75 +631,77 @@ def trajectories2Skeletons(skeletons_file,
                 dd = mask_fid.get_node('/experiment_info').read()
                 ske_file_id.create_array('/', 'experiment_info', obj=dd)
         
-                
+        skel_params = (analysis_type, strel_size, is_light_background, resampling_N, skel_args)
+        
         #initialize arrays to save the skeletons data
         tot_rows = len(trajectories_data)
-#        skel_arrays, has_skeleton = _initSkeletonsArrays(ske_file_id, 
-        skel_arrays, has_skeleton, inram_skel_arrays = _initSkeletonsArrays(ske_file_id, 
-                                                                                tot_rows, 
-                                                                                resampling_N, 
-                                                                                worm_midbody)
+        resume_key = json.dumps([tot_rows, block_size, midbody_ind, skel_params], default=str)
+        skel_arrays, has_skeleton, finished_blocks = _initSkeletonsArrays(ske_file_id, 
+                                                                         tot_rows, 
+                                                                         resampling_N, 
+                                                                         worm_midbody, 
+                                                                         resume_key)
+        skel_arrays['skeleton']._v_attrs['resume_key'] = resume_key
+        skeletons_writer = _SkeletonsWriter(ske_file_id, 
+                                            skel_arrays, 
+                                            has_skeleton, 
+                                            midbody_ind, 
+                                            block_size, 
+                                            max_buffer_mb, 
+                                            finished_blocks)
+        
+        prev_seeds = {}
+        if finished_blocks is not None:
+            #only calculate the rows that were not saved in the interrupted call
+            is_finished = finished_blocks[trajectories_data['skeleton_id'].values // block_size]
+            prev_seeds = _getResumedPrevSkeletons(skel_arrays, has_skeleton, trajectories_data, is_finished)
+            trajectories_data = trajectories_data[~is_finished]
+        
+        #column-store view of the table to avoid building a pandas row for each ROI
+        traj_cols = TrajectoriesColumns(trajectories_data, 
+                                        ['frame_number', 'coord_x', 'coord_y', 'roi_size', 
+                                        'skeleton_id', 'worm_index_joined', 'threshold', 'area'])
+        
+        #get generators to get the ROI for each frame
+        ROIs_generator = generateMoviesROI(masked_image_file, 
+                                         traj_cols, 
+                                         bgnd_param = bgnd_param,
+                                         progress_prefix = progress_prefix,
+                                         roi_cache_file = roi_cache_file)
         
-        # dictionary to store previous skeletons
-        prev_skeleton = {}
+        def _rows_generator():
+            skeleton_ids = traj_cols['skeleton_id']
+            worm_indexes = traj_cols['worm_index_joined']
+            thresholds = traj_cols['threshold']
+            areas = traj_cols['area']
+            for worms_in_frame in ROIs_generator:
+                frame_rows = []
+                irows = traj_cols.get_positions(list(worms_in_frame.keys()))
+                for irow, (worm_img, roi_corner) in zip(irows, worms_in_frame.values()):
+                    skeleton_id = int(skeleton_ids[irow])
+                    frame_rows.append((skeleton_id, 
+                                       int(worm_indexes[irow]), 
+                                       worm_img, 
+                                       roi_corner, 
+                                       float(thresholds[irow]), 
+                                       float(areas[irow]),
+                                       prev_seeds.get(skeleton_id, None)))
+                yield frame_rows
         
-        for worms_in_frame in ROIs_generator:
-            for ind, roi_dat in worms_in_frame.items():
-                row_data = trajectories_data.loc[ind]
-                worm_img, roi_corner = roi_dat
-                skeleton_id = int(row_data['skeleton_id'])
-                
-                # get the previous worm skeletons to orient them
-                worm_index = row_data['worm_index_joined']
-                if worm_index not in prev_skeleton:
-                    prev_skeleton[worm_index] = np.zeros(0)
-
-                if analysis_type == "ZEBRAFISH":
-                     output = _zebra_func(worm_img, skel_args, resampling_N)
-                else:
-                    _, worm_cnt, _ = getWormMask(worm_img, 
-                                                 row_data['threshold'], 
-                                                 strel_size,
-                                                 min_blob_area=row_data['area'] / 2, 
-                                                 is_light_background = is_light_background)
-                    # get skeletons
-                    output = getSkeleton(worm_cnt, prev_skeleton[worm_index], resampling_N, **skel_args)
-
-                
-                
-                
-                if output is not None and output[0].size > 0:
-                    skeleton, ske_len, cnt_side1, cnt_side2, cnt_widths, cnt_area = output
-                    prev_skeleton[worm_index] = skeleton.copy()
-
-                    #mark row as a valid skeleton
-                    has_skeleton[skeleton_id] = True
-                    
-                    # save segwrom_results
-#                    skel_arrays['skeleton_length'][skeleton_id] = ske_len
-#                    skel_arrays['contour_width'][skeleton_id, :] = cnt_widths
-                    inram_skel_arrays['skeleton_length'][skeleton_id] = ske_len
-                    inram_skel_arrays['contour_width'][skeleton_id, :] = cnt_widths
-                    
-                    mid_width = np.median(cnt_widths[midbody_ind[0]:midbody_ind[1]+1])
-#                    skel_arrays['width_midbody'][skeleton_id] = mid_width
-                    inram_skel_arrays['width_midbody'][skeleton_id] = mid_width
-
-                    # convert into the main image coordinates
-#                    skel_arrays['skeleton'][skeleton_id, :, :] = skeleton + roi_corner
-#                    skel_arrays['contour_side1'][skeleton_id, :, :] = cnt_side1 + roi_corner
-#                    skel_arrays['contour_side2'][skeleton_id, :, :] = cnt_side2 + roi_corner
-#                    skel_arrays['contour_area'][skeleton_id] = cnt_area
-                    inram_skel_arrays['skeleton'][skeleton_id, :, :] = skeleton + roi_corner
-                    inram_skel_arrays['contour_side1'][skeleton_id, :, :] = cnt_side1 + roi_corner
-                    inram_skel_arrays['contour_side2'][skeleton_id, :, :] = cnt_side2 + roi_corner
-                    inram_skel_arrays['contour_area'][skeleton_id] = cnt_area
-#        import pdb
-#        pdb.set_trace()
+        if n_cores_used > 1:
+            skeletons_generator = _imapSkeletonsParallel(_rows_generator(), 
+                                                         skel_params, 
+                                                         n_cores_used, 
+                                                         pool_type = pool_type)
+        else:
+            # dictionary to store previous skeletons
+            prev_skeleton = {}
+            skeletons_generator = (x for frame_rows in _rows_generator() 
+                                        for x in _skeletonizeRows(frame_rows, prev_skeleton, skel_params))
         
-#         now write on disk
-        for key in inram_skel_arrays:
-            skel_arrays[key][:] = inram_skel_arrays[key].astype(np.float32)
+        for skeleton_id, roi_corner, output in skeletons_generator:
+            skeletons_writer.add(skeleton_id, roi_corner, output)
+        skeletons_writer.close()
         
 if __name__ == '__main__':
     
@@ -7,8 +7,10 @@ Created on Tue Nov 29 21:22:22 2016
 """
 
 import numpy as np
+import pandas as pd
 import tables
 
+from tierpsy.analysis.compress.compressVideo import getImgFilters
 from tierpsy.analysis.traj_create.getBlobTrajectories import generateImages
 from tierpsy.helper.misc import TimeCounter, print_flush
 from tierpsy.helper.params import read_fps
@@ -52,14 +54,72 @@ def getWormROI(img, CMx, CMy, roi_size=128):
 
 def getAllImgROI(img, frame_data, roi_size=-1):
     #more generic function that tolerates different ROI size
+    coord_x = frame_data['coord_x'].values
+    coord_y = frame_data['coord_y'].values
+    if roi_size > 0:
+        roi_sizes = np.full(len(frame_data), roi_size)
+    else:
+        roi_sizes = frame_data['roi_size'].values
+    
     worms_in_frame = {}
-    for irow, row in frame_data.iterrows():
-        worm_roi_size = roi_size if roi_size > 0 else row['roi_size']
-        
-        worms_in_frame[irow] = getWormROI(img, row['coord_x'], row['coord_y'], worm_roi_size)
+    for irow, CMx, CMy, worm_roi_size in zip(frame_data.index, coord_x, coord_y, roi_sizes):
+        worms_in_frame[irow] = getWormROI(img, CMx, CMy, worm_roi_size)
     return worms_in_frame
 
+
+class TrajectoriesColumns():
+    '''
+    Column-store view of a trajectories_data table. The columns are numpy arrays indexed 
+    by the row position, and the positions of the rows of each frame are indexed once.
+    '''
+    def __init__(self, trajectories_data, columns = None):
+        if columns is None:
+            columns = trajectories_data.columns
+        self.columns = {col : trajectories_data[col].values for col in columns}
+        self.index = trajectories_data.index
+        
+        # sort the positions by frame, keeping the table order within a frame
+        frame_number = trajectories_data['frame_number'].values
+        self._frame_order = np.argsort(frame_number, kind='stable')
+        self.frames, frame_ini = np.unique(frame_number[self._frame_order], return_index=True)
+        self._frame_limits = np.append(frame_ini, frame_number.size)
+        
+        #the index is usually the same as the row positions, so there is no need to search
+        self._is_range_index = self.index.equals(pd.RangeIndex(len(self.index)))
+    
+    def __len__(self):
+        return len(self.index)
     
+    def __getitem__(self, col):
+        return self.columns[col]
+    
+    def frame_rows(self, frame_number):
+        '''
+        Positions of the rows of a given frame.
+        '''
+        ii = np.searchsorted(self.frames, frame_number)
+        if ii >= self.frames.size or self.frames[ii] != frame_number:
+            return np.zeros(0, np.int64)
+        return self._frame_order[self._frame_limits[ii]:self._frame_limits[ii + 1]]
+
+    def frames_range_rows(self, first_frame, last_frame):
+        '''
+        Positions of the rows with first_frame <= frame_number <= last_frame.
+        '''
+        ini = np.searchsorted(self.frames, first_frame, side='left')
+        fin = np.searchsorted(self.frames, last_frame, side='right')
+        return self._frame_order[self._frame_limits[ini]:self._frame_limits[fin]]
+
+    def get_positions(self, labels):
+        '''
+        Positions of the rows from the table index labels (the keys yielded by generateMoviesROI).
+        '''
+        labels = np.asarray(labels)
+        if self._is_range_index:
+            return labels
+        return self.index.get_indexer(labels)
+
+
 def pad_if_necessary(worm_roi, roi_corner, roi_size):
     
     #if the dimenssion are correct return
@@ -105,34 +165,182 @@ def getROIFixSize(worms_in_frame, roi_size):
         roi_corners[ii, :] = roi_corner
     return indexes, worm_imgs, roi_corners 
 
+_ROI_CACHE_FIELDS = [('row_index', np.int64), 
+                     ('frame_number', np.int32), 
+                     ('coord_x', np.float32), 
+                     ('coord_y', np.float32), 
+                     ('roi_size', np.float32),
+                     ('corner_x', np.int32),
+                     ('corner_y', np.int32),
+                     ('roi_height', np.int32),
+                     ('roi_width', np.int32)]
+
+def cacheMoviesROI(ROIs_generator, roi_cache_file, trajectories_data):
+    '''
+    Pass through the output of generateMoviesROI and save the ROIs, in the same order, into 
+    roi_cache_file so they can be read again by generateMoviesROI without decoding the video.
+    The ROIs must be extracted without background subtraction and using the table roi_size.
+    '''
+    roi_side = 2*(int(np.nanmax(trajectories_data['roi_size']))//2) if len(trajectories_data) > 0 else 0
+    chunk_rows = max(1, 2**20//max(1, roi_side*roi_side))
+    
+    with tables.File(roi_cache_file, 'w') as fid:
+        rois = fid.create_earray('/', 
+                                 'rois', 
+                                 tables.UInt8Atom(), 
+                                 (0, roi_side, roi_side), 
+                                 chunkshape = (chunk_rows, roi_side, roi_side), 
+                                 filters = getImgFilters('blosc:lz4', 1))
+        rois_data = fid.create_table('/', 
+                                     'rois_data', 
+                                     np.dtype(_ROI_CACHE_FIELDS), 
+                                     filters = getImgFilters('blosc:lz4', 1))
+        rois._v_attrs['has_finished'] = 0
+        
+        for worms_in_frame in ROIs_generator:
+            irows = trajectories_data.get_positions(list(worms_in_frame.keys()))
+            frame_rois = np.zeros((len(irows), roi_side, roi_side), np.uint8)
+            frame_data = np.recarray(len(irows), _ROI_CACHE_FIELDS)
+            for ii, (irow, (label, (worm_img, roi_corner))) in enumerate(zip(irows, worms_in_frame.items())):
+                roi_h, roi_w = worm_img.shape if worm_img.ndim == 2 else (0, 0)
+                frame_rois[ii, :roi_h, :roi_w] = worm_img
+                frame_data[ii] = (label, 
+                                  trajectories_data['frame_number'][irow], 
+                                  trajectories_data['coord_x'][irow], 
+                                  trajectories_data['coord_y'][irow], 
+                                  trajectories_data['roi_size'][irow],
+                                  *(roi_corner if roi_h > 0 else (-1, -1)),
+                                  roi_h, 
+                                  roi_w)
+            rois.append(frame_rois)
+            rois_data.append(frame_data)
+            
+            yield worms_in_frame
+        
+        rois._v_attrs['has_finished'] = 1
+
+
+def _getROICachePositions(roi_cache_file, trajectories_data):
+    '''
+    Positions in roi_cache_file of the rows of trajectories_data (ordered by frame). 
+    Returns None if the cache does not exist, is incomplete or was calculated from different data.
+    '''
+    try:
+        with tables.File(roi_cache_file, 'r') as fid:
+            if fid.get_node('/rois')._v_attrs['has_finished'] != 1:
+                return None
+            rois_data = fid.get_node('/rois_data')[:]
+    except (OSError, tables.exceptions.NoSuchNodeError, KeyError):
+        return None
+    
+    labels = trajectories_data.index.values[trajectories_data._frame_order]
+    cache_labels = rois_data['row_index']
+    
+    #the cache must contain the rows in the same order
+    sorted_ind = np.argsort(cache_labels)
+    ii = np.searchsorted(cache_labels, labels, sorter=sorted_ind)
+    ii[ii >= cache_labels.size] = 0
+    cache_pos = sorted_ind[ii] if cache_labels.size > 0 else ii
+    if cache_labels.size == 0 or np.any(cache_labels[cache_pos] != labels) or np.any(np.diff(cache_pos) <= 0):
+        return None
+    
+    #check that the trajectories were not recalculated after the cache was created
+    for field in ['frame_number', 'coord_x', 'coord_y', 'roi_size']:
+        cache_val = rois_data[field][cache_pos]
+        val = trajectories_data[field][trajectories_data._frame_order].astype(cache_val.dtype)
+        if not np.array_equal(cache_val, val, equal_nan = True):
+            return None
+    
+    return cache_pos
+
+def _generateCachedROIs(roi_cache_file, trajectories_data, cache_pos, progress_prefix, block_size = 1024):
+    #read the ROIs from roi_cache_file in blocks, the positions are sorted by frame
+    labels = trajectories_data.index.values[trajectories_data._frame_order]
+    frame_limits = trajectories_data._frame_limits
+    
+    progress_time = TimeCounter(progress_prefix, trajectories_data.frames.size)
+    with tables.File(roi_cache_file, 'r') as fid:
+        rois = fid.get_node('/rois')
+        rois_data = fid.get_node('/rois_data')
+        
+        blk_ini, blk_fin = 0, 0
+        for iframe in range(trajectories_data.frames.size):
+            worms_in_frame = {}
+            for ii in range(frame_limits[iframe], frame_limits[iframe + 1]):
+                pos = cache_pos[ii]
+                if pos >= blk_fin:
+                    blk_ini, blk_fin = pos, min(pos + block_size, rois.shape[0])
+                    blk_rois = rois[blk_ini:blk_fin]
+                    blk_data = rois_data[blk_ini:blk_fin]
+                
+                row = blk_data[pos - blk_ini]
+                if row['roi_height'] > 0:
+                    worm_img = blk_rois[pos - blk_ini, :row['roi_height'], :row['roi_width']].copy()
+                    roi_corner = np.array([row['corner_x'], row['corner_y']], dtype=np.int64)
+                else:
+                    worm_img, roi_corner = np.zeros(0, dtype=np.uint8), np.array([np.nan] * 2)
+                worms_in_frame[labels[ii]] = (worm_img, roi_corner)
+            yield worms_in_frame
+            
+            if iframe % 500 == 0:
+                print_flush(progress_time.get_str(iframe))
+        print_flush(progress_time.get_str(iframe))
+    
+
 def generateMoviesROI(masked_file, 
                     trajectories_data,
                     roi_size = -1, 
                     progress_prefix = '',
                     bgnd_param = {},
-                    progress_refresh_rate_s=20):
+                    progress_refresh_rate_s=20,
+                    roi_cache_file = ''):
+    '''
+    Yields, for each frame, a dictionary where the keys are the trajectories_data index and 
+    the values are the worm ROIs. trajectories_data can be a DataFrame or a TrajectoriesColumns.
+    roi_cache_file -- if it is a valid file created by cacheMoviesROI, the ROIs are read from it 
+                      instead of the masked video. It is ignored if bgnd_param is given.
+    '''
 
     if len(trajectories_data) == 0:
         print_flush(progress_prefix + ' No valid data. Exiting.')
         
     else:
-        frames = trajectories_data['frame_number'].unique()
+        if not isinstance(trajectories_data, TrajectoriesColumns):
+            cols = ['frame_number', 'coord_x', 'coord_y'] 
+            if roi_size <= 0 or roi_cache_file:
+                cols.append('roi_size')
+            trajectories_data = TrajectoriesColumns(trajectories_data, cols)
+        
+        if roi_cache_file and roi_size <= 0 and len(bgnd_param) == 0:
+            cache_pos = _getROICachePositions(roi_cache_file, trajectories_data)
+            if cache_pos is not None:
+                yield from _generateCachedROIs(roi_cache_file, trajectories_data, cache_pos, progress_prefix)
+                return
+        
+        #the frames must be read in order, the skeletons are oriented using the previous frame
+        frames = trajectories_data.frames
         
         img_generator = generateImages(masked_file, 
                                        frames = frames, 
                                        bgnd_param = bgnd_param)
         
-        traj_group_by_frame = trajectories_data.groupby('frame_number')
         progress_time = TimeCounter(progress_prefix, max(frames))
         
         fps = read_fps(masked_file, dflt=25)
         progress_refresh_rate = int(round(fps*progress_refresh_rate_s))
-
+        
+        labels = trajectories_data.index.values
+        coord_x = trajectories_data['coord_x']
+        coord_y = trajectories_data['coord_y']
+        roi_sizes = trajectories_data['roi_size'] if roi_size <= 0 else None
+        
         for ii, (current_frame, img) in enumerate(img_generator):
-            frame_data = traj_group_by_frame.get_group(current_frame)
-            
             #dictionary where keys are the table row and the values the worms ROIs
-            yield getAllImgROI(img, frame_data, roi_size)
+            worms_in_frame = {}
+            for irow in trajectories_data.frame_rows(current_frame):
+                worm_roi_size = roi_size if roi_sizes is None else roi_sizes[irow]
+                worms_in_frame[labels[irow]] = getWormROI(img, coord_x[irow], coord_y[irow], worm_roi_size)
+            yield worms_in_frame
             
             if current_frame % progress_refresh_rate == 0:
                 print_flush(progress_time.get_str(current_frame))
@@ -21,8 +21,8 @@ import numpy as np
 cimport numpy as np
 
 # declare the interface to the C code
-cdef extern void c_circCurvature(double *points, int numberOfPoints, double edgeLength, double *chainCodeLengths, double *angles)
-cdef extern void c_circCurvature_simple(double *points, int numberOfPoints, double edgeLength, double *angles)
+cdef extern void c_circCurvature(double *points, int numberOfPoints, double edgeLength, double *chainCodeLengths, double *angles) nogil
+cdef extern void c_circCurvature_simple(double *points, int numberOfPoints, double edgeLength, double *angles) nogil
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
@@ -41,10 +41,37 @@ double edgeLength, np.ndarray[np.float_t, ndim=1, mode="c"] chainCodeLengths = n
     cdef np.ndarray[np.float_t, ndim=1, mode="c"] angles = np.zeros(numberOfPoints)
     
     
+    cdef double *points_ptr = &points[0,0]
+    cdef double *angles_ptr = &angles[0]
+    cdef double *lengths_ptr = &chainCodeLengths[0]
+    
     if chainCodeLengths.size == numberOfPoints:
-        c_circCurvature(&points[0,0], numberOfPoints, edgeLength, &chainCodeLengths[0], &angles[0])    
+        with nogil:
+            c_circCurvature(points_ptr, numberOfPoints, edgeLength, lengths_ptr, angles_ptr)
     else:
-        c_circCurvature_simple(&points[0,0], numberOfPoints, edgeLength, &angles[0])    
+        with nogil:
+            c_circCurvature_simple(points_ptr, numberOfPoints, edgeLength, angles_ptr)
     
     return angles
 
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def circCurvatureBatch(double[:, ::1] points not None, Py_ssize_t[::1] offsets not None, \
+double[::1] edgeLengths not None, double[::1] chainCodeLengths not None):
+    """
+    Batched version of circCurvature. The contours are concatenated in points, 
+    and offsets has the index where each contour starts (plus the total number 
+    of points). Each contour has its own edge length, and the chain code 
+    lengths are required. The GIL is released during the calculation.
+    """
+    cdef Py_ssize_t ii, ini
+    cdef Py_ssize_t n_contours = offsets.shape[0] - 1
+    cdef double[::1] angles = np.zeros(points.shape[0])
+    
+    with nogil:
+        for ii in range(n_contours):
+            ini = offsets[ii]
+            c_circCurvature(&points[ini, 0], <int>(offsets[ii + 1] - ini), edgeLengths[ii], &chainCodeLengths[ini], &angles[ini])
+    
+    return np.asarray(angles)
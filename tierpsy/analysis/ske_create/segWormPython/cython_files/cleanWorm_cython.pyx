@@ -11,13 +11,15 @@ import numpy as np
 cimport numpy as np
 cimport cython
 from libc.math cimport round as c_round;
-from libc.math cimport sqrt, floor, ceil
+from libc.math cimport sqrt, floor, ceil, isnan
 
 
-cdef inline bint compare_extrema(bint is_min, float x1, float x2):
+@cython.profile(False)
+cdef inline bint compare_extrema(bint is_min, float x1, float x2) noexcept nogil:
     return x1>x2 if is_min else x1<x2
 
-cdef inline bint compare_extrema_eq(bint is_min, float x1, float x2):
+@cython.profile(False)
+cdef inline bint compare_extrema_eq(bint is_min, float x1, float x2) noexcept nogil:
     return x1>=x2 if is_min else x1<=x2
 
 @cython.boundscheck(False)
@@ -158,6 +160,156 @@ cdef extremaPeaksCircDist_(bint is_min, np.ndarray[np.float64_t, ndim=1] x, floa
 
 
 
+#%% Batched versions used by mainSegworm.getSkeletonsBatch. The arrays of all the
+# contours are concatenated, and offsets has the position where each contour starts
+# (plus the total number of points at the end). The loops release the GIL.
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def circSmoothBatch(double[::1] angles not None, Py_ssize_t[::1] offsets not None, double[::1] blurLengths not None):
+    '''
+    Batched version of cleanWorm.circSmooth (moving average of a circular vector).
+    '''
+    cdef double[::1] smoothed = np.array(angles, copy=True)
+    cdef Py_ssize_t ii, ini, n_points, win_size, n_left, i, j, k
+    cdef double val, res
+    
+    with nogil:
+        for ii in range(offsets.shape[0] - 1):
+            if blurLengths[ii] <= 1:
+                continue
+            ini = offsets[ii]
+            n_points = offsets[ii + 1] - ini
+            win_size = <Py_ssize_t>blurLengths[ii]
+            val = 1. / blurLengths[ii]
+            #same order of operations as the np.convolve used by cleanWorm.circConv
+            n_left = win_size // 2
+            for i in range(n_points):
+                k = (i - n_left) % n_points
+                if k < 0:
+                    k += n_points
+                res = angles[ini + k] * val
+                for j in range(1, win_size):
+                    k += 1
+                    if k == n_points:
+                        k = 0
+                    res = res + angles[ini + k] * val
+                smoothed[ini + i] = res
+    return np.asarray(smoothed)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.profile(False)
+cdef Py_ssize_t _extremaPeaksCircDist(bint is_min, double *x, Py_ssize_t numberOfPoints, float dist,
+    double *chainCodeLengths, double *peaks, np.int64_t *indices) noexcept nogil:
+    #same as extremaPeaksCircDist, the peaks are written in peaks and indices, 
+    #and the number of peaks is returned
+    cdef:
+        int im = -1
+        int ie = -1
+        int ip = 0
+        double p = x[ip]
+        int i = 1
+        int j = 0
+        int k
+        bint isExtrema
+        int lastIndexChain = numberOfPoints - 1
+        int indexStart = 0
+        int indexEnd
+    
+    if (chainCodeLengths[lastIndexChain] < 2 * dist + 1):
+        #the vector is smaller than the search window (np.argmax/np.argmin)
+        for i in range(1, numberOfPoints):
+            if isnan(x[ip]):
+                break
+            if isnan(x[i]) or (x[i] < x[ip] if is_min else x[i] > x[ip]):
+                ip = i
+        peaks[0] = x[ip]
+        indices[0] = ip
+        return 1
+
+    while (i < numberOfPoints):
+        if compare_extrema_eq(is_min, p, x[i]):
+            ip = i;
+            p = x[i];
+        
+        if ((chainCodeLengths[i] - chainCodeLengths[ip]) >= dist) or (i == lastIndexChain):
+            if (im >= 0) and ((chainCodeLengths[ip] - chainCodeLengths[im]) <= (2 * dist)):
+                isExtrema = True;
+                k = ie;
+                while isExtrema and (k >= 0) and ((chainCodeLengths[ip] - chainCodeLengths[k]) < dist):
+                    if compare_extrema_eq(is_min, x[ip], x[k]):
+                        isExtrema = False;
+                    k -= 1;
+                
+                if isExtrema:
+                    indices[j] = ip;
+                    peaks[j] = p;
+                    j = j + 1;
+            else:
+                indices[j] = ip;
+                peaks[j] = p;
+                j = j + 1;
+            im = ip;
+            ie = i;
+            ip = i;
+            p = x[ip];
+        i += 1;
+
+    indexEnd = j - 1
+    if(j > 2):
+        if ((chainCodeLengths[indices[indexStart]] + chainCodeLengths[lastIndexChain] - chainCodeLengths[indices[indexEnd]]) < dist):
+            if compare_extrema_eq(is_min, peaks[indexStart], peaks[indexEnd]):
+                indexStart += 1;
+            else:
+                indexEnd -= 1;
+        else:
+            k = numberOfPoints-1;
+            while ((chainCodeLengths[indices[indexStart]] + chainCodeLengths[lastIndexChain] - chainCodeLengths[k]) < dist):
+                if compare_extrema_eq(is_min, peaks[0], x[k]):
+                    indexStart += 1;
+                    break;
+                k -= 1;
+            
+            k = 0;
+            while ((chainCodeLengths[lastIndexChain] - chainCodeLengths[indices[indexEnd]] + chainCodeLengths[k]) < dist):
+                if compare_extrema(is_min, peaks[indexEnd], x[k]):
+                    indexEnd -= 1;
+                    break;
+                k += 1
+    
+    j = indexEnd - indexStart + 1
+    if indexStart > 0:
+        for i in range(j):
+            peaks[i] = peaks[i + indexStart]
+            indices[i] = indices[i + indexStart]
+    return j
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def extremaPeaksCircDistBatch(int extrema_type, double[::1] x not None, Py_ssize_t[::1] offsets not None, 
+    double[::1] dists not None, double[::1] chainCodeLengths not None):
+    '''
+    Batched version of extremaPeaksCircDist (extrema type positive for maxima, negative or zero for minima).
+    It returns (peaks, indices, peaks_offsets). The indices are relative to the start of each contour,
+    and the peaks of the contour ii are in peaks_offsets[ii]:peaks_offsets[ii+1].
+    '''
+    cdef Py_ssize_t n_contours = offsets.shape[0] - 1
+    cdef double[::1] peaks = np.zeros(x.shape[0])
+    cdef np.int64_t[::1] indices = np.zeros(x.shape[0], dtype = np.int64)
+    cdef Py_ssize_t[::1] peaks_offsets = np.zeros(n_contours + 1, dtype = np.intp)
+    cdef bint is_min = extrema_type <= 0
+    cdef Py_ssize_t ii, ini, tot = 0
+    
+    with nogil:
+        for ii in range(n_contours):
+            ini = offsets[ii]
+            tot += _extremaPeaksCircDist(is_min, &x[ini], offsets[ii + 1] - ini, <float>dists[ii], 
+                                         &chainCodeLengths[ini], &peaks[tot], &indices[tot])
+            peaks_offsets[ii + 1] = tot
+    
+    return np.asarray(peaks)[:tot].copy(), np.asarray(indices)[:tot].copy(), np.asarray(peaks_offsets)
+
 cdef inline double absDiff(double a, double b): 
     return a-b if a>b else b-a
     
@@ -21,7 +21,7 @@ import numpy as np
 cimport numpy as np
 
 # declare the interface to the C code
-cdef extern double c_curvspace(double *points, int p_size, int p_dim, int N, double *output)
+cdef extern double c_curvspace(double *points, int p_size, int p_dim, int N, double *output) nogil
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
@@ -36,11 +36,14 @@ def curvspace(np.ndarray[double, ndim=2, mode="c"] points not None, int N):
 
     """
     cdef int p_size, p_dim
-    cdef curv_len
+    cdef double curv_len
     
     cdef np.ndarray[double, ndim=2, mode="c"] output = np.zeros((N,2))
     p_size, p_dim = points.shape[0], points.shape[1]
+    cdef double *points_ptr = &points[0,0]
+    cdef double *output_ptr = &output[0,0]
     
-    curv_len = c_curvspace (&points[0,0], p_size, p_dim, N, &output[0,0])    
+    with nogil:
+        curv_len = c_curvspace (points_ptr, p_size, p_dim, N, output_ptr)
     return output, curv_len 
 
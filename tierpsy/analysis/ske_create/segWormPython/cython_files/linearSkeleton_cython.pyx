@@ -15,45 +15,28 @@ from libc.math cimport round as c_round;
 from libc.math cimport sqrt, fabs, floor, ceil, fmin, fmax
 
 
-cdef inline double absDiff(double a, double b): 
+cdef inline double absDiff(double a, double b) noexcept nogil:
     return a-b if a>b else b-a
 
 #for some weird reason libc.math does not have an integer max and min functions (the python ones are slow)
-cdef int int_max(int a, int b):
+cdef inline int int_max(int a, int b) noexcept nogil:
     return a if a>b else b;
-cdef int int_min(int a, int b):
+cdef inline int int_min(int a, int b) noexcept nogil:
     return a if a<b else b;
-    
-def chainCodeLength2Index(double length, np.ndarray[np.float64_t, ndim=1] chain_code_len):
-    '''%CHAINCODELENGTH2INDEX Translate a length into an index. The index
-    %   represents the numerically-closest element to the desired length in
-    %   an ascending array of chain code lengths.
-    %
-    %   INDICES = CHAINCODELENGTH2INDEX(LENGTHS, chain_code_len)
-    %
-    %   Inputs:
-    %       lengths          - the lengths to translate into indices
-    %       chain_code_len - an ascending array of chain code lengths
-    %                          Note: the chain code lengths must increase at
-    %                          every successive index
-    %
-    %   Output:
-    %       indices - the indices for the elements closest to the desired
-    %                 lengths
-    %
-    % See also COMPUTEchain_code_len, CIRCCOMPUTEchain_code_len
-    %
-    %
-    % © Medical Research Council 2012
-    % You will not remove any copyright or other notices from the Software;
-    % you must reproduce all copyright notices and other proprietary
-    % notices on any copies of the Software.
-    '''
-    cdef int last_index_chain = chain_code_len.size-1;
+
+#%% The kernels work on typed memoryviews and do not need the GIL, so the skeletons of
+# different contours can be calculated in parallel threads. The def functions are thin
+# wrappers that keep the original interface and release the GIL while the kernel runs.
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int _chainCodeLength2Index(double length, double[:] chain_code_len) noexcept nogil:
+    cdef int last_index_chain = chain_code_len.shape[0]-1;
     cdef int index;
     cdef double dist_j, dist_next_j;
     cdef int j;
-    
+
     #//% Is the length too small?
     if(length < chain_code_len[0]):
         #//% Find the closest index.
@@ -78,7 +61,7 @@ def chainCodeLength2Index(double length, np.ndarray[np.float64_t, ndim=1] chain_
             #//% Did we jump past the requested length?
             if (j > last_index_chain or length < chain_code_len[j]):
                 j = 0;
-            
+
             #//% find the closest index.
             dist_j = absDiff(length, chain_code_len[j]); #//important use fabs, abs will cast the value to integer
             while (j < last_index_chain):
@@ -88,7 +71,7 @@ def chainCodeLength2Index(double length, np.ndarray[np.float64_t, ndim=1] chain_
                 dist_next_j = absDiff(length, chain_code_len[j + 1]);
                 if (dist_j < dist_next_j):
                     break;
-                
+
                 #//% Advance.
                 dist_j = dist_next_j;
                 j = j + 1;
@@ -96,52 +79,51 @@ def chainCodeLength2Index(double length, np.ndarray[np.float64_t, ndim=1] chain_
             index = j;
     return index;
 
-
-cdef inline int plusCircIndex(int ind, int last_index):
-    return ind + 1 if (ind < last_index) else ind - last_index;
-    
-cdef inline int minusCircIndex(int ind, int last_index):
-    return ind - 1 if (ind > 0) else ind + last_index;
-
-def circOpposingPoints(np.ndarray[np.int_t, ndim=1] points_ind, \
-int start_ind, int end_ind, int vec_last_index, np.ndarray[np.float64_t, ndim=1] chain_code_len):
-    '''%CIRCOPPOSINGPOINTS Find the equivalent point indices on the opposing side
-    %   of a circular vector.
-    %
-    %   points_ind = CIRCOPPOSINGPOINTS(points_ind, start_ind, end_ind, VSIZE)
+def chainCodeLength2Index(double length, double[:] chain_code_len not None):
+    '''%CHAINCODELENGTH2INDEX Translate a length into an index. The index
+    %   represents the numerically-closest element to the desired length in
+    %   an ascending array of chain code lengths.
     %
-    %   points_ind = CIRCOPPOSINGPOINTS(points_ind, start_ind, end_ind, VSIZE,
-    %                                chain_code_len)
+    %   INDICES = CHAINCODELENGTH2INDEX(LENGTHS, chain_code_len)
     %
     %   Inputs:
-    %       points_ind          - the point indices to find on the opposing side
-    %       start_ind           - the index in the vector where the split, between
-    %                          opposing sides, starts
-    %       end_ind             - the index in the vector where the split, between
-    %                          opposing sides, ends
-    %       vec_last_index          - the vector last index
-    %       chain_code_len - the chain-code length at each point;
-    %                          if empty, the array indices are used instead
+    %       lengths          - the lengths to translate into indices
+    %       chain_code_len - an ascending array of chain code lengths
+    %                          Note: the chain code lengths must increase at
+    %                          every successive index
     %
     %   Output:
-    %       points_ind_out - the equivalent point indices on the opposing side
+    %       indices - the indices for the elements closest to the desired
+    %                 lengths
     %
-    % See also CIRCCOMPUTECHAINCODELENGTHS
+    % See also COMPUTEchain_code_len, CIRCCOMPUTEchain_code_len
     %
     %
     % © Medical Research Council 2012
-    % You will not remove any copyright or other notices from the Software; 
-    % you must reproduce all copyright notices and other proprietary 
-    % notices on any copies of the Software.'''
+    % You will not remove any copyright or other notices from the Software;
+    % you must reproduce all copyright notices and other proprietary
+    % notices on any copies of the Software.
+    '''
+    return _chainCodeLength2Index(length, chain_code_len)
 
+
+cdef inline int plusCircIndex(int ind, int last_index) noexcept nogil:
+    return ind + 1 if (ind < last_index) else ind - last_index;
+
+cdef inline int minusCircIndex(int ind, int last_index) noexcept nogil:
+    return ind - 1 if (ind > 0) else ind + last_index;
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _circOpposingPoints(np.int_t[:] points_ind, int start_ind, int end_ind, int vec_last_index,
+    double[:] chain_code_len, np.int_t[:] points_ind_out) noexcept nogil:
     cdef int start_ind1, start_ind2, end_ind1, end_ind2
     cdef float side1_size, side2_size, scale1to2, scale2to1
     cdef int ii, cur_ind
     cdef float delta_dist, point_dist
-    cdef np.ndarray[np.int_t, ndim=1] points_ind_out = points_ind.copy()
-    
-    
-    #% Re-order the start and end to make life simple. 
+
+    #% Re-order the start and end to make life simple.
     cdef int tmp
     if start_ind > end_ind:
         tmp = start_ind;
@@ -152,12 +134,12 @@ int start_ind, int end_ind, int vec_last_index, np.ndarray[np.float64_t, ndim=1]
     #% Note: ignore start and end points, they stay the same.
     #% Side1 always goes from start to end in positive, index increments.
     #% Side2 always goes from start to end in negative, index increments.
-    
+
     #% Compute the size of side 1.
     start_ind1 = start_ind + 1;
     end_ind1 = end_ind - 1;
     side1_size = chain_code_len[end_ind1] - chain_code_len[start_ind1];
-    
+
     #% Compute the size of side 2.
     start_ind2 = minusCircIndex(start_ind, vec_last_index)
     end_ind2 = plusCircIndex(end_ind, vec_last_index)
@@ -166,64 +148,123 @@ int start_ind, int end_ind, int vec_last_index, np.ndarray[np.float64_t, ndim=1]
             chain_code_len[vec_last_index] - chain_code_len[end_ind2];
     else: #% one of the ends wrapped
         side2_size = chain_code_len[start_ind2] - chain_code_len[end_ind2];
-    
+
     #% Compute the scale between sides.
     scale1to2 = side2_size / side1_size;
     scale2to1 = side1_size / side2_size;
-    
-    
+
     for ii in range(points_ind.shape[0]):
         cur_ind = points_ind[ii]
-        
-        
+        points_ind_out[ii] = cur_ind
+
         #% Find the distance of the side 1 points from the start, scale them for
         #% side 2, then find the equivalent point, at the scaled distance
         #% from the start, on side 2.
         if (cur_ind > start_ind) and (cur_ind < end_ind):
             point_dist = chain_code_len[start_ind2] - \
         (chain_code_len[cur_ind] - chain_code_len[start_ind1]) * scale1to2;
-    
+
         #% Find the distance of the side 2 points from the start, scale them for
         #% side 1, then find the equivalent point, at the scaled distance
         #% from the start, on side 1.
         elif (cur_ind < start_ind) or (cur_ind > end_ind):
             delta_dist = chain_code_len[start_ind2] - chain_code_len[cur_ind];
-            if points_ind[ii] > start_ind2:
+            if cur_ind > start_ind2:
                 delta_dist += chain_code_len[vec_last_index];
             point_dist = chain_code_len[start_ind1] + delta_dist * scale2to1;
-        
+
         else:
             continue
-    
+
         #% Correct any wrapped points.
         if point_dist < 0:
             point_dist += chain_code_len[vec_last_index]
         elif point_dist > chain_code_len[vec_last_index]:
             point_dist -= chain_code_len[vec_last_index]
-        
+
         #% Translate the chain-code lengths to indices.
-        points_ind_out[ii] = chainCodeLength2Index(point_dist, chain_code_len);
+        points_ind_out[ii] = _chainCodeLength2Index(point_dist, chain_code_len);
 
-    return points_ind_out
+def circOpposingPoints(np.int_t[:] points_ind not None, \
+int start_ind, int end_ind, int vec_last_index, double[:] chain_code_len not None):
+    '''%CIRCOPPOSINGPOINTS Find the equivalent point indices on the opposing side
+    %   of a circular vector.
+    %
+    %   points_ind = CIRCOPPOSINGPOINTS(points_ind, start_ind, end_ind, VSIZE)
+    %
+    %   points_ind = CIRCOPPOSINGPOINTS(points_ind, start_ind, end_ind, VSIZE,
+    %                                chain_code_len)
+    %
+    %   Inputs:
+    %       points_ind          - the point indices to find on the opposing side
+    %       start_ind           - the index in the vector where the split, between
+    %                          opposing sides, starts
+    %       end_ind             - the index in the vector where the split, between
+    %                          opposing sides, ends
+    %       vec_last_index          - the vector last index
+    %       chain_code_len - the chain-code length at each point;
+    %                          if empty, the array indices are used instead
+    %
+    %   Output:
+    %       points_ind_out - the equivalent point indices on the opposing side
+    %
+    % See also CIRCCOMPUTECHAINCODELENGTHS
+    %
+    %
+    % © Medical Research Council 2012
+    % You will not remove any copyright or other notices from the Software;
+    % you must reproduce all copyright notices and other proprietary
+    % notices on any copies of the Software.'''
+    cdef np.int_t[:] points_ind_out = np.zeros(points_ind.shape[0], dtype = np.int_)
+    with nogil:
+        _circOpposingPoints(points_ind, start_ind, end_ind, vec_last_index, chain_code_len, points_ind_out)
+    return np.asarray(points_ind_out)
 
-cdef tuple min_distance(np.ndarray[np.float_t, ndim=2] x, int curr_ind, int range_min, int range_max):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef double min_distance(double[:, :] x, int curr_ind, int range_min, int range_max, int *near_ind) noexcept nogil:
     cdef double dx, dy, r, min_r
-    cdef int j, near_ind
-    
+    cdef int j
+
     min_r = 2147483647 #max 32 integer. initialization
+    near_ind[0] = 0
     for j in range(range_min, range_max+1):
         dx = x[curr_ind,0] - x[j,0];
         dy = x[curr_ind,1] - x[j,1];
         r = dx*dx + dy*dy
         if r < min_r:
             min_r = r;
-            near_ind = j;
-    return min_r, near_ind
+            near_ind[0] = j;
+    return min_r
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _circNearestPoints(np.int_t[:] points_ind, np.int_t[:] min_ind, np.int_t[:] max_ind,
+    double[:, :] x, np.int_t[:] near_ind) noexcept nogil:
+    cdef int total_points = points_ind.shape[0]
+    cdef int last_index = total_points-1
+    cdef int i, near_ind1, near_ind2
+    cdef float mag1, mag2
+
+    #% Search for the nearest points.
+    for i in range(total_points):
+        #% The interval is continuous.
+        if min_ind[i] <= max_ind[i]:
+            min_distance(x, points_ind[i], min_ind[i], max_ind[i], &near_ind1)
+            near_ind[i] = near_ind1
+
+        #% The interval wraps.
+        else:
+            mag1 = min_distance(x, points_ind[i], min_ind[i], last_index, &near_ind1)
+            mag2 = min_distance(x, points_ind[i], 0, max_ind[i], &near_ind2)
+
+            #% Which point is nearest?
+            near_ind[i] = near_ind1 if mag1 <= mag2 else near_ind2;
 
-def circNearestPoints(np.ndarray[np.int_t, ndim=1] points_ind, \
-                            np.ndarray[np.int_t, ndim=1] min_ind, \
-                            np.ndarray[np.int_t, ndim=1] max_ind, \
-                            np.ndarray[np.float64_t, ndim=2] x):
+def circNearestPoints(np.int_t[:] points_ind not None, \
+                            np.int_t[:] min_ind not None, \
+                            np.int_t[:] max_ind not None, \
+                            double[:, :] x not None):
     '''%CIRCNEARESTPOINTS For each point, find the nearest corresponding point
     %   within an interval of circularly-connected search points.
     %
@@ -241,37 +282,21 @@ def circNearestPoints(np.ndarray[np.int_t, ndim=1] points_ind, \
     %
     %
     % © Medical Research Council 2012
-    % You will not remove any copyright or other notices from the Software; 
-    % you must reproduce all copyright notices and other proprietary 
+    % You will not remove any copyright or other notices from the Software;
+    % you must reproduce all copyright notices and other proprietary
     % notices on any copies of the Software.
     '''
-    assert len(points_ind) == len(min_ind) == len(max_ind)
-    cdef int total_points = points_ind.shape[0]
-    cdef int last_index = total_points-1
+    assert points_ind.shape[0] == min_ind.shape[0] == max_ind.shape[0]
     #% Pre-allocate memory.
-    cdef np.ndarray[np.int_t, ndim=1] near_ind = np.zeros(total_points, dtype=np.int);
-    cdef int i, near_ind1, near_ind2
-    cdef float mag1, mag2
-    
-    #% Search for the nearest points.
-    for i in range(total_points): 
-        #% The interval is continuous.
-        if min_ind[i] <= max_ind[i]:
-            mag1, near_ind1 = min_distance(x, points_ind[i], min_ind[i], max_ind[i])
-            near_ind[i] = near_ind1
-        
-        #% The interval wraps.
-        else:
-            mag1, near_ind1 = min_distance(x, points_ind[i], min_ind[i], last_index)
-            mag2, near_ind2 = min_distance(x, points_ind[i], 0, max_ind[i])
-            
-            #% Which point is nearest?
-            near_ind[i] = near_ind1 if mag1 <= mag2 else near_ind2;
-            
-    return near_ind
+    cdef np.int_t[:] near_ind = np.zeros(points_ind.shape[0], dtype=np.int_);
+    with nogil:
+        _circNearestPoints(points_ind, min_ind, max_ind, x, near_ind)
+    return np.asarray(near_ind)
 
-cdef int wrapOppositeRegion(np.ndarray[np.float64_t, ndim=1] lenghts, \
-double cur_len, int start_ind, int end_ind, int last_index, bint isMax, bint isSide1, bint isWrap):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int wrapOppositeRegion(double[:] lenghts, \
+double cur_len, int start_ind, int end_ind, int last_index, bint isMax, bint isSide1, bint isWrap) noexcept nogil:
     if isSide1:
         if (cur_len < lenghts[start_ind]):
             return start_ind;
@@ -284,70 +309,42 @@ double cur_len, int start_ind, int end_ind, int last_index, bint isMax, bint isS
         else:
             if (cur_len > lenghts[start_ind]) and (cur_len < lenghts[end_ind]):
                 return start_ind if isMax else end_ind;
-    
+
     if cur_len < lenghts[0]:
         cur_len += lenghts[last_index];
-        
+
     elif cur_len > lenghts[last_index]:
         cur_len -= lenghts[last_index];
-    
-    return chainCodeLength2Index(cur_len, lenghts);
 
-def circOpposingNearestPoints(np.ndarray[np.int_t, ndim=1] points_ind, np.ndarray[np.float64_t, ndim=2] x, \
-int start_ind, int end_ind, double search_len, np.ndarray[np.float64_t, ndim=1] chain_code_len):
-    '''%CIRCOPPOSINGNEARESTPOINTS Find the nearest equivalent point indices on the
-    %   opposing side (within a search window) of a circular vector.
-    %
-    %   points_ind = CIRCOPPOSINGNEARESTPOINTS(points_ind, X, start_ind, end_ind,
-    %                                       search_len)
-    %
-    %   points_ind = CIRCOPPOSINGNERAESTPOINTS(points_ind, X, start_ind, end_ind,
-    %                                       search_len, chain_code_len)
-    %
-    %   Inputs:
-    %       points_ind          - the point indices to find on the opposing side
-    %       x                - the circularly connected vector on which the
-    %                          points lie
-    %       start_ind           - the index in the vector where the split, between
-    %                          opposing sides, starts
-    %       end_ind             - the index in the vector where the split, between
-    %                          opposing sides, ends
-    %       search_len     - the search length, on either side of a directly
-    %                          opposing point, to search for the nearest point
-    %       chain_code_len - the chain-code length at each point;
-    %                          if empty, the array indices are used instead
-    %
-    %   Output:
-    %       points_ind - the equivalent point indices on the opposing side
-    %
-    % See also CIRCOPPOSINGPOINTS, CIRCNEARESTPOINTS, CIRCCOMPUTEchain_code_len
-    %
-    %
-    % © Medical Research Council 2012
-    % You will not remove any copyright or other notices from the Software; 
-    % you must reproduce all copyright notices and other proprietary 
-    % notices on any copies of the Software.
-    '''
-    
-    
+    return _chainCodeLength2Index(cur_len, lenghts);
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _circOpposingNearestPoints(np.int_t[:] points_ind, double[:, :] x, \
+int start_ind, int end_ind, double search_len, double[:] chain_code_len, \
+np.int_t[:] points_ind_out, np.int_t[:, :] buff) noexcept nogil:
+    #buff is a work array with (at least) 4 rows and points_ind.shape[0] columns.
+    #It returns -1 if the points are degenerate.
     cdef int x_last_index = x.shape[0]-1
-    cdef int last_chain_index = chain_code_len.size-1
+    cdef int last_chain_index = chain_code_len.shape[0]-1
+    cdef int n_points = points_ind.shape[0]
     cdef int start1, start2, end1, end2
-    cdef int ii, cur_ind
+    cdef int ii, cur_ind, n_side12
     cdef double min_opposite, max_opposite
-    cdef np.ndarray[np.int_t, ndim=1] opposite_ind
-    cdef np.ndarray[np.int_t, ndim=1] points_ind_out = points_ind.copy()
-    
+    cdef np.int_t[:] opposite_ind = buff[0, :n_points]
+    cdef np.int_t[:] side12_ind = buff[1, :n_points]
+    cdef np.int_t[:] minOpoints_ind = buff[2, :n_points]
+    cdef np.int_t[:] maxOpoints_ind = buff[3, :n_points]
+
     #flags (just to make it easier to read)
     cdef bint SIDE1 = 1;
     cdef bint SIDE2 = 0;
     cdef bint ISMAX = 1;
     cdef bint ISMIN = 0;
-    
+
     cdef bint is2Wrap
-    
-    
-    #% Re-order the start and end to make life simple. 
+
+    #% Re-order the start and end to make life simple.
     cdef int tmp
     if start_ind > end_ind:
         tmp = start_ind;
@@ -356,12 +353,12 @@ int start_ind, int end_ind, double search_len, np.ndarray[np.float64_t, ndim=1]
 
     #% The points are degenerate.
     if ((end_ind - start_ind) < 2) or ((start_ind + x_last_index - end_ind) < 2):
-        return  np.zeros([], dtype=x.dtype);
+        return -1
 
     #% Separate the points onto sides.
     #% Note: ignore start and end points, they stay the same.
     #% Side1 always goes from start to end in positive, index increments.
-    
+
     #% Compute the start indices.
     #% Note: we checked for degeneracy; therefore, only one index can wrap.
     is2Wrap = 0;
@@ -370,7 +367,7 @@ int start_ind, int end_ind, double search_len, np.ndarray[np.float64_t, ndim=1]
     if start2 < 0:
         start2 = start2 + x_last_index;
         is2Wrap = 1;
-    
+
     #% Compute the end indices.
     end1 = end_ind - 1;
     end2 = end_ind + 1;
@@ -379,180 +376,260 @@ int start_ind, int end_ind, double search_len, np.ndarray[np.float64_t, ndim=1]
         is2Wrap = 1;
 
     #% Compute the opposing points.
-    opposite_ind = circOpposingPoints(points_ind_out, start_ind, end_ind, x_last_index, chain_code_len);
-    
+    _circOpposingPoints(points_ind, start_ind, end_ind, x_last_index, chain_code_len, opposite_ind);
+
     #% Side2 always goes from start to end in negative, index increments.
-    side12 = (opposite_ind != start_ind) & (opposite_ind != end_ind);
-    opposite_ind = opposite_ind[side12];
-    cdef np.ndarray[np.int_t, ndim=1] minOpoints_ind = np.zeros_like(opposite_ind)
-    cdef np.ndarray[np.int_t, ndim=1] maxOpoints_ind = np.zeros_like(opposite_ind)
-    
-    
     #% Compute the minimum search points on side 2 (for the search intervals
     #% opposite side 1).
-    for ii in range(opposite_ind.size):
+    n_side12 = 0
+    for ii in range(n_points):
         cur_ind = opposite_ind[ii]
+        if (cur_ind == start_ind) or (cur_ind == end_ind):
+            continue
+
+        side12_ind[n_side12] = points_ind[ii]
         min_opposite = chain_code_len[cur_ind] - search_len;
         max_opposite = chain_code_len[cur_ind] + search_len;
-        
+
         #side1
         if (cur_ind > start_ind) and (cur_ind < end_ind):
-            minOpoints_ind[ii] = wrapOppositeRegion(chain_code_len, min_opposite, start1, end1, last_chain_index, ISMIN, SIDE1, is2Wrap)
-            maxOpoints_ind[ii] = wrapOppositeRegion(chain_code_len, max_opposite, start1, end1, last_chain_index, ISMAX, SIDE1, is2Wrap)
-        elif (cur_ind < start_ind) or (cur_ind > end_ind):
-            minOpoints_ind[ii] = wrapOppositeRegion(chain_code_len, min_opposite, start2, end2, last_chain_index, ISMIN, SIDE2, is2Wrap)
-            maxOpoints_ind[ii] = wrapOppositeRegion(chain_code_len, max_opposite, start2, end2, last_chain_index, ISMAX, SIDE2, is2Wrap)
-    
-    #% Search for the nearest points.
-    points_ind_out[side12] = circNearestPoints(points_ind[side12], minOpoints_ind, maxOpoints_ind, x);
-    return points_ind_out
+            minOpoints_ind[n_side12] = wrapOppositeRegion(chain_code_len, min_opposite, start1, end1, last_chain_index, ISMIN, SIDE1, is2Wrap)
+            maxOpoints_ind[n_side12] = wrapOppositeRegion(chain_code_len, max_opposite, start1, end1, last_chain_index, ISMAX, SIDE1, is2Wrap)
+        else:
+            minOpoints_ind[n_side12] = wrapOppositeRegion(chain_code_len, min_opposite, start2, end2, last_chain_index, ISMIN, SIDE2, is2Wrap)
+            maxOpoints_ind[n_side12] = wrapOppositeRegion(chain_code_len, max_opposite, start2, end2, last_chain_index, ISMAX, SIDE2, is2Wrap)
+        n_side12 += 1
+
+    #% Search for the nearest points (the results are saved in the place of the minimum indices).
+    _circNearestPoints(side12_ind[:n_side12], minOpoints_ind[:n_side12], maxOpoints_ind[:n_side12], x, minOpoints_ind[:n_side12]);
+
+    n_side12 = 0
+    for ii in range(n_points):
+        cur_ind = opposite_ind[ii]
+        if (cur_ind == start_ind) or (cur_ind == end_ind):
+            points_ind_out[ii] = points_ind[ii]
+        else:
+            points_ind_out[ii] = minOpoints_ind[n_side12]
+            n_side12 += 1
+    return 0
+
+def circOpposingNearestPoints(np.int_t[:] points_ind not None, double[:, :] x not None, \
+int start_ind, int end_ind, double search_len, double[:] chain_code_len not None):
+    '''%CIRCOPPOSINGNEARESTPOINTS Find the nearest equivalent point indices on the
+    %   opposing side (within a search window) of a circular vector.
+    %
+    %   points_ind = CIRCOPPOSINGNEARESTPOINTS(points_ind, X, start_ind, end_ind,
+    %                                       search_len)
+    %
+    %   points_ind = CIRCOPPOSINGNERAESTPOINTS(points_ind, X, start_ind, end_ind,
+    %                                       search_len, chain_code_len)
+    %
+    %   Inputs:
+    %       points_ind          - the point indices to find on the opposing side
+    %       x                - the circularly connected vector on which the
+    %                          points lie
+    %       start_ind           - the index in the vector where the split, between
+    %                          opposing sides, starts
+    %       end_ind             - the index in the vector where the split, between
+    %                          opposing sides, ends
+    %       search_len     - the search length, on either side of a directly
+    %                          opposing point, to search for the nearest point
+    %       chain_code_len - the chain-code length at each point;
+    %                          if empty, the array indices are used instead
+    %
+    %   Output:
+    %       points_ind - the equivalent point indices on the opposing side
+    %
+    % See also CIRCOPPOSINGPOINTS, CIRCNEARESTPOINTS, CIRCCOMPUTEchain_code_len
+    %
+    %
+    % © Medical Research Council 2012
+    % You will not remove any copyright or other notices from the Software;
+    % you must reproduce all copyright notices and other proprietary
+    % notices on any copies of the Software.
+    '''
+    cdef int n_points = points_ind.shape[0]
+    cdef int ret
+    cdef np.int_t[:] points_ind_out = np.zeros(n_points, dtype = np.int_)
+    cdef np.int_t[:, :] buff = np.zeros((4, n_points), dtype = np.int_)
+    with nogil:
+        ret = _circOpposingNearestPoints(points_ind, x, start_ind, end_ind, search_len, chain_code_len, points_ind_out, buff)
+
+    #% The points are degenerate.
+    if ret < 0:
+        return  np.zeros([], dtype=np.float64);
+    return np.asarray(points_ind_out)
 
 
-cdef double circAddition(double A,double B, double max_size):
-    C = A+B;
+cdef inline double circAddition(double A,double B, double max_size) noexcept nogil:
+    cdef double C = A+B;
     if C > max_size:
         C -= max_size;
     return C
 
-cdef double circSubtraction(double A, double B, double min_size, double max_size):
-    C = A-B;
+cdef inline double circSubtraction(double A, double B, double min_size, double max_size) noexcept nogil:
+    cdef double C = A-B;
     if C < min_size:
         C += max_size;
     return C
 
-def getHeadTailRegion(int head_ind, int tail_ind, np.ndarray[np.float64_t, ndim=1] chain_code_len, double worm_seg_length):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _getHeadTailRegion(int head_ind, int tail_ind, double[:] chain_code_len, double worm_seg_length,
+    int *head_tail_region) noexcept nogil:
+    #the region is returned as (head_start, head_end, tail_start, tail_end)
     cdef double head_tail_seg = worm_seg_length * 4;
-    cdef int head_start, head_end, tail_start, tail_end
     cdef double tmp
-    
-    cdef double last_chain_len = chain_code_len[chain_code_len.size-1]
+
+    cdef double last_chain_len = chain_code_len[chain_code_len.shape[0]-1]
     cdef double first_chain_len = chain_code_len[0]
-    
+
     #% Find small head boundaries.
     tmp = circSubtraction(chain_code_len[head_ind], head_tail_seg, first_chain_len, last_chain_len);
-    head_start = chainCodeLength2Index(tmp, chain_code_len);
-    
+    head_tail_region[0] = _chainCodeLength2Index(tmp, chain_code_len);
+
     tmp = circAddition(chain_code_len[head_ind], head_tail_seg, last_chain_len);
-    head_end = chainCodeLength2Index(tmp, chain_code_len);
-    
+    head_tail_region[1] = _chainCodeLength2Index(tmp, chain_code_len);
+
     #% Find small tail boundaries.
     tmp = circSubtraction(chain_code_len[tail_ind], head_tail_seg, first_chain_len, last_chain_len);
-    tail_start = chainCodeLength2Index(tmp, chain_code_len);
-    
+    head_tail_region[2] = _chainCodeLength2Index(tmp, chain_code_len);
+
     tmp = circAddition(chain_code_len[tail_ind], head_tail_seg, last_chain_len);
-    tail_end = chainCodeLength2Index(tmp, chain_code_len);
-    
-    return head_start, head_end, tail_start, tail_end
+    head_tail_region[3] = _chainCodeLength2Index(tmp, chain_code_len);
 
-def getInterBendSeeds(np.ndarray[np.int_t, ndim=1] bend_side1, np.ndarray[np.int_t, ndim=1] bend_side2, \
-np.ndarray[np.float64_t, ndim=2] contour, np.ndarray[np.float64_t, ndim=1] chain_code_len): 
-    cdef int total_interbends = bend_side1.size-1
-    #% Compute the inter-bend indices.
-    cdef np.ndarray[np.int_t, ndim=1] interbend_side1 = np.zeros((total_interbends), dtype = np.int)
-    cdef np.ndarray[np.int_t, ndim=1] interbend_side2 = np.zeros((total_interbends), dtype = np.int)
+def getHeadTailRegion(int head_ind, int tail_ind, double[:] chain_code_len not None, double worm_seg_length):
+    cdef int head_tail_region[4]
+    with nogil:
+        _getHeadTailRegion(head_ind, tail_ind, chain_code_len, worm_seg_length, head_tail_region)
+    return head_tail_region[0], head_tail_region[1], head_tail_region[2], head_tail_region[3]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _getInterBendSeeds(np.int_t[:] bend_side1, np.int_t[:] bend_side2, \
+double[:, :] contour, double[:] chain_code_len, np.int_t[:] interbend_side1, np.int_t[:] interbend_side2) noexcept nogil:
+    #It returns -1 if the number of bends in each side does not match.
+    cdef int total_interbends = bend_side1.shape[0]-1
     cdef int i
+    if total_interbends < 0 or bend_side2.shape[0] != bend_side1.shape[0]:
+        return -1
+    #% Compute the inter-bend indices.
     for i in range(total_interbends):
-        interbend_side1[i] = chainCodeLength2Index((chain_code_len[bend_side1[i]] + \
+        interbend_side1[i] = _chainCodeLength2Index((chain_code_len[bend_side1[i]] + \
         chain_code_len[bend_side1[i+1]]) / 2., chain_code_len);
-    interbend_side2 = circNearestPoints(interbend_side1, bend_side2[1:], bend_side2[:total_interbends], contour);
-    return interbend_side1, interbend_side2
-    
-cdef double getDistance(double x1, double x2, double y1, double y2):
+    _circNearestPoints(interbend_side1[:total_interbends], bend_side2[1:], bend_side2[:total_interbends], \
+        contour, interbend_side2[:total_interbends]);
+    return 0
+
+def getInterBendSeeds(np.int_t[:] bend_side1 not None, np.int_t[:] bend_side2 not None, \
+double[:, :] contour not None, double[:] chain_code_len not None):
+    cdef int total_interbends = bend_side1.shape[0]-1
+    cdef int ret
+    cdef np.int_t[:] interbend_side1 = np.zeros((total_interbends), dtype = np.int_)
+    cdef np.int_t[:] interbend_side2 = np.zeros((total_interbends), dtype = np.int_)
+    with nogil:
+        ret = _getInterBendSeeds(bend_side1, bend_side2, contour, chain_code_len, interbend_side1, interbend_side2)
+    assert ret == 0
+    return np.asarray(interbend_side1), np.asarray(interbend_side2)
+
+cdef inline double getDistance(double x1, double x2, double y1, double y2) noexcept nogil:
     cdef double d1, d2
     d1 = x1-x2;
     d2 = y1-y2;
     return sqrt(d1*d1 + d2*d2)
-    
-cdef tuple getWrappedIndex(int start_side, int end_side, double inc_side, int cnt_size):
+
+@cython.cdivision(True)
+cdef void getWrappedIndex(int start_side, int end_side, double inc_side, int cnt_size, \
+double *size_side, int *wrap_start, int *wrap_end) noexcept nogil:
+    wrap_start[0] = -1
+    wrap_end[0] = -1
     if (start_side <= end_side):
         #//% We are going forward.
         if (inc_side > 0):
-            return ((end_side - start_side + 1) / inc_side, -1, -1)
+            size_side[0] = (end_side - start_side + 1) / inc_side
         #//% We are wrapping backward.
         else:
-            return ((start_side + cnt_size - end_side + 1) / (-1*inc_side), cnt_size-1, 0)
+            size_side[0] = (start_side + cnt_size - end_side + 1) / (-1*inc_side)
+            wrap_start[0] = cnt_size-1
+            wrap_end[0] = 0
     #//% The first starting index is after the ending one.
     else:
         #//% We are going backward.
         if (inc_side < 0):
-            return ((start_side - end_side + 1) / (-1*inc_side), -1, -1)
+            size_side[0] = (start_side - end_side + 1) / (-1*inc_side)
         #//% We are wrapping forward.
         else:
-            return ((cnt_size - start_side + 1 + end_side) / inc_side, 0, cnt_size-1)
-    
-def skeletonize(int start_side1, int end_side1, int inc_side1, \
-int start_side2, int end_side2, int inc_side2, \
-np.ndarray[np.float_t, ndim=2] cnt_side1, np.ndarray[np.float_t, ndim=2] cnt_side2):
-    '''%SKELETONIZE Skeletonize takes the 2 pairs of start and end points on a
-    %contour(s), then traces the skeleton between them using the specified
-    %increments.
-    %
-    %   [SKELETON] = SKELETONIZE(start_side1, end_side1, inc_side1, start_side2, end_side2, inc_side2, cnt_side1, cnt_side2)
-    %
-    %   Inputs:
-    %       start_side1       - The starting index for the first contour segment.
-    %       end_side1       - The ending index for the first contour segment.
-    %       inc_side1       - The increment to walk along the first contour segment.
-    %                  Note: a negative increment means walk backwards.
-    %                  Contours are circular, hitting an edge wraps around.
-    %       start_side2       - The starting index for the second contour segment.
-    %       end_side2       - The ending index for the second contour segment.
-    %       inc_side2       - The increment to walk along the second contour segment.
-    %                  Note: a negative increment means walk backwards.
-    %                  Contours are circular, hitting an edge wraps around.
-    %       cnt_side1       - The contour for the first segment.
-    %       cnt_side2       - The contour for the second segment.
-    %
-    %   Output:
-    %       skeleton - the skeleton traced between the 2 sets of contour points.
-    %       cnt_widths  - the widths between the 2 sets of contour points.
-    %                  Note: there are no widths when cutting across.
-    %
-    %
-    % © Medical Research Council 2012
-    % You will not remove any copyright or other notices from the Software;
-    % you must reproduce all copyright notices and other proprietary
-    % notices on any copies of the Software.'''
+            size_side[0] = (cnt_size - start_side + 1 + end_side) / inc_side
+            wrap_start[0] = 0
+            wrap_end[0] = cnt_size-1
 
+cdef inline int _pyIndex(int ind, int size) noexcept nogil:
+    #index with the python rules (negative indexes wrap), -1 if it is out of bounds
+    if ind < 0:
+        ind += size
+    return ind if (ind >= 0 and ind < size) else -1
+
+cdef int _skeletonizeSize(int start_side1, int end_side1, int inc_side1, \
+int start_side2, int end_side2, int inc_side2, int cnt1_size, int cnt2_size) noexcept nogil:
+    #number of points preallocated by skeletonize
+    cdef int wrap_end, wrap_start
+    cdef double size1, size2
+    getWrappedIndex(start_side1, end_side1, inc_side1, cnt1_size, &size1, &wrap_start, &wrap_end)
+    getWrappedIndex(start_side2, end_side2, inc_side2, cnt2_size, &size2, &wrap_start, &wrap_end)
+    return 2*<int>floor(size1 + size2)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _skeletonize(int start_side1, int end_side1, int inc_side1, \
+int start_side2, int end_side2, int inc_side2, \
+double[:, :] cnt_side1, double[:, :] cnt_side2, double[:, :] skeleton, double[:] cnt_widths) noexcept nogil:
+    #The skeleton and widths are written in the first rows of skeleton and cnt_widths,
+    #and the number of points is returned. It returns -1 if an index is out of bounds.
     cdef int cnt1_size = cnt_side1.shape[0]
     cdef int cnt2_size = cnt_side1.shape[1]
-    
+    cdef int n1 = cnt_side1.shape[0]
+    cdef int n2 = cnt_side2.shape[0]
+
     cdef int wrap_end1, wrap_start1, wrap_end2, wrap_start2;
     cdef double size1, size2;
-    
+
     #//% The first starting index is before the ending one.
-    size1, wrap_start1, wrap_end1 = getWrappedIndex(start_side1, end_side1, inc_side1, cnt1_size)
-    
+    getWrappedIndex(start_side1, end_side1, inc_side1, cnt1_size, &size1, &wrap_start1, &wrap_end1)
+
     #//% The second starting index is before the ending one.
-    size2, wrap_start2, wrap_end2 = getWrappedIndex(start_side2, end_side2, inc_side2, cnt2_size)
-    
+    getWrappedIndex(start_side2, end_side2, inc_side2, cnt2_size, &size2, &wrap_start2, &wrap_end2)
+
     #//% Trace the midline between the contour segments.
     #//% Note: the next few pages of code represent multiple, nearly identical
     #//% algorithms. The reason they are inlined as separate instances is to
     #//% mildly speed up one of the tightest loops in our program.
-    
-    #// % pre-allocate memory
-    cdef int number_points = 2*int(floor(size1 + size2)); #preallocate memory
-    cdef np.ndarray[np.float_t, ndim=2] skeleton = np.zeros((number_points,2))
-    cdef np.ndarray[np.float_t, ndim=1] cnt_widths = np.zeros((number_points))
-    
+
+    #// % memory preallocated by the caller
+    cdef int number_points = 2*<int>floor(size1 + size2);
+    if number_points > skeleton.shape[0] or number_points > cnt_widths.shape[0]:
+        return -1
+
     cdef int j1 = start_side1;
     cdef int j2 = start_side2;
     cdef int next_j1, next_j2;
+    cdef int i1, i2, i_next1, i_next2, i2_side1, i_next2_side1;
     cdef double d1, d2, d12, dnj12_0, dnj12_1, prev_width;
-    
-    
+
     if (j1 == wrap_end1): #//% wrap
         j1 = wrap_start1;
-    
+
     if (j2 == wrap_end2): #//% wrap
         j2 = wrap_start2;
-    
+
     #//% Initialize the skeleton and contour widths.
-    skeleton[0,0] = c_round((cnt_side1[j1,0] + cnt_side2[j2,0])/ 2);
-    skeleton[0,1] = c_round((cnt_side1[j1,1] + cnt_side2[j2,1])/ 2);
-    cnt_widths[0] = getDistance(cnt_side1[j1,0], cnt_side2[j2,0], cnt_side1[j1,1], cnt_side2[j2,1]);
-    
+    i1 = _pyIndex(j1, n1)
+    i2 = _pyIndex(j2, n2)
+    if i1 < 0 or i2 < 0 or number_points < 1:
+        return -1
+    skeleton[0,0] = c_round((cnt_side1[i1,0] + cnt_side2[i2,0])/ 2);
+    skeleton[0,1] = c_round((cnt_side1[i1,1] + cnt_side2[i2,1])/ 2);
+    cnt_widths[0] = getDistance(cnt_side1[i1,0], cnt_side2[i2,0], cnt_side1[i1,1], cnt_side2[i2,1]);
+
     cdef int ske_ind = 1;
     #//% Skeletonize the contour segments and measure the width.
     while ((j1 != end_side1) and (j2 != end_side2)):
@@ -560,18 +637,28 @@ np.ndarray[np.float_t, ndim=2] cnt_side1, np.ndarray[np.float_t, ndim=2] cnt_sid
         next_j1 = j1 + inc_side1;
         if (next_j1 == wrap_end1): #//% wrap
             next_j1 = wrap_start1;
-        
+
         next_j2 = j2 + inc_side2;
         if (next_j2 == wrap_end2): #//% wrap
             next_j2 = wrap_start2;
-        
-        d1 = getDistance(cnt_side1[next_j1,0], cnt_side2[j2,0], cnt_side1[next_j1,1], cnt_side2[j2,1])
-        d2 = getDistance(cnt_side1[j1,0], cnt_side2[next_j2,0], cnt_side1[j1,1], cnt_side2[next_j2,1])
-        d12 = getDistance(cnt_side1[next_j1,0], cnt_side2[next_j2,0], cnt_side1[next_j1,1], cnt_side2[next_j2,1])
-        
-        dnj12_0 = (cnt_side1[next_j1,0]-cnt_side1[j1,0])*(cnt_side1[next_j2,0]-cnt_side1[j2,0]);
-        dnj12_1 = (cnt_side1[next_j1,1]-cnt_side1[j1,1])*(cnt_side1[next_j2,1]-cnt_side1[j2,1]);
-        
+
+        i1 = _pyIndex(j1, n1)
+        i2 = _pyIndex(j2, n2)
+        i_next1 = _pyIndex(next_j1, n1)
+        i_next2 = _pyIndex(next_j2, n2)
+        i2_side1 = _pyIndex(j2, n1)
+        i_next2_side1 = _pyIndex(next_j2, n1)
+        if i1 < 0 or i2 < 0 or i_next1 < 0 or i_next2 < 0 or i2_side1 < 0 or i_next2_side1 < 0 \
+        or ske_ind >= number_points:
+            return -1
+
+        d1 = getDistance(cnt_side1[i_next1,0], cnt_side2[i2,0], cnt_side1[i_next1,1], cnt_side2[i2,1])
+        d2 = getDistance(cnt_side1[i1,0], cnt_side2[i_next2,0], cnt_side1[i1,1], cnt_side2[i_next2,1])
+        d12 = getDistance(cnt_side1[i_next1,0], cnt_side2[i_next2,0], cnt_side1[i_next1,1], cnt_side2[i_next2,1])
+
+        dnj12_0 = (cnt_side1[i_next1,0]-cnt_side1[i1,0])*(cnt_side1[i_next2_side1,0]-cnt_side1[i2_side1,0]);
+        dnj12_1 = (cnt_side1[i_next1,1]-cnt_side1[i1,1])*(cnt_side1[i_next2_side1,1]-cnt_side1[i2_side1,1]);
+
         #//% Advance along both contours.
         if ((d12 <= d1 and d12 <= d2) or d1 == d2):
             j1 = next_j1;
@@ -588,7 +675,7 @@ np.ndarray[np.float_t, ndim=2] cnt_side1, np.ndarray[np.float_t, ndim=2] cnt_sid
                 else:
                     j2 = next_j2;
                     cnt_widths[ske_ind] = d2;
-            
+
             #//% The contours go in opposite directions.
             #//% Follow decreasing widths or walk along both contours.
             #//% In other words, catch up both contours, then walk along both.
@@ -611,25 +698,469 @@ np.ndarray[np.float_t, ndim=2] cnt_side1, np.ndarray[np.float_t, ndim=2] cnt_sid
                         cnt_widths[ske_ind] = d2;
 
         #//% Compute the skeleton.
-        skeleton[ske_ind, 0] = c_round((cnt_side1[j1, 0] + cnt_side2[j2, 0]) / 2);
-        skeleton[ske_ind, 1] = c_round((cnt_side1[j1, 1] + cnt_side2[j2, 1]) / 2);
+        i1 = _pyIndex(j1, n1)
+        i2 = _pyIndex(j2, n2)
+        skeleton[ske_ind, 0] = c_round((cnt_side1[i1, 0] + cnt_side2[i2, 0]) / 2);
+        skeleton[ske_ind, 1] = c_round((cnt_side1[i1, 1] + cnt_side2[i2, 1]) / 2);
         ske_ind +=1;
-            
+
     #//% Add the last point.
     if (j1 != end_side1) or (j2 != end_side2):
-        skeleton[ske_ind, 0] = c_round((cnt_side1[end_side1, 0] + cnt_side2[end_side2, 0]) / 2);
-        skeleton[ske_ind, 1] = c_round((cnt_side1[end_side1, 1] + cnt_side2[end_side2, 1]) / 2);
-        cnt_widths[ske_ind] = getDistance(cnt_side1[end_side1,0], cnt_side2[end_side2,0], cnt_side1[end_side1,1], cnt_side2[end_side2,1])
+        i1 = _pyIndex(end_side1, n1)
+        i2 = _pyIndex(end_side2, n2)
+        if i1 < 0 or i2 < 0 or ske_ind >= number_points:
+            return -1
+        skeleton[ske_ind, 0] = c_round((cnt_side1[i1, 0] + cnt_side2[i2, 0]) / 2);
+        skeleton[ske_ind, 1] = c_round((cnt_side1[i1, 1] + cnt_side2[i2, 1]) / 2);
+        cnt_widths[ske_ind] = getDistance(cnt_side1[i1,0], cnt_side2[i2,0], cnt_side1[i1,1], cnt_side2[i2,1])
         ske_ind +=1;
-    
-    skeleton = skeleton[:ske_ind,:];
-    cnt_widths = cnt_widths[:ske_ind]
-    
-    return (skeleton, cnt_widths)
 
+    return ske_ind
+
+def skeletonize(int start_side1, int end_side1, int inc_side1, \
+int start_side2, int end_side2, int inc_side2, \
+double[:, :] cnt_side1 not None, double[:, :] cnt_side2 not None):
+    '''%SKELETONIZE Skeletonize takes the 2 pairs of start and end points on a
+    %contour(s), then traces the skeleton between them using the specified
+    %increments.
+    %
+    %   [SKELETON] = SKELETONIZE(start_side1, end_side1, inc_side1, start_side2, end_side2, inc_side2, cnt_side1, cnt_side2)
+    %
+    %   Inputs:
+    %       start_side1       - The starting index for the first contour segment.
+    %       end_side1       - The ending index for the first contour segment.
+    %       inc_side1       - The increment to walk along the first contour segment.
+    %                  Note: a negative increment means walk backwards.
+    %                  Contours are circular, hitting an edge wraps around.
+    %       start_side2       - The starting index for the second contour segment.
+    %       end_side2       - The ending index for the second contour segment.
+    %       inc_side2       - The increment to walk along the second contour segment.
+    %                  Note: a negative increment means walk backwards.
+    %                  Contours are circular, hitting an edge wraps around.
+    %       cnt_side1       - The contour for the first segment.
+    %       cnt_side2       - The contour for the second segment.
+    %
+    %   Output:
+    %       skeleton - the skeleton traced between the 2 sets of contour points.
+    %       cnt_widths  - the widths between the 2 sets of contour points.
+    %                  Note: there are no widths when cutting across.
+    %
+    %
+    % © Medical Research Council 2012
+    % You will not remove any copyright or other notices from the Software;
+    % you must reproduce all copyright notices and other proprietary
+    % notices on any copies of the Software.'''
+
+    #// % pre-allocate memory
+    cdef int number_points = _skeletonizeSize(start_side1, end_side1, inc_side1,
+        start_side2, end_side2, inc_side2, cnt_side1.shape[0], cnt_side1.shape[1])
+    cdef double[:, ::1] skeleton = np.zeros((number_points,2))
+    cdef double[::1] cnt_widths = np.zeros((number_points))
+    cdef int ske_ind
+    with nogil:
+        ske_ind = _skeletonize(start_side1, end_side1, inc_side1, start_side2, end_side2, inc_side2,
+                               cnt_side1, cnt_side2, skeleton, cnt_widths)
+    if ske_ind < 0:
+        raise IndexError('Skeleton index out of bounds.')
+
+    return (np.asarray(skeleton)[:ske_ind,:], np.asarray(cnt_widths)[:ske_ind])
+
+
+#%% Compiled version of linearSkeleton.linearSkeleton. It gives the same results,
+# but the whole calculation can be done without the GIL.
+
+cdef inline bint _betweenPoints(int point_ind, int startI, int endI) noexcept nogil:
+    #% Find points_ind between startI and endI, inclusive.
+    if startI < endI:
+        return (point_ind >= startI) and (point_ind <= endI)
+    else:
+        return (point_ind >= startI) or (point_ind <= endI)  # wrap around
+
+cdef inline bint _maxDistPoints(int point_ind, int oposite_ind, int maxDistI, int cnt_size) noexcept nogil:
+    #% Find points_ind whose index distance from oposite_ind exceeds maxDistI.
+    if point_ind > oposite_ind:
+        return maxDistI <= int_min(point_ind - oposite_ind, oposite_ind + cnt_size - point_ind)
+    else:
+        return maxDistI <= int_min(oposite_ind - point_ind, point_ind + cnt_size - oposite_ind)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _sortIndexes(np.int_t[:] x, bint descending) noexcept nogil:
+    #insertion sort, there are only a few bends in a contour
+    cdef Py_ssize_t i, j
+    cdef np.int_t val
+    for i in range(1, x.shape[0]):
+        val = x[i]
+        j = i - 1
+        while j >= 0 and ((x[j] < val) if descending else (x[j] > val)):
+            x[j + 1] = x[j]
+            j -= 1
+        x[j + 1] = val
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _addSegment(double[:, :] skeleton, int j, double[:, :] segment, int seg_size, bint reverse) noexcept nogil:
+    #same as skeleton[j:j + seg_size] = segment (or segment[::-1]), including the
+    #width in the last column. It returns -1 if the segment does not fit.
+    cdef int k, kk
+    if j + seg_size > skeleton.shape[0]:
+        #numpy broadcasts a single point to an empty slice
+        return 0 if (seg_size == 1 and j >= skeleton.shape[0]) else -1
+    for k in range(seg_size):
+        kk = seg_size - 1 - k if reverse else k
+        skeleton[j + k, 0] = segment[kk, 0]
+        skeleton[j + k, 1] = segment[kk, 1]
+        skeleton[j + k, 2] = segment[kk, 2]
+    return 0
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _skeletonizeSegment(int start_side1, int end_side1, int inc_side1, \
+int start_side2, int end_side2, int inc_side2, double[:, :] contour, double[:, :] segment, \
+double[:, :] skeleton, int *j, bint reverse) noexcept nogil:
+    #skeletonize a segment and add it to skeleton starting in the j-th row. It returns the index
+    #of the last row of the segment (next_j) or -1 if there was an error.
+    cdef int seg_size, next_j
+    seg_size = _skeletonize(start_side1, end_side1, inc_side1, start_side2, end_side2, inc_side2, \
+                            contour, contour, segment[:, :2], segment[:, 2])
+    if seg_size < 0:
+        return -1
+    next_j = j[0] + seg_size - 1
+    if _addSegment(skeleton, j[0], segment, seg_size, reverse) < 0:
+        return -1
+    j[0] = next_j + 1
+    return next_j
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int _linearSkeleton(int head_ind, int tail_ind, \
+double[:] minima_low_freq, np.int64_t[:] minima_low_freq_ind, \
+double[:] maxima_low_freq, np.int64_t[:] maxima_low_freq_ind, \
+double[:, :] contour, double worm_seg_length, double[:] chain_code_len, \
+np.int_t[:, :] ibuff, double[:, :] seg_buff, double[:, :, :] mid_buff, \
+double[:, :] skeleton, double[:] cnt_widths) noexcept nogil:
+    #ibuff (16 x 4*contour size + 3), seg_buff (6*contour size + 8 x 3) and mid_buff (2 x contour size x 3)
+    #are work arrays. The skeleton is written in the first rows of skeleton and cnt_widths,
+    #and the number of points is returned. It returns -1 if the contour cannot be skeletonized.
+    cdef int cnt_size = contour.shape[0]
+    cdef int last_index = cnt_size - 1
+    cdef double last_chain_len = chain_code_len[chain_code_len.shape[0]-1]
+    cdef double search_edge_size = last_chain_len / 8.
+
+    cdef np.int_t[:, :] work = ibuff[12:16]
+    cdef np.int_t[:] bend_ind = ibuff[0]
+    cdef np.int_t[:] bend1_s1 = ibuff[1]
+    cdef np.int_t[:] bend1_s2 = ibuff[2]
+    cdef np.int_t[:] bend2_s1 = ibuff[3]
+    cdef np.int_t[:] bend2_s2 = ibuff[4]
+    cdef np.int_t[:] bend_side1 = ibuff[5]
+    cdef np.int_t[:] bend_side2 = ibuff[6]
+    cdef np.int_t[:] interbend_side1 = ibuff[7]
+    cdef np.int_t[:] interbend_side2 = ibuff[8]
+    cdef np.int_t[:] tmp_ind = ibuff[9]
+
+    cdef int i, k, n_bends, n_bend1, n_bend2, n_side1, n_side2, midbody_ind
+    cdef int midbody1_s1, midbody1_s2, midbody2_s1, midbody2_s2
+    cdef int midbody_side1, midbody_side2, delta_mid_point
+    cdef double midbody_len, dx, dy, r1, r2
+    cdef int region[4]
+    cdef int head_start, head_end, tail_start, tail_end
+
+    #% Compute the midbody indices for side 1 (getMidBodySeed).
+    midbody_len = (chain_code_len[head_ind] + chain_code_len[tail_ind]) / 2
+    midbody1_s1 = _chainCodeLength2Index(midbody_len, chain_code_len)
+    tmp_ind[0] = midbody1_s1
+    if _circOpposingNearestPoints(tmp_ind[:1], contour, head_ind, tail_ind, search_edge_size, \
+        chain_code_len, tmp_ind[1:2], work) < 0:
+        return -1
+    midbody1_s2 = tmp_ind[1]
+
+    #% Compute the midbody indices for side 2.
+    midbody_len = (chain_code_len[head_ind] + chain_code_len[tail_ind] + last_chain_len) / 2
+    if midbody_len > last_chain_len:
+        midbody_len -= - last_chain_len
+    midbody2_s2 = _chainCodeLength2Index(midbody_len, chain_code_len)
+    tmp_ind[0] = midbody2_s2
+    if _circOpposingNearestPoints(tmp_ind[:1], contour, head_ind, tail_ind, search_edge_size, \
+        chain_code_len, tmp_ind[1:2], work) < 0:
+        return -1
+    midbody2_s1 = tmp_ind[1]
+
+    #% The closest points are the true midbody indices.
+    dx = contour[midbody1_s1, 0] - contour[midbody1_s2, 0]
+    dy = contour[midbody1_s1, 1] - contour[midbody1_s2, 1]
+    r1 = dx*dx + dy*dy
+    dx = contour[midbody2_s1, 0] - contour[midbody2_s2, 0]
+    dy = contour[midbody2_s1, 1] - contour[midbody2_s2, 1]
+    r2 = dx*dx + dy*dy
+    if (r1 <= r2):
+        midbody_side1 = midbody1_s1
+        midbody_side2 = midbody1_s2
+    else:
+        midbody_side1 = midbody2_s1
+        midbody_side2 = midbody2_s2
+
+    #% Compute the minimum distance between the midbody indices.
+    if midbody_side1 > midbody_side2:
+        delta_mid_point = int_min(midbody_side1 - midbody_side2, midbody_side2 + cnt_size - midbody_side1)
+    else:
+        delta_mid_point = int_min(midbody_side2 - midbody_side1, midbody_side1 + cnt_size - midbody_side2)
+
+    #% Find the large minimal bends away from the head and tail (getBendsSeeds).
+    _getHeadTailRegion(head_ind, tail_ind, chain_code_len, worm_seg_length, region)
+    head_start = region[0]
+    head_end = region[1]
+    tail_start = region[2]
+    tail_end = region[3]
+
+    n_bends = 0
+    for i in range(minima_low_freq.shape[0]):
+        if minima_low_freq[i] < -20:
+            bend_ind[n_bends] = minima_low_freq_ind[i]
+            n_bends += 1
+    for i in range(maxima_low_freq.shape[0]):
+        if maxima_low_freq[i] > 20:
+            bend_ind[n_bends] = maxima_low_freq_ind[i]
+            n_bends += 1
+
+    k = 0
+    for i in range(n_bends):
+        if not (_betweenPoints(bend_ind[i], head_start, head_end) and \
+        _betweenPoints(bend_ind[i], tail_start, tail_end)):
+            bend_ind[k] = bend_ind[i]
+            k += 1
+    n_bends = k
+
+    #% Compute the bend indices for side 1.
+    #% Remove any bend indices too close to the head and/or tail.
+    n_bend1 = 0
+    for i in range(n_bends):
+        if (bend_ind[i] >= head_end) and (bend_ind[i] <= tail_start):
+            bend1_s1[n_bend1] = bend_ind[i]
+            n_bend1 += 1
+    if _circOpposingNearestPoints(bend1_s1[:n_bend1], contour, head_ind, tail_ind, search_edge_size, \
+        chain_code_len, bend1_s2[:n_bend1], work) < 0:
+        return -1
+
+    #% Remove any bend indices that cross the midline.
+    k = 0
+    for i in range(n_bend1):
+        if not _maxDistPoints(bend1_s1[i], bend1_s2[i], delta_mid_point, cnt_size):
+            bend1_s1[k] = bend1_s1[i]
+            bend1_s2[k] = bend1_s2[i]
+            k += 1
+    n_bend1 = k
+
+    #% Minimize the width at the bend.
+    if _circOpposingNearestPoints(bend1_s2[:n_bend1], contour, head_ind, tail_ind, search_edge_size, \
+        chain_code_len, bend1_s1[:n_bend1], work) < 0:
+        return -1
+    k = 0
+    for i in range(n_bend1):
+        if not (_betweenPoints(bend1_s1[i], head_start, head_end) or \
+        _betweenPoints(bend1_s1[i], tail_start, tail_end) or \
+        _maxDistPoints(bend1_s1[i], bend1_s2[i], delta_mid_point, cnt_size)):
+            bend1_s1[k] = bend1_s1[i]
+            bend1_s2[k] = bend1_s2[i]
+            k += 1
+    n_bend1 = k
+
+    #% Compute the bend indices for side 2.
+    n_bend2 = 0
+    for i in range(n_bends):
+        if (bend_ind[i] >= tail_end) and (bend_ind[i] <= head_start):
+            bend2_s2[n_bend2] = bend_ind[i]
+            n_bend2 += 1
+    if _circOpposingNearestPoints(bend2_s2[:n_bend2], contour, head_ind, tail_ind, search_edge_size, \
+        chain_code_len, bend2_s1[:n_bend2], work) < 0:
+        return -1
+
+    #% Remove any bend indices that cross the midline.
+    k = 0
+    for i in range(n_bend2):
+        if not _maxDistPoints(bend2_s2[i], bend2_s1[i], delta_mid_point, cnt_size):
+            bend2_s2[k] = bend2_s2[i]
+            bend2_s1[k] = bend2_s1[i]
+            k += 1
+    n_bend2 = k
+
+    #% Minimize the width at the bend.
+    if _circOpposingNearestPoints(bend2_s1[:n_bend2], contour, head_ind, tail_ind, search_edge_size, \
+        chain_code_len, bend2_s2[:n_bend2], work) < 0:
+        return -1
+    k = 0
+    for i in range(n_bend2):
+        if not (_betweenPoints(bend2_s2[i], head_start, head_end) or \
+        _betweenPoints(bend2_s2[i], tail_start, tail_end) or \
+        _maxDistPoints(bend2_s2[i], bend2_s1[i], delta_mid_point, cnt_size)):
+            bend2_s2[k] = bend2_s2[i]
+            bend2_s1[k] = bend2_s1[i]
+            k += 1
+    n_bend2 = k
+
+    #% Combine the bend indices from opposing sides and order everything so
+    #% that the skeleton segments can never cross.
+    bend_side1[0] = midbody_side1
+    bend_side2[0] = midbody_side2
+    for i in range(n_bend1):
+        bend_side1[1 + i] = bend1_s1[i]
+        bend_side2[1 + i] = bend1_s2[i]
+    for i in range(n_bend2):
+        bend_side1[1 + n_bend1 + i] = bend2_s1[i]
+        bend_side2[1 + n_bend1 + i] = bend2_s2[i]
+    n_side1 = 1 + n_bend1 + n_bend2
+
+    _sortIndexes(bend_side1[:n_side1], False)
+    midbody_ind = 0
+    while bend_side1[midbody_ind] != midbody_side1:
+        midbody_ind += 1
+
+    _sortIndexes(bend_side2[:n_side1], True)
+    n_side2 = 0
+    for i in range(n_side1):
+        if (bend_side2[i] <= head_ind) or (bend_side2[i] >= tail_ind):
+            bend_side2[n_side2] = bend_side2[i]
+            n_side2 += 1
+
+    #% get inter-bend seeds
+    if _getInterBendSeeds(bend_side1[:n_side1], bend_side2[:n_side2], contour, chain_code_len, \
+        interbend_side1, interbend_side2) < 0:
+        return -1
+
+    #% Get the skeleton and contour widths (getLinearSkeleton).
+    cdef int head_side1, head_side2, tail_side1, tail_side2
+    cdef int j, next_j, n_mid_head, n_mid_tail
+    cdef double[:, :] mid_head = mid_buff[0, :cnt_size]
+    cdef double[:, :] mid_tail = mid_buff[1, :cnt_size]
+
+    #% Compute the head and tail indices.
+    head_side1 = head_ind + 1
+    head_side2 = (head_ind - 1) if (head_ind > 0) else (head_ind + last_index)
+    tail_side1 = tail_ind - 1
+    tail_side2 = (tail_ind + 1) if (tail_ind < last_index) else (tail_ind - last_index)
+
+    #% Skeletonize the worm from its midbody to its head.
+    i = midbody_ind
+    j = 0
+    while i > 0:
+        #% Skeletonize the segment from the bend to the interbend.
+        if _skeletonizeSegment(bend_side1[i], interbend_side1[i - 1], -1, bend_side2[i], interbend_side2[i - 1], 1, \
+            contour, seg_buff, mid_head, &j, False) < 0:
+            return -1
+        i = i - 1
+
+        #% Skeletonize the segment from the next bend back to the interbend.
+        if _skeletonizeSegment(bend_side1[i], interbend_side1[i], 1, bend_side2[i], interbend_side2[i], -1, \
+            contour, seg_buff, mid_head, &j, True) < 0:
+            return -1
+
+    #% Skeletonize the segment from the last bend to the head.
+    next_j = _skeletonizeSegment(bend_side1[i], head_side1, -1, bend_side2[i], head_side2, 1, \
+        contour, seg_buff, mid_head, &j, False)
+    if next_j < 0:
+        return -1
+    n_mid_head = int_min(next_j, cnt_size)
+
+    #% Skeletonize the worm from its midbody to its tail.
+    i = midbody_ind
+    j = 0
+    while i < n_side1 - 1:
+        #% Skeletonize the segment from the bend to the interbend.
+        if _skeletonizeSegment(bend_side1[i], interbend_side1[i], 1, bend_side2[i], interbend_side2[i], -1, \
+            contour, seg_buff, mid_tail, &j, False) < 0:
+            return -1
+        i = i + 1
+
+        if _skeletonizeSegment(bend_side1[i], interbend_side1[i - 1], -1, bend_side2[i], interbend_side2[i - 1], 1, \
+            contour, seg_buff, mid_tail, &j, True) < 0:
+            return -1
+
+    next_j = _skeletonizeSegment(bend_side1[i], tail_side1, 1, bend_side2[i], tail_side2, -1, \
+        contour, seg_buff, mid_tail, &j, False)
+    if next_j < 0:
+        return -1
+    n_mid_tail = int_min(next_j, cnt_size)
+
+    #% Reconstruct the skeleton.
+    if n_mid_head + n_mid_tail + 2 > skeleton.shape[0]:
+        return -1
+    skeleton[0, 0] = contour[head_ind, 0]
+    skeleton[0, 1] = contour[head_ind, 1]
+    cnt_widths[0] = 0
+    j = 1
+    for i in range(n_mid_head - 1, -1, -1):
+        skeleton[j, 0] = mid_head[i, 0]
+        skeleton[j, 1] = mid_head[i, 1]
+        cnt_widths[j] = mid_head[i, 2]
+        j += 1
+    for i in range(n_mid_tail):
+        skeleton[j, 0] = mid_tail[i, 0]
+        skeleton[j, 1] = mid_tail[i, 1]
+        cnt_widths[j] = mid_tail[i, 2]
+        j += 1
+    skeleton[j, 0] = contour[tail_ind, 0]
+    skeleton[j, 1] = contour[tail_ind, 1]
+    cnt_widths[j] = 0
+    return j + 1
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def linearSkeletonBatch(np.int64_t[::1] tail_ind not None,
+    double[::1] minima_low_freq not None, np.int64_t[::1] minima_low_freq_ind not None, Py_ssize_t[::1] min_offsets not None,
+    double[::1] maxima_low_freq not None, np.int64_t[::1] maxima_low_freq_ind not None, Py_ssize_t[::1] max_offsets not None,
+    double[:, ::1] points not None, Py_ssize_t[::1] offsets not None,
+    double[::1] worm_seg_length not None, double[::1] chain_code_len not None, np.int64_t[::1] err_code not None):
+    '''
+    Batched version of linearSkeleton.linearSkeleton for contours with the head in the first
+    index (see mainSegworm.contours2SkeletonsBatch). The contours and their peaks are concatenated,
+    and the offsets have the index where each contour starts. Only the contours with err_code == 0 are
+    skeletonized. It returns (skeletons, cnt_widths, skel_offsets, failed). The contours in failed
+    could not be skeletonized (linearSkeleton raises an error for them). The GIL is released
+    during the calculation.
+    '''
+    cdef Py_ssize_t n_contours = offsets.shape[0] - 1
+    cdef Py_ssize_t ii, ini, fin, tot = 0
+    cdef int n_skel
+
+    cdef Py_ssize_t max_size = 0
+    for ii in range(n_contours):
+        max_size = max(max_size, offsets[ii + 1] - offsets[ii])
+
+    cdef np.int_t[:, :] ibuff = np.zeros((16, 4*max_size + 3), dtype = np.int_)
+    cdef double[:, :] seg_buff = np.zeros((6*max_size + 8, 3))
+    cdef double[:, :, :] mid_buff = np.zeros((2, max_size, 3))
+
+    cdef double[:, ::1] skeletons = np.zeros((2*points.shape[0] + 2*n_contours, 2))
+    cdef double[::1] cnt_widths = np.zeros(skeletons.shape[0])
+    cdef Py_ssize_t[::1] skel_offsets = np.zeros(n_contours + 1, dtype = np.intp)
+    cdef np.uint8_t[::1] failed = np.zeros(n_contours, dtype = np.uint8)
+
+    with nogil:
+        for ii in range(n_contours):
+            if err_code[ii] == 0:
+                ini = offsets[ii]
+                fin = offsets[ii + 1]
+                n_skel = _linearSkeleton(0,
+                                         <int>tail_ind[ii],
+                                         minima_low_freq[min_offsets[ii]:min_offsets[ii + 1]],
+                                         minima_low_freq_ind[min_offsets[ii]:min_offsets[ii + 1]],
+                                         maxima_low_freq[max_offsets[ii]:max_offsets[ii + 1]],
+                                         maxima_low_freq_ind[max_offsets[ii]:max_offsets[ii + 1]],
+                                         points[ini:fin],
+                                         worm_seg_length[ii],
+                                         chain_code_len[ini:fin],
+                                         ibuff, seg_buff, mid_buff,
+                                         skeletons[tot:], cnt_widths[tot:])
+                if n_skel < 0:
+                    failed[ii] = 1
+                else:
+                    tot += n_skel
+            skel_offsets[ii + 1] = tot
+
+    return np.asarray(skeletons)[:tot], np.asarray(cnt_widths)[:tot], np.asarray(skel_offsets), np.flatnonzero(failed)
 
 
-    
 def cleanSkeleton(np.ndarray[np.float_t, ndim=2] skeleton, np.ndarray[np.float_t, ndim=1] widths, double worm_seg_size):
     ''' * %CLEANSKELETON Clean an 8-connected skeleton by removing any overlap and
      * %interpolating any missing points.
@@ -878,4 +1409,3 @@ def cleanSkeleton(np.ndarray[np.float_t, ndim=2] skeleton, np.ndarray[np.float_t
     
     return cSkeleton, cWidths
     
-    
\ No newline at end of file
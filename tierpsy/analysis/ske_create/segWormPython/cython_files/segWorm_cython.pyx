@@ -14,7 +14,7 @@ import numpy as np
 cimport numpy as np
 cimport cython
 from libc.math cimport round as c_round;
-from libc.math cimport sqrt, atan2, M_PI, abs
+from libc.math cimport sqrt, atan2, M_PI, abs, isnan, NAN, fabs
 
 cdef inline double absDiff(double a, double b): 
     return a-b if a>b else b-a
@@ -242,4 +242,349 @@ def circCurvature_old(np.ndarray[np.float_t, ndim=2] points, double edgeLength,
                 p = chainCodeLengths[nextP1_ind]
                 nextE1 = getEdgeLengthLeft(last_length, pv, p)
         
-    return angles
\ No newline at end of file
+    return angles
+#%% Batched versions used by mainSegworm.getSkeletonsBatch. The contours are given
+# concatenated in a single (n_points, 2) array, and offsets has the position where
+# each contour starts (plus the total number of points at the end).
+# The loops release the GIL, so they can be run from several threads.
+
+@cython.profile(False)
+cdef inline double _absDiff(double a, double b) noexcept nogil:
+    return a-b if a>b else b-a
+
+@cython.profile(False)
+cdef inline double _displacement(double dPx, double dPy) noexcept nogil:
+    if (dPx ==0 or dPy ==0):
+        return dPx + dPy;
+    elif dPx ==1 and dPy ==1:
+        return 1.4142135623730951; #sqrt(2)
+    else:
+        return sqrt(dPx*dPx + dPy*dPy);
+
+@cython.profile(False)
+cdef double _pairwiseSum(double *a, Py_ssize_t n) noexcept nogil:
+    #same summation order as numpy's sum, so the results are identical
+    cdef double res
+    cdef double r[8]
+    cdef Py_ssize_t i, j, n2
+    if n < 8:
+        res = 0.
+        for i in range(n):
+            res += a[i]
+        return res
+    elif n <= 128:
+        for j in range(8):
+            r[j] = a[j]
+        i = 8
+        while i < n - (n % 8):
+            for j in range(8):
+                r[j] += a[i + j]
+            i += 8
+        res = ((r[0] + r[1]) + (r[2] + r[3])) + ((r[4] + r[5]) + (r[6] + r[7]))
+        while i < n:
+            res += a[i]
+            i += 1
+        return res
+    else:
+        n2 = n // 2
+        n2 -= n2 % 8
+        return _pairwiseSum(a, n2) + _pairwiseSum(a + n2, n - n2)
+
+@cython.profile(False)
+cdef double _signedArea(double[:, ::1] points, Py_ssize_t ini, Py_ssize_t fin, double *buff) noexcept nogil:
+    # x1y2 - x2y1(http://mathworld.wolfram.com/PolygonArea.html)
+    cdef Py_ssize_t i
+    for i in range(ini, fin - 1):
+        buff[i - ini] = points[i, 0]*points[i + 1, 1] - points[i + 1, 0]*points[i, 1]
+    return _pairwiseSum(buff, fin - ini - 1) / 2
+
+def orientContoursBatch(double[:, ::1] points, Py_ssize_t[::1] offsets):
+    '''
+    Reverse (in place) the contours with a positive signed area, so all of them are
+    in the counter-clockwise direction. It returns the signed area before the reversal.
+    '''
+    cdef Py_ssize_t n_contours = offsets.shape[0] - 1
+    cdef double[::1] signed_area = np.zeros(n_contours)
+    cdef double[::1] buff = np.zeros(points.shape[0] + 1)
+    cdef Py_ssize_t ii, i, j, ini, fin
+    cdef double tmp
+    with nogil:
+        for ii in range(n_contours):
+            ini, fin = offsets[ii], offsets[ii + 1]
+            signed_area[ii] = _signedArea(points, ini, fin, &buff[0])
+            if signed_area[ii] > 0:
+                for i in range((fin - ini) // 2):
+                    for j in range(2):
+                        tmp = points[ini + i, j]
+                        points[ini + i, j] = points[fin - 1 - i, j]
+                        points[fin - 1 - i, j] = tmp
+    return np.asarray(signed_area)
+
+@cython.profile(False)
+cdef void _chainCodeLengths(double[:, ::1] points, Py_ssize_t ini, Py_ssize_t fin, double[::1] lengths) noexcept nogil:
+    cdef double dPx, dPy
+    cdef Py_ssize_t i
+    dPx = _absDiff(points[ini,0], points[fin - 1,0]);
+    dPy = _absDiff(points[ini,1], points[fin - 1,1]);
+    lengths[ini] = _displacement(dPx, dPy)
+    for i in range(ini + 1, fin):
+        dPx = _absDiff(points[i,0], points[i-1,0]);
+        dPy = _absDiff(points[i,1], points[i-1,1]);
+        lengths[i] = lengths[i-1] + _displacement(dPx, dPy)
+
+def circComputeChainCodeLengthsBatch(double[:, ::1] points, Py_ssize_t[::1] offsets):
+    '''
+    Batched version of circComputeChainCodeLengths. The lengths of each contour
+    start from its first point.
+    '''
+    cdef double[::1] lengths = np.ones(points.shape[0])
+    cdef Py_ssize_t ii
+    with nogil:
+        for ii in range(offsets.shape[0] - 1):
+            _chainCodeLengths(points, offsets[ii], offsets[ii + 1], lengths)
+    return np.asarray(lengths)
+
+@cython.profile(False)
+cdef double _interp(double x_val, double *xp, double *fp, Py_ssize_t n, Py_ssize_t *j_guess) noexcept nogil:
+    #same arithmetic as numpy.interp for the values in [xp[0], xp[n-1]]
+    cdef Py_ssize_t j = j_guess[0]
+    cdef double slope, res
+    if isnan(x_val):
+        return NAN
+    while j > 0 and xp[j] > x_val:
+        j -= 1
+    while j < n - 1 and xp[j + 1] <= x_val:
+        j += 1
+    j_guess[0] = j
+    
+    if j == n - 1 or xp[j] == x_val:
+        return fp[j]
+    slope = (fp[j + 1] - fp[j]) / (xp[j + 1] - xp[j])
+    res = slope*(x_val - xp[j]) + fp[j]
+    if isnan(res):
+        res = slope*(x_val - xp[j + 1]) + fp[j + 1]
+        if isnan(res) and fp[j] == fp[j + 1]:
+            res = fp[j]
+    return res
+
+@cython.profile(False)
+cdef double _resampleCurve(double[:, ::1] curve, Py_ssize_t ini, Py_ssize_t fin, double[::1] widths, 
+    double[:, ::1] resampled_curve, double[::1] resampled_widths, bint has_widths,
+    double *lengths, double *buff_x, double *buff_y) noexcept nogil:
+    
+    cdef Py_ssize_t n = fin - ini
+    cdef Py_ssize_t N = resampled_curve.shape[0]
+    cdef Py_ssize_t i, j_guess
+    cdef double dx, dy, tot_length, step, sub_length
+    cdef double eps = 2.220446049250313e-16
+    
+    lengths[0] = 0
+    for i in range(n):
+        buff_x[i] = curve[ini + i, 0]
+        buff_y[i] = curve[ini + i, 1]
+        if i > 0:
+            dx = buff_x[i] - buff_x[i - 1]
+            dy = buff_y[i] - buff_y[i - 1]
+            lengths[i] = lengths[i - 1] + sqrt(dx * dx + dy * dy)
+    tot_length = lengths[n - 1]
+    
+    # same values as np.linspace(eps, tot_length, N)
+    step = (tot_length - eps) / (N - 1)
+    if tot_length < eps:
+        # the interpolation is out of bounds (ValueError in resample_curve)
+        for i in range(N):
+            resampled_curve[i, 0] = NAN
+            resampled_curve[i, 1] = NAN
+            resampled_widths[i] = NAN
+        return tot_length
+    
+    j_guess = 0
+    for i in range(N):
+        sub_length = i * step + eps if i < N - 1 else tot_length
+        resampled_curve[i, 0] = _interp(sub_length, lengths, buff_x, n, &j_guess)
+    j_guess = 0
+    for i in range(N):
+        sub_length = i * step + eps if i < N - 1 else tot_length
+        resampled_curve[i, 1] = _interp(sub_length, lengths, buff_y, n, &j_guess)
+    if has_widths:
+        j_guess = 0
+        for i in range(N):
+            sub_length = i * step + eps if i < N - 1 else tot_length
+            resampled_widths[i] = _interp(sub_length, lengths, &widths[ini], n, &j_guess)
+    return tot_length
+
+def resampleCurvesBatch(double[:, ::1] curves, Py_ssize_t[::1] offsets, int resampling_N, double[::1] widths = None):
+    '''
+    Batched version of mainSegworm.resample_curve. The curves must have at least two points.
+    It returns the resampled curves (n_curves, resampling_N, 2), their lengths and 
+    the resampled widths (if widths is given).
+    '''
+    cdef Py_ssize_t n_curves = offsets.shape[0] - 1
+    cdef double[:, :, ::1] resampled_curves = np.zeros((n_curves, resampling_N, 2))
+    cdef double[:, ::1] resampled_widths = np.zeros((n_curves, resampling_N))
+    cdef double[::1] curve_lengths = np.zeros(n_curves)
+    cdef double[:, ::1] buff = np.zeros((3, curves.shape[0] + 1))
+    cdef bint has_widths = widths is not None
+    cdef Py_ssize_t ii
+
+    if resampling_N < 2:
+        raise ValueError('resampling_N must be at least 2.')
+    for ii in range(n_curves):
+        if offsets[ii + 1] - offsets[ii] < 2:
+            raise ValueError('The curves must have at least two points.')
+    if not has_widths:
+        widths = np.zeros(0)
+    
+    with nogil:
+        for ii in range(n_curves):
+            curve_lengths[ii] = _resampleCurve(curves, offsets[ii], offsets[ii + 1], widths,
+                resampled_curves[ii], resampled_widths[ii], has_widths,
+                &buff[0, 0], &buff[1, 0], &buff[2, 0])
+    
+    output = np.asarray(resampled_curves), np.asarray(curve_lengths)
+    if has_widths:
+        output += (np.asarray(resampled_widths),)
+    return output
+
+@cython.profile(False)
+cdef inline double _absDistanceCirc(np.int64_t ind1, np.int64_t ind2, double *chain_code_len, Py_ssize_t last_index) noexcept nogil:
+    cdef double dist = fabs(chain_code_len[ind1] - chain_code_len[ind2])
+    cdef double dist_wrap = chain_code_len[last_index] - dist
+    return dist if dist <= dist_wrap else dist_wrap
+
+@cython.profile(False)
+cdef inline np.int64_t _nearestPeak(np.int64_t ind, np.int64_t *peaks_ind, Py_ssize_t n_peaks, 
+    double *chain_code_len, Py_ssize_t last_index) noexcept nogil:
+    cdef Py_ssize_t i, best = 0
+    cdef double dist, best_dist = _absDistanceCirc(ind, peaks_ind[0], chain_code_len, last_index)
+    for i in range(1, n_peaks):
+        dist = _absDistanceCirc(ind, peaks_ind[i], chain_code_len, last_index)
+        if dist < best_dist:
+            best, best_dist = i, dist
+    return peaks_ind[best]
+
+@cython.profile(False)
+cdef int _getHeadTail(double *cnt_ang_low_freq, np.int64_t *maxima_low_freq_ind, Py_ssize_t n_low,
+    double *cnt_ang_hi_freq, np.int64_t *maxima_hi_freq_ind, Py_ssize_t n_hi, 
+    double *chain_code_len, Py_ssize_t last_index, double angle_thresh_hi_freq, 
+    np.int64_t *good_low, np.int64_t *good_hi, np.int64_t *head_tail) noexcept nogil:
+    #same as getHeadTail.getHeadTail
+    cdef double angle_thresh_low_freq = angle_thresh_hi_freq*1.5
+    cdef Py_ssize_t i, j, n_good_low = 0, n_good_hi = 0
+    cdef np.int64_t head_ind, tail_ind, tmp
+    cdef double dist_head_tail, size1, size2
+    cdef double *angles
+    
+    for i in range(n_hi):
+        if cnt_ang_hi_freq[maxima_hi_freq_ind[i]] > angle_thresh_hi_freq:
+            good_hi[n_good_hi] = maxima_hi_freq_ind[i]
+            n_good_hi += 1
+    for i in range(n_low):
+        if cnt_ang_low_freq[maxima_low_freq_ind[i]] > angle_thresh_low_freq:
+            good_low[n_good_low] = maxima_low_freq_ind[i]
+            n_good_low += 1
+    
+    head_tail[0], head_tail[1] = -1, -1
+    if n_good_low > 2:
+        return 104
+    if n_good_hi < 2:
+        return 105
+    
+    if n_good_low == 2:
+        head_ind, tail_ind = good_low[0], good_low[1]
+        angles = cnt_ang_low_freq
+    elif n_good_hi == 2:
+        head_ind, tail_ind = good_hi[0], good_hi[1]
+        angles = cnt_ang_hi_freq
+    else:
+        head_ind, tail_ind = good_hi[0], good_hi[1]
+        angles = cnt_ang_hi_freq
+        dist_head_tail = _absDistanceCirc(head_ind, tail_ind, chain_code_len, last_index)
+        for i in range(n_good_hi - 1):
+            for j in range(i + 1, n_good_hi):
+                if _absDistanceCirc(good_hi[i], good_hi[j], chain_code_len, last_index) > dist_head_tail:
+                    head_ind, tail_ind = good_hi[i], good_hi[j]
+    
+    #% Note: the tail should have a sharper angle.
+    if not angles[head_ind] <= angles[tail_ind]:
+        head_ind, tail_ind = tail_ind, head_ind
+    
+    if n_good_low == 2:
+        #% Localize the head and tail by finding its nearest, sharpest (but blurred),
+        #% high-frequency convexity.
+        head_ind = _nearestPeak(head_ind, good_hi, n_good_hi, chain_code_len, last_index)
+        tail_ind = _nearestPeak(tail_ind, good_hi, n_good_hi, chain_code_len, last_index)
+    
+    head_tail[0], head_tail[1] = head_ind, tail_ind
+    
+    # one of the sides is too short so it might be touching itself (coiling)
+    if head_ind > tail_ind:
+        size1 = chain_code_len[head_ind] - chain_code_len[tail_ind]
+        size2 = chain_code_len[last_index] - chain_code_len[head_ind] + chain_code_len[tail_ind]
+    else:
+        size1 = chain_code_len[tail_ind] - chain_code_len[head_ind]
+        size2 = chain_code_len[last_index] - chain_code_len[tail_ind] + chain_code_len[head_ind]
+    if (size2 if size2 < size1 else size1) / (size2 if size2 > size1 else size1) <= .5:
+        return 106
+    return 0
+
+def getHeadTailBatch(double[::1] cnt_ang_low_freq, np.int64_t[::1] maxima_low_freq_ind, Py_ssize_t[::1] low_offsets,
+    double[::1] cnt_ang_hi_freq, np.int64_t[::1] maxima_hi_freq_ind, Py_ssize_t[::1] hi_offsets,
+    double[::1] chain_code_len, Py_ssize_t[::1] offsets, double angle_thresh_hi_freq = 60):
+    '''
+    Batched version of getHeadTail.getHeadTail. The maxima indices are relative to the start of 
+    each contour, and the maxima of the contour ii are in [low/hi]_offsets[ii]:[low/hi]_offsets[ii+1].
+    It returns the head and tail indices, and the error code of each contour.
+    '''
+    cdef Py_ssize_t n_contours = offsets.shape[0] - 1
+    cdef np.int64_t[::1] head_tail = np.zeros(2*n_contours, dtype=np.int64)
+    cdef np.int64_t[::1] err_code = np.zeros(n_contours, dtype=np.int64)
+    cdef np.int64_t[:, ::1] buff = np.zeros((2, max(maxima_low_freq_ind.shape[0], maxima_hi_freq_ind.shape[0]) + 1), dtype=np.int64)
+    cdef Py_ssize_t ii, ini
+    
+    with nogil:
+        for ii in range(n_contours):
+            ini = offsets[ii]
+            err_code[ii] = _getHeadTail(&cnt_ang_low_freq[ini], &maxima_low_freq_ind[low_offsets[ii]], 
+                low_offsets[ii + 1] - low_offsets[ii], 
+                &cnt_ang_hi_freq[ini], &maxima_hi_freq_ind[hi_offsets[ii]], 
+                hi_offsets[ii + 1] - hi_offsets[ii],
+                &chain_code_len[ini], offsets[ii + 1] - ini - 1, angle_thresh_hi_freq,
+                &buff[0, 0], &buff[1, 0], &head_tail[2*ii])
+    
+    head_tail_arr = np.asarray(head_tail)
+    return head_tail_arr[::2].copy(), head_tail_arr[1::2].copy(), np.asarray(err_code)
+
+def rollHead2FirstIndexBatch(double[:, ::1] points, double[::1] chain_code_len, double[::1] cnt_ang, 
+    Py_ssize_t[::1] offsets, np.int64_t[::1] head_ind):
+    '''
+    Batched version of getHeadTail.rollHead2FirstIndex for the contours, 
+    chain code lengths and angles. Contours with a negative head_ind are not changed.
+    '''
+    cdef double[:, ::1] points_r = np.zeros((points.shape[0], 2))
+    cdef double[::1] chain_code_len_r = np.zeros(chain_code_len.shape[0])
+    cdef double[::1] cnt_ang_r = np.zeros(cnt_ang.shape[0])
+    cdef Py_ssize_t ii, ini, n, h, k, src
+    cdef double delta_ini, delta_end
+    
+    with nogil:
+        for ii in range(offsets.shape[0] - 1):
+            ini = offsets[ii]
+            n = offsets[ii + 1] - ini
+            h = head_ind[ii] if head_ind[ii] > 0 else 0
+            if h > 0:
+                delta_ini = chain_code_len[ini + h - 1]
+                delta_end = chain_code_len[ini + n - 1] - chain_code_len[ini + h - 1]
+            for k in range(n):
+                src = ini + (k + h if k + h < n else k + h - n)
+                points_r[ini + k, 0] = points[src, 0]
+                points_r[ini + k, 1] = points[src, 1]
+                cnt_ang_r[ini + k] = cnt_ang[src]
+                if h == 0:
+                    chain_code_len_r[ini + k] = chain_code_len[src]
+                elif k + h < n:
+                    chain_code_len_r[ini + k] = chain_code_len[src] - delta_ini
+                else:
+                    chain_code_len_r[ini + k] = chain_code_len[src] + delta_end
+    
+    return np.asarray(points_r), np.asarray(chain_code_len_r), np.asarray(cnt_ang_r)
@@ -10,12 +10,16 @@ from scipy.interpolate import interp1d
 from scipy.signal import savgol_filter
 
 from .linearSkeleton import linearSkeleton
+from .cython_files.linearSkeleton_cython import linearSkeletonBatch
 from .getHeadTail import getHeadTail, rollHead2FirstIndex
-from .cython_files.segWorm_cython import circComputeChainCodeLengths
+from .cython_files.segWorm_cython import circComputeChainCodeLengths, \
+circComputeChainCodeLengthsBatch, orientContoursBatch, resampleCurvesBatch, \
+getHeadTailBatch, rollHead2FirstIndexBatch
+from .cython_files.cleanWorm_cython import circSmoothBatch, extremaPeaksCircDistBatch
 from .cleanWorm import circSmooth, extremaPeaksCircDist
 
 # wrappers around C functions
-from .cython_files.circCurvature import circCurvature
+from .cython_files.circCurvature import circCurvature, circCurvatureBatch
 
 errMsg = {104 : '''The worm has 3 or more low-frequency sampled convexities
         sharper than 90 degrees (possible head/tail points).''',
@@ -322,3 +326,184 @@ def getSkeleton(worm_cnt, prev_skeleton=np.zeros(0), resampling_N=49,
         cnt_area)
     assert len(output_data) == n_output_param
     return output_data
+
+
+def _concatenateCurves(curves):
+    '''Concatenate a list of Nx2 arrays, returning the points and the offsets of each curve'''
+    offsets = np.zeros(len(curves) + 1, dtype=np.intp)
+    offsets[1:] = np.cumsum([x.shape[0] for x in curves])
+    points = np.ascontiguousarray(np.concatenate(curves), dtype=np.double)
+    return points, offsets
+
+
+def contours2SkeletonsBatch(worm_cnts, ske_worm_segments=24, head_angle_thresh=60):
+    '''
+    Batched version of contour2Skeleton. worm_cnts is a list of Nx2 contours.
+    The curvature and peaks of all the contours are calculated together in 
+    compiled loops. It returns a list with the output of contour2Skeleton for each contour.
+    '''
+    cnt_worm_segments = 2 * ske_worm_segments
+    outputs = [4 * [np.zeros(0)] + ['Contour is too small'] for _ in worm_cnts]
+
+    valid_ind = [ii for ii, cnt in enumerate(worm_cnts) if cnt.shape[0] >= cnt_worm_segments]
+    if not valid_ind:
+        return outputs
+
+    points, offsets = _concatenateCurves([worm_cnts[ii] for ii in valid_ind])
+    cnt_sizes = np.diff(offsets)
+
+    # make sure the contours are in the counter-clockwise direction (reversed in place)
+    orientContoursBatch(points, offsets)
+
+    cnt_chain_code_len = circComputeChainCodeLengthsBatch(points, offsets)
+    worm_seg_length = (cnt_chain_code_len[offsets[:-1]] + cnt_chain_code_len[offsets[1:] - 1]) / cnt_worm_segments
+
+    # same calculations as get_contour_angles
+    edge_len_hi_freq = worm_seg_length
+    edge_len_low_freq = 2 * edge_len_hi_freq
+    cnt_ang_hi_freq = circCurvatureBatch(points, offsets, edge_len_hi_freq, cnt_chain_code_len)
+    cnt_ang_low_freq = circCurvatureBatch(points, offsets, edge_len_low_freq, cnt_chain_code_len)
+
+    blur_size_hi_freq = np.ceil((cnt_sizes / cnt_worm_segments) / 2)
+    cnt_ang_hi_freq = circSmoothBatch(cnt_ang_hi_freq, offsets, blur_size_hi_freq)
+
+    maxima_hi_freq, maxima_hi_freq_ind, hi_offsets = extremaPeaksCircDistBatch(
+        1, cnt_ang_hi_freq, offsets, edge_len_hi_freq, cnt_chain_code_len)
+    maxima_low_freq, maxima_low_freq_ind, low_offsets = extremaPeaksCircDistBatch(
+        1, cnt_ang_low_freq, offsets, edge_len_low_freq, cnt_chain_code_len)
+
+    #identify head/tail
+    head_ind, tail_ind, err_code = getHeadTailBatch(cnt_ang_low_freq, 
+                                                    maxima_low_freq_ind, 
+                                                    low_offsets,
+                                                    cnt_ang_hi_freq, 
+                                                    maxima_hi_freq_ind, 
+                                                    hi_offsets,
+                                                    cnt_chain_code_len, 
+                                                    offsets,
+                                                    head_angle_thresh)
+
+    # change arrays so the head correspond to the first position
+    points, cnt_chain_code_len, cnt_ang_low_freq = rollHead2FirstIndexBatch(points, 
+                                                                          cnt_chain_code_len, 
+                                                                          cnt_ang_low_freq, 
+                                                                          offsets, 
+                                                                          head_ind)
+    n_low_peaks = np.diff(low_offsets)
+    maxima_low_freq_ind = maxima_low_freq_ind - np.repeat(head_ind, n_low_peaks)
+    maxima_low_freq_ind[maxima_low_freq_ind < 0] += np.repeat(cnt_sizes, n_low_peaks)[maxima_low_freq_ind < 0]
+    tail_ind = tail_ind - head_ind
+    tail_ind[tail_ind < 0] += cnt_sizes[tail_ind < 0]
+
+    #% Compute the contour's local low-frequency curvature minima.
+    minima_low_freq, minima_low_freq_ind, min_offsets = extremaPeaksCircDistBatch(
+        -1, cnt_ang_low_freq, offsets, edge_len_low_freq, cnt_chain_code_len)
+
+    #% Compute the worm's skeleton (the GIL is released).
+    skeletons, skel_widths, skel_offsets, failed = linearSkeletonBatch(tail_ind,
+                                                                      minima_low_freq,
+                                                                      minima_low_freq_ind,
+                                                                      min_offsets,
+                                                                      maxima_low_freq,
+                                                                      maxima_low_freq_ind,
+                                                                      low_offsets,
+                                                                      points,
+                                                                      offsets,
+                                                                      worm_seg_length,
+                                                                      cnt_chain_code_len,
+                                                                      err_code)
+    failed = set(failed)
+
+    for ii, (ini, fin) in enumerate(zip(offsets[:-1], offsets[1:])):
+        if err_code[ii] != 0:
+            outputs[valid_ind[ii]][-1] = err_code[ii]
+            continue
+        
+        contour = points[ini:fin]
+        if ii in failed:
+            # the compiled version could not skeletonize the contour, the python version raises the error
+            low_peaks = slice(low_offsets[ii], low_offsets[ii + 1])
+            min_peaks = slice(min_offsets[ii], min_offsets[ii + 1])
+            skeleton, cnt_widths = linearSkeleton(0, 
+                                                  tail_ind[ii], 
+                                                  minima_low_freq[min_peaks], 
+                                                  minima_low_freq_ind[min_peaks],
+                                                  maxima_low_freq[low_peaks], 
+                                                  maxima_low_freq_ind[low_peaks], 
+                                                  contour.copy(), 
+                                                  worm_seg_length[ii], 
+                                                  cnt_chain_code_len[ini:fin])
+        else:
+            skeleton = skeletons[skel_offsets[ii]:skel_offsets[ii + 1]]
+            cnt_widths = skel_widths[skel_offsets[ii]:skel_offsets[ii + 1]]
+        
+        # Get the contour for each side.
+        cnt_side1 = contour[:tail_ind[ii] + 1, :].copy()
+        cnt_side2 = np.vstack([contour[0, :], contour[:tail_ind[ii] - 1:-1, :]])
+
+        assert np.all(cnt_side1[0] == cnt_side2[0])
+        assert np.all(cnt_side1[-1] == cnt_side2[-1])
+        assert np.all(skeleton[-1] == cnt_side1[-1])
+        assert np.all(skeleton[0] == np.round(cnt_side2[0]))
+        
+        outputs[valid_ind[ii]] = (skeleton, cnt_side1, cnt_side2, cnt_widths, '')
+
+    return outputs
+
+
+def getSkeletonsBatch(worm_cnts, prev_skeletons=None, resampling_N=49, 
+                      num_segments = 24, head_angle_thresh=60, worm_index=None):
+    '''
+    Batched version of getSkeleton. It returns a list with the output of getSkeleton for each contour.
+    worm_cnts -> list of contours.
+    prev_skeletons -> optional list with the previous skeleton of each contour (used to orient the skeletons).
+    worm_index -> optional list with the worm of each contour. The contours of each worm must be 
+        in frame order, and if an element of prev_skeletons is None the last valid skeleton of 
+        that worm is used instead.
+    '''
+    n_output_param = 6  # number of expected output parameters
+
+    for worm_cnt in worm_cnts:
+        assert isinstance(
+            worm_cnt,
+            np.ndarray) and (worm_cnt.size == 0 or (worm_cnt.ndim == 2 and worm_cnt.shape[1] == 2))
+    
+    if prev_skeletons is None:
+        prev_skeletons = [np.zeros(0)]*len(worm_cnts)
+    assert len(prev_skeletons) == len(worm_cnts)
+
+    # make sure the worm contours are float
+    worm_cnts = [x.astype(np.float32) if x.size > 0 else np.zeros((0, 2), np.float32) for x in worm_cnts]
+    skel_data = contours2SkeletonsBatch(worm_cnts, num_segments, head_angle_thresh)
+    
+    outputs = [(n_output_param) * [np.zeros(0)] for _ in worm_cnts]
+    valid_ind = [ii for ii, x in enumerate(skel_data) if x[0].size > 0]
+    if not valid_ind:
+        return outputs
+
+    # resample curves
+    skeletons, offsets = _concatenateCurves([skel_data[ii][0] for ii in valid_ind])
+    cnt_widths = np.concatenate([skel_data[ii][3] for ii in valid_ind])
+    skeletons, ske_lens, cnt_widths = resampleCurvesBatch(skeletons, offsets, resampling_N, cnt_widths)
+    
+    cnt_side1s = resampleCurvesBatch(*_concatenateCurves([skel_data[ii][1] for ii in valid_ind]), resampling_N)[0]
+    cnt_side2s = resampleCurvesBatch(*_concatenateCurves([skel_data[ii][2] for ii in valid_ind]), resampling_N)[0]
+    
+    # orient skeleton with respect to the previous skeleton (in order, since it can be in the batch)
+    last_skeletons = {}
+    valid_row = np.full(len(worm_cnts), -1)
+    valid_row[valid_ind] = np.arange(len(valid_ind))
+    for ii, irow in enumerate(valid_row):
+        worm_key = ii if worm_index is None else worm_index[ii]
+        if prev_skeletons[ii] is not None:
+            last_skeletons[worm_key] = prev_skeletons[ii]
+        if irow < 0:
+            continue
+        
+        prev_skeleton = last_skeletons.get(worm_key, np.zeros(0))
+        skeleton, cnt_side1, cnt_side2, cnt_widths_i, cnt_area = \
+            orientWorm(skeletons[irow], prev_skeleton, cnt_side1s[irow], cnt_side2s[irow], cnt_widths[irow])
+        outputs[ii] = (skeleton, ske_lens[irow], cnt_side1, cnt_side2, cnt_widths_i, cnt_area)
+        last_skeletons[worm_key] = skeleton
+    
+    return outputs
@@ -6,12 +6,15 @@ Created on Fri Dec 11 23:39:22 2015
 """
 
 import os
+import json
+import tempfile
 import warnings
 
 import numpy as np
 import pandas as pd
 import tables
 from scipy.stats import chi2
+from scipy.linalg import pinvh
 from sklearn.covariance import MinCovDet
 
 from tierpsy.helper.params import min_num_skel_defaults
@@ -133,22 +136,87 @@ def _h_readFeat2Check(skeletons_file, valid_index=-1):
     return worm_morph, head_widths, tail_widths, head_widthsL, tail_widthsL
 
 
-def _h_getMahalanobisRobust(dat, critical_alpha=0.01, good_rows=np.zeros(0)):
-    '''Calculate the Mahalanobis distance from the sample vector.'''
-    if good_rows.size == 0:
-        good_rows = np.any(~np.isnan(dat), axis=1)
+def _h_sampleStratified(
+        trajectories_data,
+        good_skel_row,
+        max_rows_fit,
+        n_time_blocks=10,
+        seed=0):
+    '''
+    Select a random subsample of at most max_rows_fit rows from good_skel_row stratified by worm
+    and time block. Each stratum contributes proportionally to its size, and all the strata are
+    represented if max_rows_fit is larger than the number of strata.
+    '''
+    if max_rows_fit <= 0 or good_skel_row.size <= max_rows_fit:
+        return good_skel_row
+
+    rng = np.random.RandomState(seed)
+    rows = rng.permutation(good_skel_row)
+
+    worm_ids = trajectories_data['worm_index_joined'].values[rows].astype(np.int64)
+    frames = trajectories_data['frame_number'].values[rows].astype(np.int64)
+    frames = frames - frames.min()
+    time_block = frames * n_time_blocks // (frames.max() + 1)
 
+    _, strata, strata_size = np.unique(worm_ids * n_time_blocks + time_block,
+                                       return_inverse=True, return_counts=True)
+
+    # position of each row inside its stratum (the rows were already shuffled)
+    order = np.argsort(strata, kind='stable')
+    strata_ini = np.cumsum(strata_size) - strata_size
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.size) - strata_ini[strata[order]]
+
+    frac_rank = rank / strata_size[strata]
+    selected = rows[np.argsort(frac_rank, kind='stable')[:max_rows_fit]]
+    return np.sort(selected)
+
+
+def _h_fitRobustModel(dat, good_rows):
+    '''
+    Fit the robust covariance using the rows in good_rows.
+    Return the (location, covariance) of the model or None if the fit failed.
+    '''
     try:
         dat2fit = dat[good_rows]
         assert not np.any(np.isnan(dat2fit))
 
         robust_cov = MinCovDet().fit(dat2fit)
-        mahalanobis_dist = np.sqrt(robust_cov.mahalanobis(dat))
+        return robust_cov.location_, robust_cov.covariance_
     except ValueError:
         # this step will fail if the covariance matrix is not singular. This happens if the data is not
-        # a unimodal symetric distribution. For example there is too many small noisy particles. Therefore
-        # I will take a safe option and return zeros in the mahalanobis
-        # distance if this is the case.
+        # a unimodal symetric distribution. For example there is too many small noisy particles.
+        return None
+
+
+def _h_getMahalanobisDist(dat, robust_model, chunk_size=100000):
+    '''Calculate the Mahalanobis distance to a (location, covariance) model in chunks of rows.'''
+    location, covariance = robust_model
+    precision = pinvh(covariance, check_finite=False)
+
+    mahalanobis_dist = np.zeros(dat.shape[0])
+    for ini in range(0, dat.shape[0], chunk_size):
+        # rows with nan (not skeletonized) will have a nan distance
+        centered_obs = dat[ini:ini + chunk_size] - location
+        mahalanobis_dist[ini:ini + chunk_size] = np.sum(np.dot(centered_obs, precision) * centered_obs, 1)
+    return np.sqrt(mahalanobis_dist)
+
+
+def _h_getMahalanobisRobust(dat, critical_alpha=0.01, good_rows=np.zeros(0), robust_model=None):
+    '''
+    Calculate the Mahalanobis distance from the sample vector.
+    The robust covariance is fitted using good_rows unless a robust_model is given.
+    '''
+    if robust_model is None:
+        if good_rows.size == 0:
+            good_rows = np.any(~np.isnan(dat), axis=1)
+        robust_model = _h_fitRobustModel(dat, good_rows)
+
+    if robust_model is not None:
+        mahalanobis_dist = _h_getMahalanobisDist(dat, robust_model)
+    else:
+        # If the fit failed I will take a safe option and return zeros in the mahalanobis
+        # distance.
         mahalanobis_dist = np.zeros(dat.shape[0])
 
     # critial distance of the maholanobis distance using the chi-square distirbution
@@ -157,7 +225,38 @@ def _h_getMahalanobisRobust(dat, critical_alpha=0.01, good_rows=np.zeros(0)):
     maha_lim = chi2.ppf(1 - critical_alpha, dat.shape[1])
     outliers = mahalanobis_dist > maha_lim
 
-    return mahalanobis_dist, outliers, maha_lim
+    return mahalanobis_dist, outliers, maha_lim, robust_model
+
+
+def _h_savePopulationModel(model_file, nodes4fit, robust_models):
+    '''
+    Save the robust models of each set of features in a json file. The models are written into a
+    temporary file that is then moved, so videos processed in parallel never read a partial file.
+    '''
+    assert all(x is not None for x in robust_models)
+    models = [{'location':x[0].tolist(), 'covariance':x[1].tolist()} for x in robust_models]
+    
+    fd, tmp_file = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(model_file)))
+    try:
+        with os.fdopen(fd, 'w') as fid:
+            json.dump({'features':nodes4fit, 'models':models}, fid, indent=4)
+        os.replace(tmp_file, model_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def _h_readPopulationModel(model_file, nodes4fit):
+    '''Read the robust models saved by _h_savePopulationModel.'''
+    with open(model_file, 'r') as fid:
+        dat = json.load(fid)
+
+    if dat['features'] != nodes4fit:
+        raise ValueError('The population model {} was calculated using the features {} instead of {}.'.format(
+            model_file, dat['features'], nodes4fit))
+
+    return [None if x is None else (np.array(x['location']), np.array(x['covariance']))
+            for x in dat['models']]
 
 
 def _h_getPerpContourInd(
@@ -207,10 +306,218 @@ def _h_calcArea(cnt):
     signed_area = np.sum(cnt[:-1, 0] * cnt[1:, 1] - cnt[1:, 0] * cnt[:-1, 1])
     return np.abs(signed_area / 2)
 
+
+def _h_isGoodSkelRow(
+        skeleton,
+        contour_side1,
+        contour_side2,
+        contour_width,
+        max_width_ratio=2.25,
+        max_area_ratio=6):
+    '''
+    Row by row version of _h_isGoodSkelArray. It is not used by filterPossibleCoils,
+    but it is kept as the reference implementation of the coil filters.
+    '''
+    sample_N = contour_width.size
+    ht_limits = int(round(sample_N / 6))
+
+    head_w = contour_width[ht_limits]
+    tail_w = contour_width[-ht_limits]
+    midbody_w = np.max(contour_width)
+    if midbody_w / head_w > max_width_ratio or midbody_w / \
+            tail_w > max_width_ratio or max(head_w / tail_w, tail_w / head_w) > max_width_ratio:
+        return False
+
+    head_skel_lim = skeleton[np.newaxis, ht_limits]
+    tail_skel_lim = skeleton[np.newaxis, -ht_limits]
+
+    cnt_side1_ind_h, cnt_side2_ind_h = _h_getPerpContourInd(
+        skeleton, ht_limits, contour_side1, contour_side2, contour_width)
+    cnt_side1_ind_t, cnt_side2_ind_t = _h_getPerpContourInd(
+        skeleton, -ht_limits, contour_side1, contour_side2, contour_width)
+
+    if cnt_side1_ind_h > cnt_side1_ind_t or cnt_side2_ind_h > cnt_side2_ind_t or \
+    np.any(np.isnan([cnt_side1_ind_h, cnt_side2_ind_h, cnt_side1_ind_t, cnt_side2_ind_t])):
+        return False
+
+    cnt_head = np.concatenate((contour_side1[:cnt_side1_ind_h + 1], head_skel_lim,
+                               contour_side2[:cnt_side2_ind_h + 1][::-1]))
+    cnt_tail = np.concatenate((contour_side2[cnt_side2_ind_t:][::-1], tail_skel_lim,
+                               contour_side1[cnt_side1_ind_t:]))
+    area_head = _h_calcArea(cnt_head)
+    area_tail = _h_calcArea(cnt_tail)
+    if area_tail == 0 or area_head == 0 or area_head / \
+            area_tail > max_width_ratio or area_tail / area_head > max_width_ratio:
+        return False
+
+    cnt_rest = np.concatenate((head_skel_lim,
+                               contour_side1[cnt_side1_ind_h:cnt_side1_ind_t + 1],
+                               tail_skel_lim,
+                               contour_side2[cnt_side2_ind_h:cnt_side2_ind_t + 1][::-1],
+                               head_skel_lim))
+    area_rest = _h_calcArea(cnt_rest)
+    return not area_rest / (area_head + area_tail) > max_area_ratio
+
+def _h_getPerpContourIndArray(
+        skeletons,
+        skel_ind,
+        contour_side1,
+        contour_side2,
+        max_width_squared):
+    '''
+    Vectorized version of _h_getPerpContourInd for a block of skeletons.
+    Return the contour indexes and a flag that is True if no valid point was found.
+    '''
+    dR = skeletons[:, skel_ind + 1] - skeletons[:, skel_ind - 1]
+    a = -dR[:, 0:1]
+    b = +dR[:, 1:2]
+
+    skel_p = skeletons[:, skel_ind]
+    c = b * skel_p[:, 1:2] - a * skel_p[:, 0:1]
+
+    cnt_inds = []
+    is_invalid = np.zeros(skeletons.shape[0], bool)
+    for contour_side in (contour_side1, contour_side2):
+        dist2cnt = np.sum((contour_side - skel_p[:, np.newaxis, :])**2, axis=2)
+        d = np.abs(a * contour_side[..., 0] - b * contour_side[..., 1] + c)
+        d[dist2cnt > max_width_squared[:, np.newaxis]] = np.nan
+
+        # equivalent to a row by row np.nanargmin
+        bad = np.isnan(d)
+        is_invalid |= np.all(bad, axis=1)
+        d[bad] = np.inf
+        cnt_inds.append(np.argmin(d, axis=1))
+
+    return cnt_inds[0], cnt_inds[1], is_invalid
+
+
+def _h_cross(p1, p2):
+    return p1[:, 0] * p2[:, 1] - p2[:, 0] * p1[:, 1]
+
+
+def _h_isGoodSkelArray(
+        skeletons,
+        contour_side1,
+        contour_side2,
+        contour_width,
+        max_width_ratio=2.25,
+        max_area_ratio=6):
+    '''
+    Apply the segworm coil filters to a block of skeletons.
+    Return a boolean array that is False if the skeleton is likely to be a coil.
+    '''
+    n_rows, sample_N = contour_width.shape
+    ht_limits = int(round(sample_N / 6))
+    rows = np.arange(n_rows)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # the idea is that when the worm coils and there is an skeletons, it is
+        # likely to be a cnonsequence of the head/tail protuding, therefore we can
+        # use the head/tail withd to get a good ratio of the worm width
+        head_w = contour_width[:, ht_limits]
+        tail_w = contour_width[:, -ht_limits]
+        midbody_w = np.max(contour_width, axis=1)
+
+        '''
+        Does the worm more than double its width from the head/tail?
+        Note: if the worm coils, its width will grow to more than
+        double that at the end of the head.
+        '''
+        is_good = ~((midbody_w / head_w > max_width_ratio) |
+                    (midbody_w / tail_w > max_width_ratio) |
+                    (head_w / tail_w > max_width_ratio) |
+                    (tail_w / head_w > max_width_ratio))
+
+        # get the contour points in a line perpendicular to the head/tail limits
+        max_width_squared = midbody_w**2
+        cnt_side1_ind_h, cnt_side2_ind_h, invalid_h = _h_getPerpContourIndArray(
+            skeletons, ht_limits, contour_side1, contour_side2, max_width_squared)
+        cnt_side1_ind_t, cnt_side2_ind_t, invalid_t = _h_getPerpContourIndArray(
+            skeletons, -ht_limits, contour_side1, contour_side2, max_width_squared)
+
+        is_good &= ~(invalid_h | invalid_t |
+                     (cnt_side1_ind_h > cnt_side1_ind_t) |
+                     (cnt_side2_ind_h > cnt_side2_ind_t))
+
+        # calculate the head, tail and body areas using the shoelace method
+        # (the polygons are not closed, like in _h_calcArea). The sums along each
+        # contour side are obtained from the cumulative sum of the cross products.
+        skeletons = skeletons.astype(np.float64)
+        contour_side1 = contour_side1.astype(np.float64)
+        contour_side2 = contour_side2.astype(np.float64)
+
+        cum_cross = []
+        for contour_side in (contour_side1, contour_side2):
+            cross_side = contour_side[:, :-1, 0] * contour_side[:, 1:, 1] - \
+                         contour_side[:, 1:, 0] * contour_side[:, :-1, 1]
+            cum_side = np.zeros((n_rows, sample_N))
+            cum_side[:, 1:] = np.cumsum(cross_side, axis=1)
+            cum_cross.append(cum_side)
+        cum_side1, cum_side2 = cum_cross
+
+        head_skel_lim = skeletons[:, ht_limits]
+        tail_skel_lim = skeletons[:, -ht_limits]
+        p1_h = contour_side1[rows, cnt_side1_ind_h]
+        p2_h = contour_side2[rows, cnt_side2_ind_h]
+        p1_t = contour_side1[rows, cnt_side1_ind_t]
+        p2_t = contour_side2[rows, cnt_side2_ind_t]
+
+        # contour_side1[:h1+1], head_skel_lim, contour_side2[:h2+1][::-1]
+        area_head = cum_side1[rows, cnt_side1_ind_h] + \
+                    _h_cross(p1_h, head_skel_lim) + \
+                    _h_cross(head_skel_lim, p2_h) - \
+                    cum_side2[rows, cnt_side2_ind_h]
+        area_head = np.abs(area_head / 2)
+
+        # contour_side2[t2:][::-1], tail_skel_lim, contour_side1[t1:]
+        area_tail = -(cum_side2[:, -1] - cum_side2[rows, cnt_side2_ind_t]) + \
+                    _h_cross(p2_t, tail_skel_lim) + \
+                    _h_cross(tail_skel_lim, p1_t) + \
+                    (cum_side1[:, -1] - cum_side1[rows, cnt_side1_ind_t])
+        area_tail = np.abs(area_tail / 2)
+
+        # head_skel_lim, contour_side1[h1:t1+1], tail_skel_lim, contour_side2[h2:t2+1][::-1], head_skel_lim
+        area_rest = _h_cross(head_skel_lim, p1_h) + \
+                    (cum_side1[rows, cnt_side1_ind_t] - cum_side1[rows, cnt_side1_ind_h]) + \
+                    _h_cross(p1_t, tail_skel_lim) + \
+                    _h_cross(tail_skel_lim, p2_t) - \
+                    (cum_side2[rows, cnt_side2_ind_t] - cum_side2[rows, cnt_side2_ind_h]) + \
+                    _h_cross(p2_h, head_skel_lim)
+        area_rest = np.abs(area_rest / 2)
+
+        '''Is the tail too small (or the head too large)?
+        Note: the area of the head and tail should be roughly the same size.
+        A 2-fold difference is huge!
+        '''
+        is_good &= ~((area_tail == 0) | (area_head == 0) |
+                     (area_head / area_tail > max_width_ratio) |
+                     (area_tail / area_head > max_width_ratio))
+
+        '''
+        Are the head and tail too small (or the body too large)?
+        Note: earlier, the head and tail were each chosen to be 4/24 = 1/6
+        the body length of the worm. The head and tail are roughly shaped
+        like rounded triangles with a convex taper. And, the width at their
+        ends is nearly the width at the center of the worm. Imagine they were
+        2 triangles that, when combined, formed a rectangle similar to the
+        midsection of the worm. The area of this rectangle would be greater
+        than a 1/6 length portion from the midsection of the worm (the
+        maximum area per length in a worm is located at its midsection). The
+        combined area of the right and left sides is 4/6 of the worm.
+        Therefore, the combined area of the head and tail must be greater
+        than (1/6) / (4/6) = 1/4 the combined area of the left and right
+        sides.
+        '''
+        is_good &= ~(area_rest / (area_head + area_tail) > max_area_ratio)
+
+    return is_good
+
+
 def filterPossibleCoils(
         skeletons_file,
         max_width_ratio=2.25,
-        max_area_ratio=6):
+        max_area_ratio=6,
+        chunk_size=10000):
     with pd.HDFStore(skeletons_file, 'r') as table_fid:
         trajectories_data = table_fid['/trajectories_data']
 
@@ -218,7 +525,7 @@ def filterPossibleCoils(
         is_good_skel = trajectories_data['has_skeleton'].values.copy()
     else:
         is_good_skel = trajectories_data['is_good_skel'].values.copy()
-    
+
     tot_skeletons = len(is_good_skel)
     with tables.File(skeletons_file, 'r') as ske_file_id:
 
@@ -227,132 +534,23 @@ def filterPossibleCoils(
         contour_side2s = ske_file_id.get_node('/contour_side2')
         contour_widths = ske_file_id.get_node('/contour_width')
 
-        sample_N = contour_widths.shape[1]
-
-        ht_limits = int(round(sample_N / 6))
-        mid_limits = (int(round(3 * sample_N / 6)),
-                      int(round(4 * sample_N / 6)) + 1)
-
-        for skel_id in range(tot_skeletons):
-            if is_good_skel[skel_id] == 0:
-                continue
-
-            contour_width = contour_widths[skel_id]
-            contour_side1 = contour_side1s[skel_id]
-            contour_side2 = contour_side2s[skel_id]
-            skeleton = skeletons[skel_id]
-
-
-            #%%
-            edge_length = 8
-            p1 = contour_side1[:-edge_length]
-            p2 = contour_side1[edge_length:]
-
-            points = contour_side1[edge_length // 2:-edge_length // 2]
-            ang2 = np.arctan2(points[:, 0] - p2[:, 0], points[:, 1] - p2[:, 1])
-            ang1 = np.arctan2(p1[:, 0] - points[:, 0], p1[:, 1] - points[:, 1])
-            angles = ang2 - ang1
-
-            for i in range(angles.size):
-                if angles[i] > np.pi:
-                    angles[i] = angles[i] - 2 * np.pi
-                elif angles[i] < -np.pi:
-                    angles[i] = angles[i] + 2 * np.pi
-            angles = angles * 180 / np.pi
-
-            blurWin = np.full(edge_length, 1. / edge_length)
-            anglesb = np.convolve(angles, blurWin, 'same')
-            #%%
-            # the idea is that when the worm coils and there is an skeletons, it is
-            # likely to be a cnonsequence of the head/tail protuding, therefore we can
-            # use the head/tail withd to get a good ratio of the worm width
-
-            # calculate head and tail width
-            head_w = contour_width[ht_limits]
-            tail_w = contour_width[-ht_limits]
-            midbody_w = np.max(contour_width)
-
-            '''
-            Does the worm more than double its width from the head/tail?
-            Note: if the worm coils, its width will grow to more than
-            double that at the end of the head.
-            '''
-            if midbody_w / head_w > max_width_ratio or midbody_w / \
-                    tail_w > max_width_ratio or max(head_w / tail_w, tail_w / head_w) > max_width_ratio:
-                is_good_skel[skel_id] = 0
+        # read the data in contiguous blocks and only check the rows that are still valid
+        for ini in range(0, tot_skeletons, chunk_size):
+            fin = min(ini + chunk_size, tot_skeletons)
+            valid = np.flatnonzero(is_good_skel[ini:fin])
+            if valid.size == 0:
                 continue
 
-            # calculate the head and tail area (it is an approximation the
-            # limits are not super well defined, but it is enough for
-            # filtering)
-            head_skel_lim = skeleton[np.newaxis, ht_limits]
-            tail_skel_lim = skeleton[np.newaxis, -ht_limits]
+            is_good = _h_isGoodSkelArray(
+                skeletons[ini:fin][valid],
+                contour_side1s[ini:fin][valid],
+                contour_side2s[ini:fin][valid],
+                contour_widths[ini:fin][valid],
+                max_width_ratio=max_width_ratio,
+                max_area_ratio=max_area_ratio)
 
-            cnt_side1_ind_h, cnt_side2_ind_h = _h_getPerpContourInd(
-                skeleton, ht_limits, contour_side1, contour_side2, contour_width)
-            cnt_side1_ind_t, cnt_side2_ind_t = _h_getPerpContourInd(
-                skeleton, -ht_limits, contour_side1, contour_side2, contour_width)
+            is_good_skel[ini + valid[~is_good]] = 0
 
-            if cnt_side1_ind_h > cnt_side1_ind_t or cnt_side2_ind_h > cnt_side2_ind_t or \
-            np.any(np.isnan([cnt_side1_ind_h, cnt_side2_ind_h, cnt_side1_ind_t, cnt_side2_ind_t])):    
-                is_good_skel[skel_id] = 0
-                continue
-            
-            # if cnt_side1_ind_h>cnt_side1_ind_t:
-            #    cnt_side1_ind_h, cnt_side1_ind_t = cnt_side1_ind_t, cnt_side1_ind_h
-            # if cnt_side2_ind_h>cnt_side2_ind_t:
-            #    cnt_side2_ind_h, cnt_side2_ind_t = cnt_side2_ind_t, cnt_side2_ind_h
-
-            cnt_head = np.concatenate((contour_side1[:cnt_side1_ind_h + 1], head_skel_lim,
-                                           contour_side2[:cnt_side2_ind_h + 1][::-1]))
-
-            cnt_tail = np.concatenate(
-                (contour_side2[cnt_side2_ind_t:][::-1],
-                    tail_skel_lim,
-                    contour_side1[cnt_side1_ind_t:]))
-
-            area_head = _h_calcArea(cnt_head)
-            area_tail = _h_calcArea(cnt_tail)
-
-            '''Is the tail too small (or the head too large)?
-            Note: the area of the head and tail should be roughly the same size.
-            A 2-fold difference is huge!
-            '''
-            if area_tail == 0 or area_head == 0 or area_head / \
-                    area_tail > max_width_ratio or area_tail / area_head > max_width_ratio:
-                is_good_skel[skel_id] = 0
-                continue
-
-            # calculate the area of the rest of the body
-            cnt_rest = np.concatenate(
-                (head_skel_lim,
-                 contour_side1[
-                     cnt_side1_ind_h:cnt_side1_ind_t + 1],
-                    tail_skel_lim,
-                    contour_side2[
-                     cnt_side2_ind_h:cnt_side2_ind_t + 1][
-                     ::-1],
-                    head_skel_lim))
-            area_rest = _h_calcArea(cnt_rest)
-
-            '''
-            Are the head and tail too small (or the body too large)?
-            Note: earlier, the head and tail were each chosen to be 4/24 = 1/6
-            the body length of the worm. The head and tail are roughly shaped
-            like rounded triangles with a convex taper. And, the width at their
-            ends is nearly the width at the center of the worm. Imagine they were
-            2 triangles that, when combined, formed a rectangle similar to the
-            midsection of the worm. The area of this rectangle would be greater
-            than a 1/6 length portion from the midsection of the worm (the
-            maximum area per length in a worm is located at its midsection). The
-            combined area of the right and left sides is 4/6 of the worm.
-            Therefore, the combined area of the head and tail must be greater
-            than (1/6) / (4/6) = 1/4 the combined area of the left and right
-            sides.
-            '''
-            if area_rest / (area_head + area_tail) > max_area_ratio:
-                is_good_skel[skel_id] = 0
-                continue
     trajectories_data['is_good_skel'] = is_good_skel
     save_modified_table(skeletons_file, trajectories_data, 'trajectories_data')
 
@@ -397,7 +595,14 @@ def _addMissingFields(skeletons_file):
             width_midbody = np.median(contour_width[:, midbody_ind[0]:midbody_ind[1]+1], axis=1)
             fid.create_carray('/', "width_midbody", obj=width_midbody, filters=TABLE_FILTERS)
 
-def filterByPopulationMorphology(skeletons_file, good_skel_row, critical_alpha=0.01):
+def filterByPopulationMorphology(
+        skeletons_file,
+        good_skel_row,
+        critical_alpha=0.01,
+        max_rows_fit=0,
+        fit_time_blocks=10,
+        fit_seed=0,
+        population_model=''):
     base_name = get_base_name(skeletons_file)
     progress_timer = TimeCounter('')
 
@@ -426,6 +631,25 @@ def filterByPopulationMorphology(skeletons_file, good_skel_row, critical_alpha=0
 
         #feats4fit = _h_readFeat2Check(skeletons_file)
 
+        robust_models = None
+        if population_model and os.path.exists(population_model):
+            # skip the fitting and use a model calculated in other videos
+            robust_models = _h_readPopulationModel(population_model, nodes4fit)
+            assert len(robust_models) == len(feats4fit)
+            if any(x is None for x in robust_models):
+                # the file was saved after a failed fit, fit the video instead
+                robust_models = None
+        
+        if robust_models is not None:
+            rows2fit = good_skel_row
+        else:
+            robust_models = [None]*len(feats4fit)
+            rows2fit = _h_sampleStratified(trajectories_data,
+                                           good_skel_row,
+                                           max_rows_fit,
+                                           n_time_blocks=fit_time_blocks,
+                                           seed=fit_seed)
+
         print_flush(
             base_name +
             ' Filter Skeletons: Calculating outliers. Total time:' +
@@ -439,13 +663,19 @@ def filterByPopulationMorphology(skeletons_file, good_skel_row, critical_alpha=0
         assert len(feats4fit) < 64  # otherwise the outlier flag will not work
 
         for out_ind, dat in enumerate(feats4fit):
-            maha, out_d, lim_d = _h_getMahalanobisRobust(
-                dat, critical_alpha, good_skel_row)
+            maha, out_d, lim_d, robust_models[out_ind] = _h_getMahalanobisRobust(
+                dat, critical_alpha, rows2fit, robust_models[out_ind])
             outliers_rob = outliers_rob | out_d
 
             # flag the outlier flag by turning on the corresponding bit
             outliers_flag += (out_d) * (2**out_ind)
 
+        if population_model and not os.path.exists(population_model):
+            if any(x is None for x in robust_models):
+                print_flush(base_name + ' Filter Skeletons: The robust fit failed. The population model is not saved.')
+            else:
+                _h_savePopulationModel(population_model, nodes4fit, robust_models)
+
         print_flush(
             base_name +
             ' Filter Skeletons: Labeling valid skeletons. Total time:' +
@@ -471,7 +701,11 @@ def getFilteredSkels(
         min_displacement=5,
         critical_alpha=0.01,
         max_width_ratio=2.25,
-        max_area_ratio=6):
+        max_area_ratio=6,
+        max_rows_fit=0,
+        fit_time_blocks=10,
+        fit_seed=0,
+        population_model=''):
 
     min_num_skel = min_num_skel_defaults(skeletons_file, min_num_skel=min_num_skel)
 
@@ -497,5 +731,9 @@ def getFilteredSkels(
     filterByPopulationMorphology(
         skeletons_file,
         good_skel_row,
-        critical_alpha=critical_alpha)
+        critical_alpha=critical_alpha,
+        max_rows_fit=max_rows_fit,
+        fit_time_blocks=fit_time_blocks,
+        fit_seed=fit_seed,
+        population_model=population_model)
 
@@ -11,6 +11,7 @@ def _get_head_tail_param(p):
 def args_(fn, param):
     argkws_d = _get_head_tail_param(param.p_dict)
     argkws_d['skeletons_file'] = fn['skeletons']
+    argkws_d['n_cores_used'] = param.p_dict['n_cores_used']
 
     #arguments used by AnalysisPoints.py
     return {
@@ -7,13 +7,14 @@ Created on Wed May 13 19:35:04 2015
 
 import os
 import sys
+import multiprocessing as mp
+from functools import partial
 
 import numpy as np
 import pandas as pd
 import tables
 
 from tierpsy.helper.params import head_tail_defaults
-from tierpsy.analysis.ske_orient.WormClass import WormClass
 from tierpsy.helper.misc import TimeCounter, print_flush
 
 
@@ -141,7 +142,43 @@ def isWormHTSwitched(skeletons, segment4angle, max_gap_allowed,
     return is_switch_skel, roll_std
 
 
-def correctHeadTail(skeletons_file, **params):
+def _getSwitchedSkels(skeletons, **ht_params):
+    # wrapper to only return the switched flags (used by the process pool)
+    is_switched_skel, _ = isWormHTSwitched(skeletons, **ht_params)
+    return is_switched_skel
+
+
+def _switchHeadTail(worm_data, is_switched):
+    '''
+    Same as WormClass.switchHeadTail but using a dictionary with the worm data.
+    '''
+    for field in ['skeleton', 'contour_side1', 'contour_side2', 'contour_width']:
+        worm_data[field][is_switched] = worm_data[field][is_switched, ::-1]
+
+    # contours must be switched to keep the same clockwise orientation
+    worm_data['contour_side1'][is_switched], worm_data['contour_side2'][is_switched] = \
+        worm_data['contour_side2'][is_switched], worm_data['contour_side1'][is_switched]
+
+
+def _getWormsChunks(rows_indexes, max_chunk_rows):
+    '''
+    Group the worms in chunks of contiguous rows with at most max_chunk_rows
+    (unless a single worm is larger). Return a list of (ini, end, [(worm_index, w_ini, w_end), ...]).
+    '''
+    chunks = []
+    worms_in_chunk = []
+    for worm_index, w_ini, w_end in zip(rows_indexes.index, rows_indexes['min'], rows_indexes['max']):
+        if worms_in_chunk and w_end - worms_in_chunk[0][1] + 1 > max_chunk_rows:
+            chunks.append(worms_in_chunk)
+            worms_in_chunk = []
+        worms_in_chunk.append((worm_index, w_ini, w_end))
+    if worms_in_chunk:
+        chunks.append(worms_in_chunk)
+
+    return [(min(x[1] for x in worms), max(x[2] for x in worms), worms) for worms in chunks]
+
+
+def correctHeadTail(skeletons_file, n_cores_used=1, max_chunk_rows=100000, **params):
     '''
     Correct Head Tail orientation using skeleton movement. Head must move more than the tail (have a higher rolling standar deviation). This might fail if the amount of contingously skeletonized frames is too little (a few seconds). Head must be in the first position of the single frame skeleton array, while the tail must be in the last.
 
@@ -149,6 +186,8 @@ def correctHeadTail(skeletons_file, **params):
     window_std - frame windows to calculate the standard deviation
     segment4angle - separation between skeleton segments to calculate the angles
     min_block_size - consider only around 10s intervals to determine if it is head or tail...
+    n_cores_used - if larger than one the orientation of each worm is calculated by a pool of processes.
+    max_chunk_rows - the skeletons file is read and written in chunks of contiguous rows containing several worms.
     '''
 
     params = head_tail_defaults(skeletons_file, **params)    
@@ -174,26 +213,66 @@ def correctHeadTail(skeletons_file, **params):
         if 'has_finished' in dir(skeleton_table._v_attrs):
             assert skeleton_table._v_attrs['has_finished'] >= 2
 
+    data_fields = [
+        'skeleton',
+        'skeleton_length',
+        'contour_side1',
+        'contour_side2',
+        'contour_width',
+        'contour_area']
+
+    worms_chunks = _getWormsChunks(rows_indexes.sort_values(by='min'), max_chunk_rows)
+    get_switched = partial(_getSwitchedSkels,
+                           segment4angle=segment4angle,
+                           max_gap_allowed=max_gap_allowed,
+                           window_std=window_std,
+                           min_block_size=min_block_size)
+
     progress_timer = TimeCounter('')
-    for ii, dat in enumerate(rows_indexes.iterrows()):
-        if ii % 10 == 0:
-            dd = " Correcting Head-Tail using worm movement. Worm %i of %i." % (
-                ii + 1, len(rows_indexes))
-            dd = base_name + dd + ' Total time:' + progress_timer.get_time_str()
-            print_flush(dd)
-
-        worm_index, row_range = dat
-        worm_data = WormClass(skeletons_file, worm_index,
-                              rows_range=(row_range['min'], row_range['max']))
-
-        if not np.all(np.isnan(worm_data.skeleton_length)):
-            is_switched_skel, roll_std = isWormHTSwitched(worm_data.skeleton,
-                                                          segment4angle=segment4angle, max_gap_allowed=max_gap_allowed,
-                                                          window_std=window_std, min_block_size=min_block_size)
-            worm_data.switchHeadTail(is_switched_skel)
-
-        worm_data.writeData()
-        #%%
+    p = mp.Pool(n_cores_used) if n_cores_used > 1 else None
+    try:
+        with tables.File(skeletons_file, "r+") as ske_file_id:
+            data_nodes = {field : ske_file_id.get_node('/' + field) for field in data_fields}
+
+            n_worms = 0
+            for ini, end, worms in worms_chunks:
+                dd = " Correcting Head-Tail using worm movement. Worm %i of %i." % (
+                    n_worms + 1, len(rows_indexes))
+                dd = base_name + dd + ' Total time:' + progress_timer.get_time_str()
+                print_flush(dd)
+                n_worms += len(worms)
+
+                chunk_data = {field : data_nodes[field][ini:end + 1] for field in data_fields}
+
+                worms_data = []
+                for worm_index, w_ini, w_end in worms:
+                    # views of the worm rows in the chunk
+                    worm_data = {field : val[w_ini - ini:w_end - ini + 1] for field, val in chunk_data.items()}
+
+                    # change invalid data zeros for np.nan
+                    invalid = worm_data['skeleton_length'] == 0
+                    for field in data_fields:
+                        worm_data[field][invalid] = np.nan
+
+                    if not np.all(np.isnan(worm_data['skeleton_length'])):
+                        worms_data.append(worm_data)
+
+                skeletons = [x['skeleton'] for x in worms_data]
+                if p is not None:
+                    switched_generator = p.imap(get_switched, skeletons)
+                else:
+                    switched_generator = map(get_switched, skeletons)
+
+                for worm_data, is_switched_skel in zip(worms_data, switched_generator):
+                    _switchHeadTail(worm_data, is_switched_skel)
+
+                for field in data_fields:
+                    data_nodes[field][ini:end + 1] = chunk_data[field]
+    finally:
+        if p is not None:
+            p.terminate()
+            p.join()
+
     print_flush(
         'Head-Tail correction using worm movement finished:' +
         progress_timer.get_time_str())
@@ -7,7 +7,9 @@ Created on Thu Apr  2 16:33:34 2015
 from pathlib import Path
 import json
 import multiprocessing as mp
+from multiprocessing import shared_memory
 import os
+from collections import deque
 from functools import partial
 
 import cv2
@@ -22,15 +24,43 @@ from tierpsy.helper.params import traj_create_defaults, read_unit_conversions, r
 from tierpsy.helper.misc import TimeCounter, print_flush, TABLE_FILTERS
 
 
+def _otsu_hist(pix_hist):
+    '''
+    Otsu threshold calculated from the histogram of integer pixel values (pix_hist[i] is 
+    the number of pixels with value i). Same result as skimage.filters.threshold_otsu.
+    '''
+    valid_bins = np.nonzero(pix_hist)[0]
+    if valid_bins.size == 0:
+        raise ValueError('There are no pixels in the histogram.')
+    
+    ini, fin = valid_bins[0], valid_bins[-1] + 1
+    if fin - ini == 1:
+        #only one value
+        return ini
+    
+    counts = pix_hist[ini:fin].astype(np.float32)
+    bin_centers = np.arange(ini, fin)
+
+    weight1 = np.cumsum(counts)
+    weight2 = np.cumsum(counts[::-1])[::-1]
+    mean1 = np.cumsum(counts * bin_centers) / weight1
+    mean2 = (np.cumsum((counts * bin_centers)[::-1]) / weight2[::-1])[::-1]
+    variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+
+    return bin_centers[np.argmax(variance12)]
+
 def _thresh_bw(pix_valid):
+    return _thresh_bw_hist(np.bincount(pix_valid))
+
+def _thresh_bw_hist(pix_hist):
     # calculate otsu_threshold as lower limit. Otsu understimates the threshold.
     try:
-        otsu_thresh = skf.threshold_otsu(pix_valid)
+        otsu_thresh = _otsu_hist(pix_hist)
     except:
         return np.nan
 
-    # calculate the histogram
-    pix_hist = np.bincount(pix_valid)
+    # calculate the histogram (same as np.bincount of the valid pixels)
+    pix_hist = pix_hist[:np.nonzero(pix_hist)[0][-1] + 1]
 
     # the higher limit is the most frequent value in the distribution
     # (background)
@@ -57,37 +87,63 @@ def _thresh_bw(pix_valid):
     return thresh
 
 def _thresh_bodywallmuscle(pix_valid):
-    pix_mean = np.mean(pix_valid)
-    pix_median = np.median(pix_valid)
+    return _thresh_bodywallmuscle_hist(np.bincount(pix_valid, minlength = 256))
+
+def _hist_median(pix_hist):
+    #same as np.median of the pixels in the histogram
+    n_pix = pix_hist.sum()
+    cumhist = np.cumsum(pix_hist)
+    val_high = np.searchsorted(cumhist, n_pix//2, side='right')
+    if n_pix % 2 == 1:
+        return float(val_high)
+    val_low = np.searchsorted(cumhist, n_pix//2 - 1, side='right')
+    return (val_low + val_high)/2
+
+def _thresh_bodywallmuscle_hist(pix_hist):
+    pix_mean = np.sum(pix_hist*np.arange(pix_hist.size))/pix_hist.sum()
+    pix_median = _hist_median(pix_hist)
     # when fluorescent worms are present, the distribution of pixels should be asymmetric, with a peak at low values corresponding to the background
     if pix_mean > pix_median*1.1: # alternatively, could use scipy.stats.skew and some threshold, like >1/2
         thresh = pix_mean
     else: # try usual thresholding otherwise
-        thresh = 255 - _thresh_bw(255 - pix_valid) #correct for fluorescence images
+        thresh = 255 - _thresh_bw_hist(pix_hist[255::-1]) #correct for fluorescence images
     return thresh
 
+def _buffer_hist(ROI_buffer):
+    #histogram of the pixels values. The zeros (pixels outside the mask) are not counted.
+    #calcHist does not need to copy the (non contiguous) ROI views as np.bincount
+    pix_hist = np.zeros(256, np.int64)
+    for img in ROI_buffer:
+        pix_hist += cv2.calcHist([img], [0], None, [256], [0, 256])[:, 0].astype(np.int64)
+    pix_hist[0] = 0
+    return pix_hist
+
 def getBufferThresh(ROI_buffer, worm_bw_thresh_factor, is_light_background, analysis_type):
     ''' calculate threshold using the nonzero pixels.  Using the
      buffer instead of a single image, improves the threshold
      calculation, since better statistics are recovered'''
      
+    if analysis_type == "ZEBRAFISH":
+        # Override threshold
+        return 255
+    return getHistThresh(_buffer_hist(ROI_buffer), worm_bw_thresh_factor, is_light_background, analysis_type)
+
+def getHistThresh(pix_hist, worm_bw_thresh_factor, is_light_background, analysis_type):
+    ''' same as getBufferThresh but using the histogram of the nonzero pixels '''
     if analysis_type == "ZEBRAFISH":
         # Override threshold
         thresh = 255
     else: 
-        pix_valid = ROI_buffer[ROI_buffer != 0]
-
-
-        if pix_valid.size > 0:
+        if pix_hist.sum() > 0:
             if is_light_background:
-                thresh = _thresh_bw(pix_valid)
+                thresh = _thresh_bw_hist(pix_hist)
             else:
                 if analysis_type == "WORM":
-                    thresh = _thresh_bodywallmuscle(pix_valid)
+                    thresh = _thresh_bodywallmuscle_hist(pix_hist)
                 else:
                     #correct for fluorescence images
                     MAX_PIX = 255 #for uint8 images
-                    thresh = _thresh_bw(MAX_PIX - pix_valid)
+                    thresh = _thresh_bw_hist(pix_hist[MAX_PIX::-1])
                     thresh = MAX_PIX - thresh
 
             thresh *= worm_bw_thresh_factor
@@ -97,6 +153,48 @@ def getBufferThresh(ROI_buffer, worm_bw_thresh_factor, is_light_background, anal
     return thresh
 
 
+class ThreshCache():
+    '''
+    Reuse the threshold calculated for an ROI in the previous buffer if the new ROI overlaps
+    with it and its pixel histogram is similar to the one used to calculate the threshold.
+    The histogram distance is the fraction of pixels that would need to change value 
+    (total variation distance between the normalized histograms).
+    '''
+    def __init__(self, max_hist_dist, min_overlap = 0.5):
+        self.max_hist_dist = max_hist_dist
+        self.min_overlap = min_overlap
+        self.prev_rois = []
+        self.curr_rois = []
+    
+    @staticmethod
+    def _bbox_overlap(bbox1, bbox2):
+        #intersection over union of two (x, y, w, h) bounding boxes
+        w = min(bbox1[0] + bbox1[2], bbox2[0] + bbox2[2]) - max(bbox1[0], bbox2[0])
+        h = min(bbox1[1] + bbox1[3], bbox2[1] + bbox2[3]) - max(bbox1[1], bbox2[1])
+        if w <= 0 or h <= 0:
+            return 0.
+        inter = w*h
+        return inter/(bbox1[2]*bbox1[3] + bbox2[2]*bbox2[3] - inter)
+    
+    def get(self, ROI_bbox, pix_hist, thresh_func):
+        n_pix = pix_hist.sum()
+        for prev_bbox, prev_hist, prev_thresh in self.prev_rois:
+            if n_pix > 0 and self._bbox_overlap(ROI_bbox, prev_bbox) >= self.min_overlap:
+                hist_dist = 0.5*np.abs(pix_hist/n_pix - prev_hist/prev_hist.sum()).sum()
+                if hist_dist <= self.max_hist_dist:
+                    #keep the original histogram, otherwise small changes could accumulate over time
+                    self.curr_rois.append((ROI_bbox, prev_hist, prev_thresh))
+                    return prev_thresh
+        
+        thresh = thresh_func(pix_hist)
+        if n_pix > 0:
+            self.curr_rois.append((ROI_bbox, pix_hist, thresh))
+        return thresh
+    
+    def next_buffer(self):
+        self.prev_rois, self.curr_rois = self.curr_rois, []
+
+
 def _remove_corner_blobs(ROI_image):
     #remove blobs specially in the corners that could be part of other ROI
     # get the border of the ROI mask, this will be used to filter for valid
@@ -171,6 +269,91 @@ def getBlobContours(ROI_image,
     return ROI_worms, hierarchy
 
 
+def _tile_stack(ROI_buffer, pad):
+    #stack the frames vertically separated by `pad` rows, so a whole ROI buffer 
+    #can be processed with a single opencv call
+    n_frames, roi_h, roi_w = ROI_buffer.shape
+    tiles = np.zeros((n_frames, roi_h + 2*pad, roi_w), ROI_buffer.dtype)
+    tiles[:, pad:pad+roi_h] = ROI_buffer
+    return tiles
+
+
+def getBlobContoursBatch(ROI_buffer, 
+                    thresh, 
+                    strel_size=(5, 5), 
+                    is_light_background=True, 
+                    analysis_type="WORM", 
+                    thresh_block_size=15,
+                    min_area=0):
+    '''
+    Equivalent to calling getBlobContours for each frame of ROI_buffer, but the frames are 
+    processed together as a tiled image. Returns a list with the contours of each frame.
+    Contours with an area smaller than min_area are discarded.
+    '''
+    n_frames, roi_h, roi_w = ROI_buffer.shape
+    if analysis_type == "PHARYNX" or n_frames == 0:
+        #the local otsu threshold cannot be tiled without artifacts
+        worms_per_frame = [getBlobContours(x, thresh, strel_size, is_light_background, analysis_type, thresh_block_size)[0] 
+                            for x in ROI_buffer]
+        return [[cnt for cnt in x if cv2.contourArea(cnt) >= min_area] for x in worms_per_frame]
+
+    do_close = np.all(strel_size)
+    #the padding must be larger than the median filter and structuring element radius
+    pad = max(1, max(strel_size)//2 + 1) if do_close else 1
+    tile_h = roi_h + 2*pad
+
+    tiles = _tile_stack(ROI_buffer, pad)
+    tiles_2d = tiles.reshape(-1, roi_w)
+    
+    #_remove_corner_blobs only changes the frames that have more than one region
+    ROI_valid = cv2.compare(tiles_2d, 0, cv2.CMP_NE)
+    ROI_regions, _ = cv2.findContours(ROI_valid, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2:]
+    n_regions = np.bincount([x[0, 0, 1]//tile_h for x in ROI_regions], minlength=n_frames)
+    for ii in np.where(n_regions > 1)[0]:
+        ini = ii*tile_h + pad
+        tiles_2d[ini:ini+roi_h] = _remove_corner_blobs(tiles_2d[ini:ini+roi_h])
+        ROI_valid[ini:ini+roi_h] = cv2.compare(tiles_2d[ini:ini+roi_h], 0, cv2.CMP_NE)
+    
+    #medianBlur uses a replicated border
+    tiles[:, :pad] = tiles[:, pad:pad+1]
+    tiles[:, pad+roi_h:] = tiles[:, pad+roi_h-1:pad+roi_h]
+    tiles_th = cv2.medianBlur(tiles_2d, 3)
+
+    #threshold using a look up table (ROI_valid is zero in the padding)
+    pix_vals = np.arange(256)
+    lut = (pix_vals < thresh) if is_light_background else (pix_vals >= thresh)
+    ROI_mask = cv2.LUT(tiles_th, lut.astype(np.uint8)*255)
+    ROI_mask = cv2.bitwise_and(ROI_mask, ROI_valid)
+
+    if do_close:
+        # the closing is done in two steps to emulate the border of morphologyEx, 
+        # where the pixels outside the image do not affect neither the dilation nor the erosion
+        strel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, strel_size)
+        ROI_mask = cv2.dilate(ROI_mask, strel).reshape(tiles.shape)
+        ROI_mask[:, :pad] = 255
+        ROI_mask[:, pad+roi_h:] = 255
+        ROI_mask = cv2.erode(ROI_mask.reshape(-1, roi_w), strel).reshape(tiles.shape)
+        ROI_mask[:, :pad] = 0
+        ROI_mask[:, pad+roi_h:] = 0
+    
+    ROI_worms, _ = cv2.findContours(ROI_mask.reshape(-1, roi_w), 
+                                       cv2.RETR_EXTERNAL, 
+                                       cv2.CHAIN_APPROX_NONE)[-2:]
+    
+    #assign each contour to its frame (in the same order findContours uses for a single frame)
+    worms_per_frame = [[] for _ in range(n_frames)]
+    for cnt in ROI_worms[::-1]:
+        #the area does not change with the translation, so filter before moving the contour
+        if cv2.contourArea(cnt) < min_area:
+            continue
+        frame_ind = cnt.item(1)//tile_h
+        cnt[..., 1] -= frame_ind*tile_h + pad
+        worms_per_frame[frame_ind].append(cnt)
+    worms_per_frame = [x[::-1] for x in worms_per_frame]
+    
+    return worms_per_frame
+
+
 def getBlobDimesions(worm_cnt, ROI_bbox):
     
     area = float(cv2.contourArea(worm_cnt))
@@ -250,24 +433,36 @@ def generateImages(masked_image_file,
     
     
 
-def generateROIBuff(masked_image_file, buffer_size, **argkws):
-    img_generator = generateImages(masked_image_file)
+def generateROIBuff(masked_image_file, buffer_size, image_buffers = None, **argkws):
+    '''
+    Yield the ROI contours of each buffer. If image_buffers (a list of preallocated 
+    (buffer_size, im_h, im_w) arrays) is given the buffers are filled in a round-robin
+    fashion instead of allocating a new array every time. The rest of the arguments
+    (e.g. progress_str) are passed to generateImages.
+    '''
+    img_generator = generateImages(masked_image_file, **argkws)
     
     with tables.File(masked_image_file, 'r') as mask_fid:
         tot_frames, im_h, im_w = mask_fid.get_node("/mask").shape
     
+    n_buff = 0
     for frame_number, image in img_generator:
         if frame_number % buffer_size == 0:
-            if frame_number + buffer_size > tot_frames:
-                buffer_size = tot_frames-frame_number #change this value, otherwise the buffer will not get full
-            image_buffer = np.zeros((buffer_size, im_h, im_w), np.uint8)
+            #the last buffer might not get full
+            n_frames = min(buffer_size, tot_frames - frame_number)
+            if image_buffers is None:
+                image_buffer = np.zeros((n_frames, im_h, im_w), np.uint8)
+            else:
+                #every frame is overwritten so there is no need to clear the buffer
+                image_buffer = image_buffers[n_buff % len(image_buffers)][:n_frames]
+                n_buff += 1
             ini_frame = frame_number            
         
         
         image_buffer[frame_number-ini_frame] = image
         
         #compress if it is the last frame in the buffer
-        if (frame_number+1) % buffer_size == 0 or (frame_number+1 == tot_frames):
+        if frame_number - ini_frame + 1 == n_frames:
             # z projection and select pixels as connected regions that were selected as worms at
             # least once in the masks
             main_mask = np.any(image_buffer, axis=0)
@@ -291,6 +486,9 @@ def generateROIBuff(masked_image_file, buffer_size, **argkws):
 def _cnt_to_ROIs(ROI_cnt, image_buffer, min_box_width):
     #get the corresponding ROI from the contours
     ROI_bbox = cv2.boundingRect(ROI_cnt)
+    return _bbox_to_ROIs(ROI_bbox, image_buffer, min_box_width)
+
+def _bbox_to_ROIs(ROI_bbox, image_buffer, min_box_width):
     # bounding box too small to be a worm - ROI_bbox[2] and [3] are width and height
     if ROI_bbox[2] > min_box_width and ROI_bbox[3] > min_box_width:
         # select ROI for all buffer slides 
@@ -319,42 +517,131 @@ def _cnt_to_props(ROI_worms, current_frame, thresh, min_area, ROI_bbox=(0,0,0,0)
     return props
 
 
-def getBlobsData(buff_data, blob_params):
+def getBlobsData(buff_data, blob_params, thresh_cache = None):
     #I packed input data to be able top to map the function into generateROIBuff
     ROI_cnts, image_buffer, frame_number = buff_data
+    ROI_bboxes = [cv2.boundingRect(x) for x in ROI_cnts]
+    ROI_threshs = _getROIThreshs(ROI_bboxes, image_buffer, blob_params, thresh_cache)
+    return _getBlobsDataBBoxes(ROI_bboxes, image_buffer, frame_number, blob_params, ROI_threshs)
+
+def _getROIThreshs(ROI_bboxes, image_buffer, blob_params, thresh_cache = None):
+    #calculate the threshold of each ROI (None if the ROI is too small)
+    is_light_background, _, min_box_width, worm_bw_thresh_factor, \
+    _, analysis_type, _ = blob_params
+    
+    thresh_func = partial(getHistThresh, 
+                          worm_bw_thresh_factor = worm_bw_thresh_factor, 
+                          is_light_background = is_light_background, 
+                          analysis_type = analysis_type)
+    ROI_threshs = []
+    for ROI_bbox in ROI_bboxes:
+        ROI_buffer, ROI_bbox = _bbox_to_ROIs(ROI_bbox, image_buffer, min_box_width)
+        if ROI_buffer is None:
+            thresh = None
+        elif thresh_cache is None:
+            thresh = getBufferThresh(ROI_buffer, worm_bw_thresh_factor, is_light_background, analysis_type)
+        else:
+            thresh = thresh_cache.get(ROI_bbox, _buffer_hist(ROI_buffer), thresh_func)
+        ROI_threshs.append(thresh)
     
+    if thresh_cache is not None:
+        thresh_cache.next_buffer()
+    return ROI_threshs
+
+def _getBlobsDataBBoxes(ROI_bboxes, image_buffer, frame_number, blob_params, ROI_threshs = None):
     is_light_background, min_area, min_box_width, worm_bw_thresh_factor, \
     strel_size, analysis_type, thresh_block_size = blob_params
     
+    if ROI_threshs is None:
+        ROI_threshs = _getROIThreshs(ROI_bboxes, image_buffer, blob_params)
+    
     blobs_data = []
     # examinate each region of interest
-    for ROI_cnt in ROI_cnts:
-        #get the corresponding ROI from the contours
-        ROI_buffer, ROI_bbox = _cnt_to_ROIs(ROI_cnt, image_buffer, min_box_width)
+    for ROI_bbox, thresh_buff in zip(ROI_bboxes, ROI_threshs):
+        #get the corresponding ROI from the bounding box
+        ROI_buffer, ROI_bbox = _bbox_to_ROIs(ROI_bbox, image_buffer, min_box_width)
         if ROI_buffer is not None:
-            # calculate threshold
-            thresh_buff = getBufferThresh(ROI_buffer, worm_bw_thresh_factor, is_light_background, analysis_type)
+            # get the contour of possible worms in all the frames of the buffer
+            worms_per_frame = getBlobContoursBatch(ROI_buffer, 
+                                                    thresh_buff, 
+                                                    strel_size, 
+                                                    is_light_background,
+                                                    analysis_type, 
+                                                    thresh_block_size,
+                                                    min_area)
             
-            for buff_ind in range(image_buffer.shape[0]):
-                curr_ROI = ROI_buffer[buff_ind, :, :]
-    
-                # get the contour of possible worms
-                ROI_worms, hierarchy = getBlobContours(curr_ROI, 
-                                                        thresh_buff, 
-                                                        strel_size, 
-                                                        is_light_background,
-                                                        analysis_type, 
-                                                        thresh_block_size)
+            for buff_ind, ROI_worms in enumerate(worms_per_frame):
                 current_frame = frame_number + buff_ind
-                
-                # make sure there are no holes in the contours. This shouldn't occur with the flag RETR_EXTERNAL
-                assert all([hierarchy[0][x][3] == -1 for x in range(len(ROI_worms))])
-                
                 blobs_data += _cnt_to_props(ROI_worms, current_frame, thresh_buff, min_area, ROI_bbox)
                 
     return blobs_data
 
 
+#shared memory buffers attached by each worker of the TRAJ_CREATE pool
+_shared_buffers = []
+
+def _initSharedBuffers(shm_names, buff_shape):
+    global _shared_buffers
+    #keep a reference of the SharedMemory objects, otherwise the memory is released
+    shms = [shared_memory.SharedMemory(name=x) for x in shm_names]
+    _shared_buffers = [(shm, np.ndarray(buff_shape, np.uint8, buffer=shm.buf)) for shm in shms]
+
+def _getBlobsDataShared(task, blob_params):
+    #the image buffer is read from the shared memory slot, only the ROI boxes are pickled
+    slot, n_frames, ROI_bboxes, ROI_threshs, frame_number = task
+    image_buffer = _shared_buffers[slot][1][:n_frames]
+    return _getBlobsDataBBoxes(ROI_bboxes, image_buffer, frame_number, blob_params, ROI_threshs)
+
+def _imapSharedBuffers(masked_image_file, buffer_size, blob_params, n_cores_used, n_slots = None, thresh_cache = None, progress_str = ''):
+    '''
+    Equivalent to imap(getBlobsData, generateROIBuff(...)) using a process pool, but the 
+    buffers are written into a pool of shared memory slots and the workers only receive 
+    the slot index and the ROI bounding boxes. The results are returned in reading order.
+    If a thresh_cache is given the thresholds are calculated here, so the cached 
+    values do not depend on the order the workers process the buffers.
+    '''
+    with tables.File(masked_image_file, 'r') as mask_fid:
+        _, im_h, im_w = mask_fid.get_node("/mask").shape
+    buff_shape = (buffer_size, im_h, im_w)
+
+    if n_slots is None:
+        #enough slots to keep all the workers busy while the next buffer is being read
+        n_slots = 2*n_cores_used + 1
+
+    shms = [shared_memory.SharedMemory(create=True, size=int(np.prod(buff_shape))) for _ in range(n_slots)]
+    try:
+        image_buffers = [np.ndarray(buff_shape, np.uint8, buffer=shm.buf) for shm in shms]
+        buff_generator = generateROIBuff(masked_image_file, buffer_size, image_buffers = image_buffers, progress_str = progress_str)
+        f_blob_data = partial(_getBlobsDataShared, blob_params = blob_params)
+
+        with mp.Pool(n_cores_used, 
+                     initializer = _initSharedBuffers, 
+                     initargs = ([x.name for x in shms], buff_shape)) as p:
+            pending = deque()
+            for ibuf, (ROI_cnts, image_buffer, ini_frame) in enumerate(buff_generator):
+                ROI_bboxes = [cv2.boundingRect(x) for x in ROI_cnts]
+                if thresh_cache is not None:
+                    ROI_threshs = _getROIThreshs(ROI_bboxes, image_buffer, blob_params, thresh_cache)
+                else:
+                    ROI_threshs = None
+                task = (ibuf % n_slots, image_buffer.shape[0], ROI_bboxes, ROI_threshs, ini_frame)
+                pending.append(p.apply_async(f_blob_data, (task,)))
+                
+                # The buffers are filled in a round-robin. Make sure the slot used by the next 
+                # buffer is not in use before the generator starts to overwrite it.
+                while len(pending) >= n_slots:
+                    yield pending.popleft().get()
+
+            while pending:
+                yield pending.popleft().get()
+    finally:
+        #the numpy views must be released before closing the shared memory
+        buff_generator = image_buffers = image_buffer = None
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+
 def getBlobsSimple(in_data, blob_params):
     frame_number, image = in_data
     min_area, worm_bw_thresh_factor, strel_size = blob_params
@@ -389,7 +676,8 @@ def getBlobsTable(masked_image_file,
                     analysis_type="WORM",
                     thresh_block_size=15,
                     n_cores_used = 1, 
-                    bgnd_param = {}):
+                    bgnd_param = {},
+                    thresh_cache_tol = 0):
     
     #correct strel if it is not a tuple or list
     if not isinstance(strel_size, (tuple,list)):
@@ -447,8 +735,8 @@ def getBlobsTable(masked_image_file,
         return plate_worms
     
     progress_str = ' Calculating trajectories.'
+    p = None
     if len(bgnd_param) == 0:
-        buff_generator = generateROIBuff(masked_image_file, buffer_size,  progress_str = progress_str)
         blob_params = (is_light_background,
                       min_area,
                       min_box_width,
@@ -457,7 +745,19 @@ def getBlobsTable(masked_image_file,
                       analysis_type,
                       thresh_block_size)
         
-        f_blob_data = partial(getBlobsData, blob_params = blob_params)
+        thresh_cache = ThreshCache(thresh_cache_tol) if thresh_cache_tol > 0 else None
+        if n_cores_used > 1:
+            #the image buffers are shared with the workers instead of being pickled
+            blobs_generator = _imapSharedBuffers(masked_image_file, 
+                                                 buffer_size, 
+                                                 blob_params, 
+                                                 n_cores_used, 
+                                                 thresh_cache = thresh_cache,
+                                                 progress_str = progress_str)
+        else:
+            buff_generator = generateROIBuff(masked_image_file, buffer_size,  progress_str = progress_str)
+            f_blob_data = partial(getBlobsData, blob_params = blob_params, thresh_cache = thresh_cache)
+            blobs_generator = map(f_blob_data, buff_generator)
         
     else:
         blob_params = (min_area,
@@ -468,17 +768,21 @@ def getBlobsTable(masked_image_file,
                                         progress_str = progress_str)
         f_blob_data = partial(getBlobsSimple, blob_params = blob_params)
     
+        if n_cores_used > 1:
+            p = mp.Pool(n_cores_used)
+            blobs_generator = p.imap(f_blob_data, buff_generator)
+        else:
+            blobs_generator = map(f_blob_data, buff_generator)
     
-    if n_cores_used > 1:
-        p = mp.Pool(n_cores_used)
-        blobs_generator = p.imap(f_blob_data, buff_generator)
-    else:
-        blobs_generator = map(f_blob_data, buff_generator)
-    
-    with tables.open_file(trajectories_file, mode='w') as traj_fid:
-        plate_worms = _ini_plate_worms(traj_fid, masked_image_file)
-        for ibuf, blobs_data in enumerate(blobs_generator):
-            if blobs_data:
-                plate_worms.append(blobs_data)
+    try:
+        with tables.open_file(trajectories_file, mode='w') as traj_fid:
+            plate_worms = _ini_plate_worms(traj_fid, masked_image_file)
+            for ibuf, blobs_data in enumerate(blobs_generator):
+                if blobs_data:
+                    plate_worms.append(blobs_data)
+    finally:
+        if p is not None:
+            p.terminate()
+            p.join()
              
   
\ No newline at end of file
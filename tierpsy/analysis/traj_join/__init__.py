@@ -9,6 +9,7 @@ def args_(fn, param):
         'min_track_size': 0,
         'max_frames_gap': p['traj_max_frames_gap'], 
         'area_ratio_lim': p['traj_area_ratio_lim'],
+        'link_method': p['traj_link_method'],
         'is_one_worm': param.is_one_worm,
         'is_WT2' : param.is_WT2
 		}
@@ -10,36 +10,192 @@ import os
 import numpy as np
 import pandas as pd
 import tables
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist
 
 from tierpsy.helper.misc import TimeCounter, print_flush, TABLE_FILTERS
 
-def assignBlobTraj(trajectories_file, max_allowed_dist=20, area_ratio_lim=(0.5, 2)):
+LINK_METHODS = ['ARGMIN', 'LINEAR_ASSIGNMENT']
+
+#number of rows of /plate_worms read at once
+DFLT_CHUNK_SIZE = 500000
+
+class _UnsortedFramesError(Exception):
+    pass
+
+def _iterFrameBlocks(tbl, chunk_size = DFLT_CHUNK_SIZE):
+    '''
+    Read /plate_worms in chunks and yield blocks of complete frames sorted by frame (and by row 
+    within a frame) together with their row indexes. It assumes the table was written in 
+    blocks of increasing frames (as TRAJ_CREATE does), so a frame is complete once it is smaller 
+    than all the frames of the last chunk read. Raises _UnsortedFramesError otherwise.
+    '''
+    pending = tbl.read(0, 0)
+    pending_rows = np.zeros(0, np.int64)
+    last_frame = -1
+    
+    def _sorted_block(good):
+        block, block_rows = pending[good], pending_rows[good]
+        order = np.lexsort((block_rows, block['frame_number']))
+        return block_rows[order], block[order]
+    
+    for ini in range(0, tbl.nrows, chunk_size):
+        chunk = tbl.read(ini, ini + chunk_size)
+        chunk_min = chunk['frame_number'].min()
+        if chunk_min <= last_frame:
+            raise _UnsortedFramesError
+        
+        pending = np.concatenate((pending, chunk))
+        pending_rows = np.concatenate((pending_rows, np.arange(ini, ini + chunk.size)))
+        
+        is_ready = pending['frame_number'] < chunk_min
+        if np.any(is_ready):
+            block_rows, block = _sorted_block(is_ready)
+            last_frame = block['frame_number'][-1]
+            yield block_rows, block
+            pending, pending_rows = pending[~is_ready], pending_rows[~is_ready]
+    
+    if pending.size > 0:
+        yield _sorted_block(np.ones(pending.size, bool))
+
+def _frameLimits(frame_number):
+    #limits of each frame in an array sorted by frame
+    limits = np.flatnonzero(np.diff(frame_number)) + 1
+    return zip(np.concatenate(([0], limits)), np.concatenate((limits, [frame_number.size])))
+
+def assignBlobTraj(trajectories_file, 
+                   max_allowed_dist=20, 
+                   area_ratio_lim=(0.5, 2), 
+                   link_method='ARGMIN', 
+                   chunk_size=DFLT_CHUNK_SIZE):
+    '''
+    Assign worm_index_blob linking the blobs in consecutive frames. /plate_worms is processed in 
+    chunks, keeping in memory only the previous frame and the ends of the tracks (returned).
+    '''
     #loop, save data and display progress
     base_name = os.path.basename(trajectories_file).replace('_trajectories.hdf5', '').replace('_skeletons.hdf5', '')
     
-    with pd.HDFStore(trajectories_file, 'r') as fid:
-        plate_worms = fid['/plate_worms']
+    with tables.File(trajectories_file, 'r+') as fid:
+        tbl = fid.get_node('/', 'plate_worms')
+        
+        linker = _FrameLinker(max_allowed_dist, area_ratio_lim, link_method)
+        tracks_ends = _TracksEnds()
+        progress_time = TimeCounter(base_name + ' Assigning trajectories.')
+        
+        #the results are written once all the rows of a chunk are assigned
+        traj_ind = np.zeros(0, np.int64)
+        is_assigned = np.zeros(0, bool)
+        n_written = 0
+        try:
+            for block_rows, block in _iterFrameBlocks(tbl, chunk_size):
+                block_ind = np.zeros(block_rows.size, np.int64)
+                for ini, fin in _frameLimits(block['frame_number']):
+                    frame_data = block[ini:fin]
+                    block_ind[ini:fin] = linker.link(np.column_stack((frame_data['coord_x'], frame_data['coord_y'])), 
+                                                     frame_data['area'])
+                    frame = frame_data['frame_number'][0]
+                    if frame % 500 == 0:
+                        # calculate the progress and put it in a string
+                        print_flush(progress_time.get_str(frame))
+                
+                tracks_ends.add(block_ind, block_rows, block)
+                
+                n_rows = block_rows.max() + 1 - n_written
+                if n_rows > traj_ind.size:
+                    traj_ind = np.concatenate((traj_ind, np.zeros(n_rows - traj_ind.size, np.int64)))
+                    is_assigned = np.concatenate((is_assigned, np.zeros(n_rows - is_assigned.size, bool)))
+                traj_ind[block_rows - n_written] = block_ind
+                is_assigned[block_rows - n_written] = True
+                
+                n_done = np.argmin(is_assigned) if not np.all(is_assigned) else is_assigned.size
+                if n_done > 0:
+                    tbl.modify_column(start=n_written, 
+                                      stop=n_written + n_done, 
+                                      column=traj_ind[:n_done], 
+                                      colname='worm_index_blob')
+                    n_written += n_done
+                    traj_ind, is_assigned = traj_ind[n_done:], is_assigned[n_done:]
+            
+        except _UnsortedFramesError:
+            #the frames are not sorted in blocks, use the whole table
+            plate_worms = pd.DataFrame(tbl.read())
+            traj_ind = assignBlobTrajDF(plate_worms, max_allowed_dist, area_ratio_lim, base_name=base_name, link_method=link_method)
+            if traj_ind is not None:
+                tbl.modify_column(column=traj_ind, colname='worm_index_blob')
+            tracks_ends = None
+        
+        fid.flush()
     
-    traj_ind = assignBlobTrajDF(plate_worms, max_allowed_dist, area_ratio_lim, base_name=base_name)
+    return tracks_ends
 
-    if traj_ind is not None:
-        with tables.File(trajectories_file, 'r+') as fid:
-            tbl = fid.get_node('/', 'plate_worms')
-            tbl.modify_column(column=traj_ind, colname='worm_index_blob')
-
-        #print_flush(progress_time.get_str(frame))    
-
-def assignBlobTrajDF(traj_df, max_allowed_dist, area_ratio_lim, base_name=''):
+def _linkFramesAssignment(coord_prev, area_prev, coord, area, max_allowed_dist, area_ratio_lim):
+    '''
+    Match the blobs of two consecutive frames solving a linear assignment problem.
+    Only the pairs closer than max_allowed_dist (found using a KD-tree) and with a valid area ratio 
+    are considered, and the assignment is solved independently for each group of blobs connected
+    by these candidate pairs. Returns the index in the previous frame of each blob (-1 if unmatched).
+    '''
+    n_prev, n_curr = coord_prev.shape[0], coord.shape[0]
+    map_to_prev = np.full(n_curr, -1, dtype=np.int64)
+    if n_prev == 0 or n_curr == 0:
+        return map_to_prev
+    
+    #candidate pairs
+    tree_prev = cKDTree(coord_prev)
+    tree_curr = cKDTree(coord)
+    pairs = tree_prev.sparse_distance_matrix(tree_curr, max_allowed_dist, output_type='ndarray')
+    ii, jj, dist = pairs['i'], pairs['j'], pairs['v']
+    
+    #area ratio gate
+    with np.errstate(divide='ignore', invalid='ignore'):
+        area_ratio = area_prev[ii]/area[jj]
+    good = (area_ratio >= area_ratio_lim[0]) & (area_ratio <= area_ratio_lim[1])
+    ii, jj, dist = ii[good], jj[good], dist[good]
+    if ii.size == 0:
+        return map_to_prev
     
-    def _get_cost_matrix(frame_data, frame_data_prev):
-        coord = frame_data[['coord_x', 'coord_y']].values
-        coord_prev = frame_data_prev[['coord_x', 'coord_y']].values
+    #split the problem in independent groups. The nodes 0..n_prev-1 are the previous blobs
+    adj = coo_matrix((np.ones(ii.size), (ii, jj + n_prev)), shape=(n_prev + n_curr, n_prev + n_curr))
+    _, labels = connected_components(adj, directed=False)
+    pair_labels = labels[ii]
+    
+    #the most common case, one to one groups, does not need to be solved
+    n_prev_group = np.bincount(labels[:n_prev], minlength=labels.max() + 1)
+    n_curr_group = np.bincount(labels[n_prev:], minlength=labels.max() + 1)
+    is_single = (n_prev_group[pair_labels] == 1) & (n_curr_group[pair_labels] == 1)
+    map_to_prev[jj[is_single]] = ii[is_single]
+    
+    ii, jj, dist, pair_labels = ii[~is_single], jj[~is_single], dist[~is_single], pair_labels[~is_single]
+    if ii.size > 0:
+        order = np.argsort(pair_labels, kind='stable')
+        ii, jj, dist, pair_labels = ii[order], jj[order], dist[order], pair_labels[order]
+        group_limits = np.flatnonzero(np.diff(pair_labels)) + 1
+        for g_ii, g_jj, g_dist in zip(*[np.split(x, group_limits) for x in (ii, jj, dist)]):
+            rows, g_ii = np.unique(g_ii, return_inverse=True)
+            cols, g_jj = np.unique(g_jj, return_inverse=True)
+            
+            #invalid pairs get a cost larger than any valid combination
+            invalid_cost = (g_dist.sum() + 1)*(min(rows.size, cols.size) + 1)
+            cost = np.full((rows.size, cols.size), invalid_cost)
+            cost[g_ii, g_jj] = g_dist
+            r_ind, c_ind = linear_sum_assignment(cost)
+            valid = cost[r_ind, c_ind] < invalid_cost
+            map_to_prev[cols[c_ind[valid]]] = rows[r_ind[valid]]
+    
+    return map_to_prev
+
+def _linkFramesArgmin(coord_prev, area_prev, coord, area, max_allowed_dist, area_ratio_lim):
+    '''
+    Link each blob to the closest blob in the previous frame. The blobs involved in a 
+    merge or a split are left unmatched. Returns the index in the previous frame of each blob (-1 if unmatched).
+    '''
+    def _get_cost_matrix():
         costMatrix = cdist(coord_prev, coord)  # calculate the cost matrix
         
         # assign a large value to non-valid combinations by area
-        area = frame_data['area'].values
-        area_prev = frame_data_prev['area'].values
         area_ratio = area_prev[:, None]/area[None,:]
         area_ratio[np.isnan(area_ratio)] = 1e20
         
@@ -79,23 +235,35 @@ def assignBlobTrajDF(traj_df, max_allowed_dist, area_ratio_lim, base_name=''):
         possible_merges = np.in1d(map_to_prev, bad_prev_ind) 
         map_to_prev[possible_merges] = -1
         return map_to_prev
-     
     
-    frame_data_prev = None
-    tot_worms = 0
-    all_indexes = []
-    frames_grouped = traj_df.groupby('frame_number')
-    
-    #if isinstance(area_ratio_lim, (float, int)):
-    #    area_ratio_lim = (1/area_ratio_lim, area_ratio_lim)
+    return _get_prev_ind_match(_get_cost_matrix())
+
+
+class _FrameLinker():
+    '''
+    Assign the trajectory indexes frame by frame. Only the blobs of the previous frame are kept.
+    '''
+    def __init__(self, max_allowed_dist, area_ratio_lim, link_method='ARGMIN'):
+        self.max_allowed_dist = max_allowed_dist
+        self.area_ratio_lim = area_ratio_lim
+        if link_method == 'LINEAR_ASSIGNMENT':
+            self.link_func = _linkFramesAssignment
+        else:
+            self.link_func = _linkFramesArgmin
+        
+        self.tot_worms = 0
+        self.prev_data = None
     
-    progress_time = TimeCounter(base_name + ' Assigning trajectories.', len(frames_grouped))  
-    for frame, frame_data in frames_grouped:
+    def link(self, coord, area):
         #what happens if the frames are not continous?
-        if frame_data_prev is not None:    
-            _, prev_traj_ind = all_indexes[-1]
-            costMatrix = _get_cost_matrix(frame_data, frame_data_prev)
-            map_to_prev = _get_prev_ind_match(costMatrix)
+        if self.prev_data is not None:
+            coord_prev, area_prev, prev_traj_ind = self.prev_data
+            map_to_prev = self.link_func(coord_prev, 
+                                        area_prev, 
+                                        coord, 
+                                        area, 
+                                        self.max_allowed_dist, 
+                                        self.area_ratio_lim)
             
             traj_indexes = np.zeros_like(map_to_prev)
             unmatched = map_to_prev == -1
@@ -104,20 +272,34 @@ def assignBlobTrajDF(traj_df, max_allowed_dist, area_ratio_lim, base_name=''):
             #assign matched index from the previous indexes
             traj_indexes[matched] = prev_traj_ind[map_to_prev[matched]]
             
-            vv = np.arange(1, np.sum(unmatched) + 1) + tot_worms
+            vv = np.arange(1, np.sum(unmatched) + 1) + self.tot_worms
             if vv.size > 0:
-                tot_worms = vv[-1]
+                self.tot_worms = vv[-1]
                 traj_indexes[unmatched] = vv
                 
         else:
             # initialize worm indexes
-            traj_indexes = tot_worms + np.arange(1, len(frame_data) + 1)
-            tot_worms = traj_indexes[-1]
+            traj_indexes = self.tot_worms + np.arange(1, len(coord) + 1)
+            self.tot_worms = traj_indexes[-1]
         
+        self.prev_data = (coord, area, traj_indexes)
+        return traj_indexes
+
+
+def assignBlobTrajDF(traj_df, max_allowed_dist, area_ratio_lim, base_name='', link_method='ARGMIN'):
+    linker = _FrameLinker(max_allowed_dist, area_ratio_lim, link_method)
+    
+    all_indexes = []
+    frames_grouped = traj_df.groupby('frame_number')
+    
+    #if isinstance(area_ratio_lim, (float, int)):
+    #    area_ratio_lim = (1/area_ratio_lim, area_ratio_lim)
+    
+    progress_time = TimeCounter(base_name + ' Assigning trajectories.', len(frames_grouped))  
+    for frame, frame_data in frames_grouped:
+        traj_indexes = linker.link(frame_data[['coord_x', 'coord_y']].values, frame_data['area'].values)
         all_indexes.append((frame_data.index, traj_indexes))
-            
         
-        frame_data_prev = frame_data
         if frame % 500 == 0:
             # calculate the progress and put it in a string
             print_flush(progress_time.get_str(frame))
@@ -235,8 +417,10 @@ def correctSingleWormCase(trajectories_file, is_WT2):
     '''
     Only keep the object with the largest area when cosider the case of individual worms.
     '''
-    with pd.HDFStore(trajectories_file, 'r') as traj_fid:
-        plate_worms = traj_fid['/plate_worms']
+    with tables.File(trajectories_file, 'r') as traj_fid:
+        tbl = traj_fid.get_node('/plate_worms')
+        plate_worms = pd.DataFrame({x : tbl.col(x) for x in 
+                        ['worm_index_blob', 'frame_number', 'coord_x', 'coord_y', 'area', 'box_length']})
 
     # emtpy table nothing to do here
     if len(plate_worms) == 0:
@@ -262,27 +446,240 @@ def correctSingleWormCase(trajectories_file, is_WT2):
 def joinGapsTrajectories(trajectories_file, 
                          min_track_size=50,
                          max_frames_gap=100, 
-                         area_ratio_lim=(0.67, 1.5)):
-    #% get the first and last rows for each trajectory. Pandas is easier of manipulate than tables.
-    with pd.HDFStore(trajectories_file, 'r') as fid:
-        df = fid['plate_worms'][['worm_index_blob', 'frame_number',
-                                 'coord_x', 'coord_y', 'area', 'box_length']]
-
-    worm_index_joined = joinGapsTrajectoriesDF(df, 
-                           min_track_size=min_track_size,
-                           max_frames_gap=max_frames_gap, 
-                           area_ratio_lim=area_ratio_lim
-                           )
-
-    # update worm_index_joined field
+                         area_ratio_lim=(0.67, 1.5),
+                         tracks_ends=None,
+                         chunk_size=DFLT_CHUNK_SIZE):
+    '''
+    Join the trajectories separated by small time gaps. Only the first and last rows of each
+    trajectory are kept in memory, and worm_index_joined is written in chunks.
+    tracks_ends -- _TracksEnds calculated by assignBlobTraj. If it is None it is calculated here.
+    '''
     with tables.open_file(trajectories_file, mode='r+') as fid:
         plate_worms = fid.get_node('/plate_worms')
-        # add the result the column worm_index_joined
-        plate_worms.modify_column(
-            colname='worm_index_joined',
-            column=worm_index_joined)
+        
+        if tracks_ends is None:
+            tracks_ends = _TracksEnds()
+            for ini in range(0, plate_worms.nrows, chunk_size):
+                chunk = plate_worms.read(ini, ini + chunk_size)
+                tracks_ends.add(chunk['worm_index_blob'], np.arange(ini, ini + chunk.size), chunk)
+        
+        ends_df = tracks_ends.get_df()
+        prev_traj, valid_indexes = _linkTracksEnds(ends_df[ends_df['count'] >= min_track_size], 
+                                                   area_ratio_lim, 
+                                                   max_frames_gap)
+        
+        # update worm_index_joined field. The worm_index_blob order has to be conserved.
+        for ini in range(0, plate_worms.nrows, chunk_size):
+            worm_index_blob = plate_worms.read(ini, ini + chunk_size, field='worm_index_blob')
+            worm_index_joined = _joinPrev2Index(worm_index_blob, prev_traj, valid_indexes)
+            plate_worms.modify_column(start=ini, 
+                                      stop=ini + worm_index_blob.size, 
+                                      column=worm_index_joined, 
+                                      colname='worm_index_joined')
         fid.flush()
 
+
+def _getTracksEnds(worm_index, frame_number, row_index):
+    '''
+    Get the positions of the first and last rows (by frame_number) of each trajectory. 
+    The first row is used in case of ties, as in idxmin/idxmax.
+    Returns the trajectory indexes (sorted), the first and last positions and the number of rows.
+    '''
+    order = np.lexsort((row_index, frame_number, worm_index))
+    worm_index_s = worm_index[order]
+    frame_number_s = frame_number[order]
+    
+    is_new = np.ones(worm_index_s.size, bool)
+    is_new[1:] = worm_index_s[1:] != worm_index_s[:-1]
+    ini_pos = np.flatnonzero(is_new)
+    fin_pos = np.append(ini_pos[1:], worm_index_s.size)
+    counts = fin_pos - ini_pos
+    
+    #first position of the last frame of each trajectory
+    is_frame_ini = is_new.copy()
+    is_frame_ini[1:] |= frame_number_s[1:] != frame_number_s[:-1]
+    frame_ini = np.flatnonzero(is_frame_ini)
+    last_pos = frame_ini[np.searchsorted(frame_ini, fin_pos, side='left') - 1]
+    
+    return worm_index_s[ini_pos], order[ini_pos], order[last_pos], counts
+
+
+_ENDS_FIELDS = ['frame_number', 'coord_x', 'coord_y', 'area', 'box_length']
+
+class _TracksEnds():
+    '''
+    Accumulate the first and last valid rows (no nan values) of each trajectory 
+    from blocks of rows. In case of ties in the frame_number the lowest row is used.
+    '''
+    def __init__(self):
+        self.ends_df = None
+    
+    def add(self, worm_index, row_index, block):
+        valid = np.ones(worm_index.size, bool)
+        for field in _ENDS_FIELDS:
+            valid &= ~np.isnan(block[field])
+        worm_index, row_index, block = worm_index[valid], row_index[valid], block[valid]
+        if worm_index.size == 0:
+            return
+        
+        index, first_pos, last_pos, counts = _getTracksEnds(worm_index, block['frame_number'], row_index)
+        block_df = {'index' : index, 'count' : counts, 
+                    'first_row' : row_index[first_pos], 'last_row' : row_index[last_pos]}
+        for field in _ENDS_FIELDS:
+            block_df['first_' + field] = block[field][first_pos]
+            block_df['last_' + field] = block[field][last_pos]
+        block_df = pd.DataFrame(block_df)
+        
+        if self.ends_df is None:
+            self.ends_df = block_df
+            return
+        
+        ends_df = pd.concat((self.ends_df, block_df), ignore_index=True)
+        index = ends_df['index'].values
+        
+        #earliest frame (lowest row in ties) for the first rows
+        order = np.lexsort((ends_df['first_row'].values, ends_df['first_frame_number'].values, index))
+        is_first = np.ones(index.size, bool)
+        is_first[1:] = index[order[1:]] != index[order[:-1]]
+        first_pos = order[is_first]
+        
+        #latest frame (lowest row in ties) for the last rows
+        order = np.lexsort((ends_df['last_row'].values, -ends_df['last_frame_number'].values, index))
+        last_pos = order[is_first]
+        
+        first_cols = ['index', 'first_row'] + ['first_' + x for x in _ENDS_FIELDS]
+        last_cols = ['last_row'] + ['last_' + x for x in _ENDS_FIELDS]
+        new_df = ends_df[first_cols].iloc[first_pos].reset_index(drop=True)
+        for col in last_cols:
+            new_df[col] = ends_df[col].values[last_pos]
+        new_df['count'] = np.bincount(np.searchsorted(new_df['index'].values, index), 
+                                      weights=ends_df['count'].values).astype(np.int64)
+        self.ends_df = new_df
+    
+    def get_df(self):
+        if self.ends_df is None:
+            cols = ['index', 'count', 'first_row', 'last_row'] + ['first_' + x for x in _ENDS_FIELDS] + ['last_' + x for x in _ENDS_FIELDS]
+            return pd.DataFrame({x : np.zeros(0, np.int64) for x in cols})
+        return self.ends_df
+
+
+def _findNextTraj(df, 
+                  worm_index_type,
+                  area_ratio_lim, 
+                  min_track_size, 
+                  max_frames_gap):
+    '''
+    area_ratio_lim -- allowed range between the area ratio of consecutive frames
+    min_track_size -- minimum tracksize accepted
+    max_frames_gap -- time gap between joined trajectories
+    '''
+    df = df[[worm_index_type, 'frame_number',
+             'coord_x', 'coord_y', 'area', 'box_length']].dropna()
+    
+    # select the first and last frame_number for each separate trajectory
+    index, first_pos, last_pos, counts = _getTracksEnds(df[worm_index_type].values, 
+                                                        df['frame_number'].values, 
+                                                        np.arange(len(df)))
+    
+    ends_df = {'index' : index, 'count' : counts}
+    for field in _ENDS_FIELDS:
+        ends_df['first_' + field] = df[field].values[first_pos]
+        ends_df['last_' + field] = df[field].values[last_pos]
+    ends_df = pd.DataFrame(ends_df)
+    
+    # filter data only to include trajectories larger than min_track_size
+    ends_df = ends_df[ends_df['count'] >= min_track_size]
+    return _linkTracksEnds(ends_df, area_ratio_lim, max_frames_gap)
+    
+
+def _linkTracksEnds(ends_df, 
+                    area_ratio_lim, 
+                    max_frames_gap,
+                    max_pairs_per_chunk = 1000000):
+    '''
+    Returns, for each trajectory in ends_df, the position of the trajectory it continues 
+    (-1 if it is not joined), and the trajectory indexes.
+    '''
+    valid_indexes = ends_df['index'].values
+    first_frame, first_x, first_y, first_area = [ends_df['first_' + x].values 
+        for x in ('frame_number', 'coord_x', 'coord_y', 'area')]
+    last_frame, last_x, last_y, last_area, last_length = [ends_df['last_' + x].values 
+        for x in ('frame_number', 'coord_x', 'coord_y', 'area', 'box_length')]
+    
+    #% look for trajectories that could be join together in a small time gap.
+    # The possible connected trajectories must have started after the end of the current trajectories,
+    # within a timegap given by max_frames_gap. Use a binary search over the sorted starting frames.
+    start_order = np.argsort(first_frame, kind='stable')
+    start_frames = first_frame[start_order]
+    win_ini = np.searchsorted(start_frames, last_frame, side='right')
+    win_fin = np.searchsorted(start_frames, last_frame + max_frames_gap, side='right')
+    win_size = np.maximum(win_fin - win_ini, 0)
+    
+    prev_traj = np.full(valid_indexes.size, -1, dtype=np.int64)
+    tot_pairs = np.cumsum(win_size)
+    chunk_ini = 0
+    while chunk_ini < valid_indexes.size:
+        #limit the number of pairs evaluated at once
+        chunk_fin = np.searchsorted(tot_pairs, tot_pairs[chunk_ini] - win_size[chunk_ini] + max_pairs_per_chunk, side='right')
+        chunk_fin = max(chunk_fin, chunk_ini + 1)
+        
+        curr = np.arange(chunk_ini, chunk_fin)
+        n_pairs = win_size[curr]
+        pair_curr = np.repeat(curr, n_pairs)
+        offsets = np.arange(pair_curr.size) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+        pair_next = start_order[win_ini[pair_curr] + offsets]
+        
+        # the area change must be smaller than the one given by area_ratio_lim
+        # it is better to use the last point change of area because we are
+        # considered changes near that occur near time
+        areaR = last_area[pair_curr] / first_area[pair_next]
+        valid = (areaR > area_ratio_lim[0]) & (areaR < area_ratio_lim[1])
+        pair_curr, pair_next = pair_curr[valid], pair_next[valid]
+        
+        R = np.sqrt((first_x[pair_next] - last_x[pair_curr]) ** 2 +
+                    (first_y[pair_next] - last_y[pair_curr]) ** 2)
+        
+        # select the closest trajectory (the one with the lowest index in case of a tie)
+        best = np.lexsort((pair_next, R, pair_curr))
+        is_first = np.ones(best.size, bool)
+        is_first[1:] = pair_curr[best[1:]] != pair_curr[best[:-1]]
+        best = best[is_first]
+        
+        # only join trajectories that move at most one worm body
+        good = R[best] <= last_length[pair_curr[best]]
+        best = best[good]
+        
+        #if several trajectories select the same next trajectory the last one (highest index) is kept
+        best_next = pair_next[best][::-1]
+        best_curr = pair_curr[best][::-1]
+        best_next, ind = np.unique(best_next, return_index=True)
+        prev_traj[best_next] = best_curr[ind]
+        
+        chunk_ini = chunk_fin
+    
+    return prev_traj, valid_indexes
+
+
+def _joinPrev2Index(worm_index, prev_traj, valid_indexes):
+    # find the first trajectory of each joined group by pointer jumping 
+    # (each trajectory points to the one it continues)
+    root = np.where(prev_traj >= 0, prev_traj, np.arange(prev_traj.size))
+    while True:
+        new_root = root[root]
+        if np.array_equal(new_root, root):
+            break
+        root = new_root
+    
+    # replace the previous index for the root index, -1 if it is not a valid index
+    worm_index_new = np.full_like(worm_index, -1)
+    if valid_indexes.size > 0:
+        pos = np.searchsorted(valid_indexes, worm_index)
+        pos = np.minimum(pos, valid_indexes.size - 1)
+        is_valid = valid_indexes[pos] == worm_index
+        worm_index_new[is_valid] = valid_indexes[root[pos[is_valid]]]
+    return worm_index_new
+
+
 def joinGapsTrajectoriesDF(plate_worms, 
                            min_track_size=50,
                            max_frames_gap=100, 
@@ -293,99 +690,11 @@ def joinGapsTrajectoriesDF(plate_worms,
     min_track_size -- minimum tracksize accepted
     max_frames_gap -- time gap between joined trajectories
     '''
-
-
-
-    def _findNextTraj(df, 
-                      area_ratio_lim, 
-                      min_track_size, 
-                      max_frames_gap):
-        '''
-        area_ratio_lim -- allowed range between the area ratio of consecutive frames
-        min_track_size -- minimum tracksize accepted
-        max_frames_gap -- time gap between joined trajectories
-        '''
-    
-        df = df[[worm_index_type, 'frame_number',
-                 'coord_x', 'coord_y', 'area', 'box_length']].dropna()
-        # select the first and last frame_number for each separate trajectory
-        tracks_data = df[[worm_index_type, 'frame_number']]
-        tracks_data = tracks_data.groupby(worm_index_type)
-        tracks_data = tracks_data.aggregate(
-            {'frame_number': [np.argmin, np.argmax, 'count']})
-    
-        # filter data only to include trajectories larger than min_track_size
-        tracks_data = tracks_data[
-            tracks_data['frame_number']['count'] >= min_track_size]
-        valid_indexes = tracks_data.index
-    
-        # select the corresponding first and last rows of each trajectory
-        first_rows = df.iloc[tracks_data['frame_number']['argmin'].values]
-        last_rows = df.iloc[tracks_data['frame_number']['argmax'].values]
-        # let's use the particle id as index instead of the row number
-        last_rows.index = tracks_data['frame_number'].index
-        first_rows.index = tracks_data['frame_number'].index
-    
-        #% look for trajectories that could be join together in a small time gap
-        join_frames = []
-        for curr_index in valid_indexes:
-            # the possible connected trajectories must have started after the end of the current trajectories,
-            # within a timegap given by max_frames_gap
-            possible_rows = first_rows[
-                (first_rows['frame_number'] > last_rows['frame_number'][curr_index]) & (
-                    first_rows['frame_number'] <= last_rows['frame_number'][curr_index] +
-                    max_frames_gap)]
-    
-            # the area change must be smaller than the one given by area_ratio_lim
-            # it is better to use the last point change of area because we are
-            # considered changes near that occur near time
-            areaR = last_rows['area'][curr_index] / possible_rows['area']
-            possible_rows = possible_rows[
-                (areaR > area_ratio_lim[0]) & (
-                    areaR < area_ratio_lim[1])]
-    
-            # not valid rows left
-            if len(possible_rows) == 0:
-                continue
-    
-            R = np.sqrt((possible_rows['coord_x'] -
-                         last_rows['coord_x'][curr_index]) ** 2 +
-                        (possible_rows['coord_y'] -
-                         last_rows['coord_y'][curr_index]) ** 2)
-    
-            indmin = np.argmin(R)
-            # only join trajectories that move at most one worm body
-            if R[indmin] <= last_rows['box_length'][curr_index]:
-                #print(curr_index, indmin)
-                join_frames.append((indmin, curr_index))
-    
-        relations_dict = dict(join_frames)
-    
-        return relations_dict, valid_indexes
-    
-    
-    def _joinDict2Index(worm_index, relations_dict, valid_indexes):
-        worm_index_new = np.full_like(worm_index, -1)
-    
-        for ind in valid_indexes:
-            # seach in the dictionary for the first index in the joined trajectory
-            # group
-            ind_joined = ind
-            while ind_joined in relations_dict:
-                ind_joined = relations_dict[ind_joined]
-    
-            # replace the previous index for the root index
-            worm_index_new[worm_index == ind] = ind_joined
-    
-        return worm_index_new
-    
-    
-    
-    relations_dict, valid_indexes = _findNextTraj(plate_worms, area_ratio_lim, min_track_size, max_frames_gap)
+    prev_traj, valid_indexes = _findNextTraj(plate_worms, worm_index_type, area_ratio_lim, min_track_size, max_frames_gap)
     # read the worm_index_blob column, this is the index order that have to
     # be conserved in the worm_index_joined column
     worm_index_blob = plate_worms[worm_index_type].values
-    worm_index_joined = _joinDict2Index(worm_index_blob, relations_dict, valid_indexes)
+    worm_index_joined = _joinPrev2Index(worm_index_blob, prev_traj, valid_indexes)
 
     return worm_index_joined
 
@@ -397,18 +706,19 @@ def joinBlobsTrajectories(trajectories_file,
                           max_allowed_dist, 
                           area_ratio_lim, 
                           min_track_size,
-                          max_frames_gap):
+                          max_frames_gap,
+                          link_method = 'ARGMIN'):
     
     #allow to recieve int/float values
     if not isinstance(area_ratio_lim, (tuple,list)):
         area_ratio_lim = (1/area_ratio_lim, area_ratio_lim)
 
     
-    assignBlobTraj(trajectories_file, max_allowed_dist, area_ratio_lim)
+    tracks_ends = assignBlobTraj(trajectories_file, max_allowed_dist, area_ratio_lim, link_method)
     if is_one_worm:
         correctSingleWormCase(trajectories_file, is_WT2)
     else:
-        joinGapsTrajectories(trajectories_file, min_track_size, max_frames_gap, area_ratio_lim)
+        joinGapsTrajectories(trajectories_file, min_track_size, max_frames_gap, area_ratio_lim, tracks_ends)
 
     with tables.File(trajectories_file, "r+") as traj_fid:
         traj_fid.get_node('/plate_worms')._v_attrs['has_finished'] = 2
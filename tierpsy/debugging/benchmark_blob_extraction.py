@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the time of the frame by frame (getBlobContours) and the batched
+(getBlobContoursBatch) blob extraction used by TRAJ_CREATE, and check that both
+produce the same plate_worms rows.
+
+python benchmark_blob_extraction.py masked_video.hdf5 --buffer_size 25
+"""
+import time
+import argparse
+
+import cv2
+import numpy as np
+
+from tierpsy.analysis.traj_create.getBlobTrajectories import generateROIBuff, getBlobsData, \
+getBlobContours, getBufferThresh, _cnt_to_ROIs, _cnt_to_props
+from tierpsy.helper.params import read_unit_conversions
+
+def _getBlobsDataSingle(buff_data, blob_params):
+    #frame by frame version of getBlobsData
+    ROI_cnts, image_buffer, frame_number = buff_data
+    is_light_background, min_area, min_box_width, worm_bw_thresh_factor, \
+    strel_size, analysis_type, thresh_block_size = blob_params
+
+    blobs_data = []
+    for ROI_cnt in ROI_cnts:
+        ROI_buffer, ROI_bbox = _cnt_to_ROIs(ROI_cnt, image_buffer, min_box_width)
+        if ROI_buffer is not None:
+            thresh_buff = getBufferThresh(ROI_buffer, worm_bw_thresh_factor, is_light_background, analysis_type)
+            for buff_ind in range(image_buffer.shape[0]):
+                ROI_worms, _ = getBlobContours(ROI_buffer[buff_ind],
+                                               thresh_buff,
+                                               strel_size,
+                                               is_light_background,
+                                               analysis_type,
+                                               thresh_block_size)
+                blobs_data += _cnt_to_props(ROI_worms, frame_number + buff_ind, thresh_buff, min_area, ROI_bbox)
+    return blobs_data
+
+def benchmark_blob_extraction(masked_file,
+                              buffer_size = 25,
+                              min_area = 25,
+                              min_box_width = 5,
+                              worm_bw_thresh_factor = 1.,
+                              strel_size = 5,
+                              analysis_type = 'WORM'):
+
+    _, _, is_light_background = read_unit_conversions(masked_file)
+    blob_params = (is_light_background,
+                  min_area,
+                  min_box_width,
+                  worm_bw_thresh_factor,
+                  (strel_size, strel_size),
+                  analysis_type,
+                  15)
+
+    tot_time = {'single':0, 'batch':0}
+    n_rows, n_rois, n_diff = 0, 0, 0
+    for buff_data in generateROIBuff(masked_file, buffer_size):
+        tic = time.time()
+        rows_single = _getBlobsDataSingle(buff_data, blob_params)
+        tot_time['single'] += time.time() - tic
+
+        tic = time.time()
+        rows_batch = getBlobsData(buff_data, blob_params)
+        tot_time['batch'] += time.time() - tic
+
+        n_rows += len(rows_single)
+        n_rois += len(buff_data[0])
+        n_diff += rows_single != rows_batch
+
+    print('ROIs {} rows {} buffers with different rows {}'.format(n_rois, n_rows, n_diff))
+    for key, val in tot_time.items():
+        print('{} total time {:.3f}s'.format(key, val))
+    print('speedup {:.2f}x'.format(tot_time['single']/tot_time['batch']))
+
+if __name__ == '__main__':
+    cv2.setNumThreads(1)
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('masked_file', help='masked video (hdf5)')
+    parser.add_argument('--buffer_size', type=int, default=25)
+    parser.add_argument('--min_area', type=int, default=25)
+    parser.add_argument('--strel_size', type=int, default=5)
+    parser.add_argument('--analysis_type', default='WORM')
+    args = parser.parse_args()
+
+    benchmark_blob_extraction(**vars(args))
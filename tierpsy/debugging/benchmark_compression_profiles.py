@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the write speed, read speed and file size of the different
+codec/chunk profiles used to store /mask, using a masked video as sample.
+
+python benchmark_compression_profiles.py masked_video.hdf5 --max_frames 1000
+"""
+import os
+import time
+import tempfile
+import argparse
+
+import tables
+
+from tierpsy.analysis.compress.compressVideo import createImgGroup
+
+PROFILES = [
+    ('zlib_5_c1', dict(codec='zlib', level=5, chunk_frames=1)),
+    ('zlib_5_c25', dict(codec='zlib', level=5, chunk_frames=25)),
+    ('lz4_5_c1', dict(codec='blosc:lz4', level=5, chunk_frames=1)),
+    ('lz4_5_c25', dict(codec='blosc:lz4', level=5, chunk_frames=25)),
+    ('zstd_3_c1', dict(codec='blosc:zstd', level=3, chunk_frames=1)),
+    ('zstd_3_c25', dict(codec='blosc:zstd', level=3, chunk_frames=25)),
+]
+
+def _benchmark_profile(masks, tmp_file, buffer_size, **profile):
+    tot_frames, im_height, im_width = masks.shape
+
+    tic = time.time()
+    with tables.File(tmp_file, 'w') as fid:
+        mask_new = createImgGroup(fid, '/mask', tot_frames, im_height, im_width, **profile)
+        for ini in range(0, tot_frames, buffer_size):
+            mask_new.append(masks[ini:ini + buffer_size])
+    write_time = time.time() - tic
+
+    tic = time.time()
+    with tables.File(tmp_file, 'r') as fid:
+        mask_new = fid.get_node('/mask')
+        for ii in range(tot_frames):
+            mask_new[ii]
+    read_frame_time = time.time() - tic
+
+    tic = time.time()
+    with tables.File(tmp_file, 'r') as fid:
+        mask_new = fid.get_node('/mask')
+        for ini in range(0, tot_frames, buffer_size):
+            mask_new[ini:ini + buffer_size]
+    read_buff_time = time.time() - tic
+
+    file_size = os.path.getsize(tmp_file)
+
+    return write_time, read_frame_time, read_buff_time, file_size
+
+def benchmark_profiles(masked_file, max_frames = 1000, buffer_size = 25):
+    with tables.File(masked_file, 'r') as fid:
+        masks = fid.get_node('/mask')[:max_frames]
+    tot_frames = masks.shape[0]
+    data_mb = masks.nbytes/1e6
+
+    print('{} frames of {}x{} from {}'.format(tot_frames, *masks.shape[1:], masked_file))
+    header = '{:<12}{:>12}{:>16}{:>16}{:>12}'.format(
+        'profile', 'write MB/s', 'read frame MB/s', 'read buff MB/s', 'size MB')
+    print(header)
+    print('-'*len(header))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, profile in PROFILES:
+            tmp_file = os.path.join(tmp_dir, name + '.hdf5')
+            write_time, read_frame_time, read_buff_time, file_size = \
+                _benchmark_profile(masks, tmp_file, buffer_size, **profile)
+
+            print('{:<12}{:>12.1f}{:>16.1f}{:>16.1f}{:>12.2f}'.format(
+                name,
+                data_mb/write_time,
+                data_mb/read_frame_time,
+                data_mb/read_buff_time,
+                file_size/1e6))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('masked_file', help='masked video (hdf5) used as sample')
+    parser.add_argument('--max_frames', type=int, default=1000, help='number of frames used in the benchmark')
+    parser.add_argument('--buffer_size', type=int, default=25, help='number of frames per block read/write')
+    args = parser.parse_args()
+
+    benchmark_profiles(**vars(args))
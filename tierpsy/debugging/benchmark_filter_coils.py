@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the time of the row by row and the chunked (filterPossibleCoils) coil
+filters of SKE_FILT, and check that both flag the same skeletons. The skeletons
+file is not modified.
+
+python benchmark_filter_coils.py skeletons.hdf5 --chunk_size 10000
+"""
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+import tables
+
+from tierpsy.analysis.ske_filt.getFilteredSkels import _h_isGoodSkelRow, _h_isGoodSkelArray
+
+def benchmark_filter_coils(skeletons_file,
+                           max_width_ratio = 2.25,
+                           max_area_ratio = 6,
+                           chunk_size = 10000):
+
+    with pd.HDFStore(skeletons_file, 'r') as fid:
+        trajectories_data = fid['/trajectories_data']
+    has_skeleton = trajectories_data['has_skeleton'].values.astype(bool)
+    tot_skeletons = has_skeleton.size
+
+    with tables.File(skeletons_file, 'r') as fid:
+        nodes = [fid.get_node(x) for x in ('/skeleton', '/contour_side1', '/contour_side2', '/contour_width')]
+
+        tic = time.time()
+        is_good_row = has_skeleton.copy()
+        for skel_id in np.flatnonzero(has_skeleton):
+            is_good_row[skel_id] = _h_isGoodSkelRow(*[x[skel_id] for x in nodes],
+                                                  max_width_ratio = max_width_ratio,
+                                                  max_area_ratio = max_area_ratio)
+        time_row = time.time() - tic
+
+        tic = time.time()
+        is_good_chunk = has_skeleton.copy()
+        for ini in range(0, tot_skeletons, chunk_size):
+            fin = min(ini + chunk_size, tot_skeletons)
+            valid = np.flatnonzero(is_good_chunk[ini:fin])
+            if valid.size == 0:
+                continue
+            is_good = _h_isGoodSkelArray(*[x[ini:fin][valid] for x in nodes],
+                                         max_width_ratio = max_width_ratio,
+                                         max_area_ratio = max_area_ratio)
+            is_good_chunk[ini + valid[~is_good]] = False
+        time_chunk = time.time() - tic
+
+    n_diff = np.sum(is_good_row != is_good_chunk)
+    print('skeletons {} flagged as coils {} different labels {}'.format(
+        has_skeleton.sum(), np.sum(has_skeleton & ~is_good_row), n_diff))
+    print('row by row total time {:.3f}s'.format(time_row))
+    print('chunked total time {:.3f}s'.format(time_chunk))
+    print('speedup {:.2f}x'.format(time_row/time_chunk))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('skeletons_file', help='skeletons file after SKE_CREATE')
+    parser.add_argument('--max_width_ratio', type=float, default=2.25)
+    parser.add_argument('--max_area_ratio', type=float, default=6)
+    parser.add_argument('--chunk_size', type=int, default=10000)
+    args = parser.parse_args()
+
+    benchmark_filter_coils(**vars(args))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the time of the contour by contour (getSkeleton) and the batched
+(getSkeletonsBatch) skeletonization used by SKE_CREATE, and check that both
+produce the same skeletons. The contours are obtained from the worm ROIs of a
+skeletons file that already has the /trajectories_data table.
+
+python benchmark_skeletons_batch.py masked_video.hdf5 skeletons.hdf5 --max_frames 100
+"""
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from tierpsy.analysis.ske_create.getSkeletonsTables import getWormMask
+from tierpsy.analysis.ske_create.helperIterROI import generateMoviesROI
+from tierpsy.analysis.ske_create.segWormPython.mainSegworm import getSkeleton, getSkeletonsBatch
+from tierpsy.helper.params import read_unit_conversions
+
+def _getFramesContours(masked_file, trajectories_data, strel_size, is_light_background):
+    for worms_in_frame in generateMoviesROI(masked_file, trajectories_data):
+        worm_cnts = []
+        for irow, (worm_img, roi_corner) in worms_in_frame.items():
+            row = trajectories_data.loc[irow]
+            _, worm_cnt, _ = getWormMask(worm_img,
+                                         row['threshold'],
+                                         strel_size,
+                                         min_blob_area=row['area'] / 2,
+                                         is_light_background = is_light_background)
+            worm_cnts.append(worm_cnt)
+        yield worm_cnts
+
+def _is_same_output(output1, output2):
+    return all(np.array_equal(x, y, equal_nan=True) for x, y in zip(output1, output2))
+
+def benchmark_skeletons_batch(masked_file,
+                              skeletons_file,
+                              max_frames = 100,
+                              strel_size = 5,
+                              resampling_N = 49):
+
+    _, _, is_light_background = read_unit_conversions(masked_file)
+    with pd.HDFStore(skeletons_file, 'r') as fid:
+        trajectories_data = fid['/trajectories_data']
+    first_frame = trajectories_data['frame_number'].min()
+    trajectories_data = trajectories_data[trajectories_data['frame_number'] < first_frame + max_frames]
+
+    tot_time = {'single':0, 'batch':0}
+    n_contours, n_skeletons, n_diff = 0, 0, 0
+    for worm_cnts in _getFramesContours(masked_file, trajectories_data, strel_size, is_light_background):
+        tic = time.time()
+        outputs_single = [getSkeleton(worm_cnt, resampling_N=resampling_N) for worm_cnt in worm_cnts]
+        tot_time['single'] += time.time() - tic
+
+        tic = time.time()
+        outputs_batch = getSkeletonsBatch(worm_cnts, resampling_N=resampling_N)
+        tot_time['batch'] += time.time() - tic
+
+        n_contours += len(worm_cnts)
+        n_skeletons += sum(x[0].size > 0 for x in outputs_single)
+        n_diff += sum(not _is_same_output(x, y) for x, y in zip(outputs_single, outputs_batch))
+
+    print('contours {} skeletons {} different outputs {}'.format(n_contours, n_skeletons, n_diff))
+    for key, val in tot_time.items():
+        print('{} total time {:.3f}s'.format(key, val))
+    print('speedup {:.2f}x'.format(tot_time['single']/tot_time['batch']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('masked_file', help='masked video (hdf5)')
+    parser.add_argument('skeletons_file', help='skeletons file with the /trajectories_data table')
+    parser.add_argument('--max_frames', type=int, default=100)
+    parser.add_argument('--strel_size', type=int, default=5)
+    parser.add_argument('--resampling_N', type=int, default=49)
+    args = parser.parse_args()
+
+    benchmark_skeletons_batch(**vars(args))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the time of the SKE_CREATE skeletonization using a pool of 1, 2, 4 and 8
+threads (ske_pool_type THREAD), and check that all of them produce the same
+skeletons. The ROIs are read from a skeletons file that already has the
+/trajectories_data table, and kept in memory so only the skeletonization is timed.
+
+python benchmark_skeletons_threads.py masked_video.hdf5 skeletons.hdf5 --n_threads 1 2 4 8
+"""
+import os
+import time
+import argparse
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from tierpsy.analysis.ske_create.getSkeletonsTables import _skeletonizeRows, _imapSkeletonsParallel
+from tierpsy.analysis.ske_create.helperIterROI import generateMoviesROI
+from tierpsy.helper.params import read_unit_conversions
+
+def _getFramesRows(masked_file, trajectories_data):
+    frames_rows = []
+    for worms_in_frame in generateMoviesROI(masked_file, trajectories_data):
+        frame_rows = []
+        for irow, (worm_img, roi_corner) in worms_in_frame.items():
+            row = trajectories_data.loc[irow]
+            frame_rows.append((int(row['skeleton_id']),
+                               int(row['worm_index_joined']),
+                               worm_img,
+                               roi_corner,
+                               float(row['threshold']),
+                               float(row['area']),
+                               None))
+        frames_rows.append(frame_rows)
+    return frames_rows
+
+def _skeletonize(frames_rows, skel_params, n_threads):
+    if n_threads > 1:
+        outputs = _imapSkeletonsParallel(iter(frames_rows), skel_params, n_threads, pool_type = 'THREAD')
+    else:
+        prev_skeleton = {}
+        outputs = (x for frame_rows in frames_rows for x in _skeletonizeRows(frame_rows, prev_skeleton, skel_params))
+    return {skeleton_id : output for skeleton_id, _, output in outputs}
+
+def _is_same_output(output1, output2):
+    if output1 is None or output2 is None:
+        return output1 is output2
+    return all(np.array_equal(x, y, equal_nan=True) for x, y in zip(output1, output2))
+
+def benchmark_skeletons_threads(masked_file,
+                                skeletons_file,
+                                n_threads = [1, 2, 4, 8],
+                                max_frames = 100,
+                                strel_size = 5,
+                                resampling_N = 49):
+
+    _, _, is_light_background = read_unit_conversions(masked_file)
+    with pd.HDFStore(skeletons_file, 'r') as fid:
+        trajectories_data = fid['/trajectories_data']
+    first_frame = trajectories_data['frame_number'].min()
+    trajectories_data = trajectories_data[trajectories_data['frame_number'] < first_frame + max_frames]
+
+    frames_rows = _getFramesRows(masked_file, trajectories_data)
+    skel_params = ('WORM', strel_size, is_light_background, resampling_N, {'num_segments' : 24, 'head_angle_thresh' : 60})
+
+    print('ROIs {} cpu count {}'.format(sum(len(x) for x in frames_rows), os.cpu_count()))
+    header = '{:>10}{:>12}{:>10}{:>12}'.format('n_threads', 'time (s)', 'speedup', 'different')
+    print(header)
+    print('-'*len(header))
+
+    ref_outputs, ref_time = None, None
+    for n in n_threads:
+        tic = time.time()
+        outputs = _skeletonize(frames_rows, skel_params, n)
+        tot_time = time.time() - tic
+
+        if ref_outputs is None:
+            ref_outputs, ref_time = outputs, tot_time
+        n_diff = sum(not _is_same_output(val, outputs.get(key)) for key, val in ref_outputs.items())
+        print('{:>10}{:>12.3f}{:>10.2f}{:>12}'.format(n, tot_time, ref_time/tot_time, n_diff))
+
+if __name__ == '__main__':
+    cv2.setNumThreads(1)
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('masked_file', help='masked video (hdf5)')
+    parser.add_argument('skeletons_file', help='skeletons file with the /trajectories_data table')
+    parser.add_argument('--n_threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--max_frames', type=int, default=100)
+    parser.add_argument('--strel_size', type=int, default=5)
+    parser.add_argument('--resampling_N', type=int, default=49)
+    args = parser.parse_args()
+
+    benchmark_skeletons_threads(**vars(args))
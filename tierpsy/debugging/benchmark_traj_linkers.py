@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the ARGMIN and LINEAR_ASSIGNMENT methods used by TRAJ_JOIN to link the
+particles of consecutive frames, using synthetic plates with an increasing
+number of particles. It reports the time per frame, and the fraction of the
+true links recovered by each method.
+
+python benchmark_traj_linkers.py --n_blobs 100 500 2000 --n_frames 50
+"""
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from tierpsy.analysis.traj_join.joinBlobsTrajectories import assignBlobTrajDF, LINK_METHODS
+
+def _synthetic_plate(n_blobs, n_frames, plate_size, step_size, seed = 0):
+    rng = np.random.RandomState(seed)
+    coords = rng.uniform(0, plate_size, (n_blobs, 2))
+    areas = rng.uniform(200, 400, n_blobs)
+
+    dat = []
+    for frame in range(n_frames):
+        coords = coords + rng.normal(0, step_size, coords.shape)
+        frame_areas = areas*rng.uniform(0.9, 1.1, n_blobs)
+        dat.append(pd.DataFrame({'frame_number' : frame,
+                                 'coord_x' : coords[:, 0],
+                                 'coord_y' : coords[:, 1],
+                                 'area' : frame_areas,
+                                 'true_index' : np.arange(n_blobs)}))
+
+    traj_df = pd.concat(dat, ignore_index=True)
+    #shuffle the rows of each frame so the order does not give away the solution
+    traj_df = traj_df.sample(frac=1, random_state=seed).sort_values('frame_number', kind='mergesort')
+    return traj_df.reset_index(drop=True)
+
+def _links_recovered(traj_df, traj_ind):
+    #fraction of the true consecutive links that are in the same trajectory
+    traj_df = traj_df.assign(traj_ind = traj_ind).sort_values(['true_index', 'frame_number'])
+    same_true = np.diff(traj_df['true_index'].values) == 0
+    same_traj = np.diff(traj_df['traj_ind'].values) == 0
+    return np.sum(same_true & same_traj)/np.sum(same_true)
+
+def benchmark_linkers(n_blobs = [100, 500, 2000],
+                      n_frames = 50,
+                      plate_size = 2048,
+                      step_size = 3,
+                      max_allowed_dist = 25,
+                      area_ratio_lim = (0.5, 2)):
+
+    header = '{:>8}{:>20}{:>16}{:>12}'.format('n_blobs', 'method', 'ms per frame', 'links')
+    print(header)
+    print('-'*len(header))
+    for n in n_blobs:
+        traj_df = _synthetic_plate(n, n_frames, plate_size, step_size)
+        for link_method in LINK_METHODS:
+            tic = time.time()
+            traj_ind = assignBlobTrajDF(traj_df, max_allowed_dist, area_ratio_lim, link_method = link_method)
+            tot_time = time.time() - tic
+            print('{:>8}{:>20}{:>16.2f}{:>12.3f}'.format(n,
+                                                      link_method,
+                                                      1000*tot_time/n_frames,
+                                                      _links_recovered(traj_df, traj_ind)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n_blobs', type=int, nargs='+', default=[100, 500, 2000])
+    parser.add_argument('--n_frames', type=int, default=50)
+    parser.add_argument('--plate_size', type=float, default=2048)
+    parser.add_argument('--step_size', type=float, default=3, help='standard deviation of the displacement per frame')
+    parser.add_argument('--max_allowed_dist', type=float, default=25)
+    args = parser.parse_args()
+
+    benchmark_linkers(**vars(args))
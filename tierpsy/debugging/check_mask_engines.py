@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the masks (and the time) calculated by the CONTOURS and COMPONENTS
+engines of getROIMask using the buffers of a video.
+
+python check_mask_engines.py video_file --json_file MULTIWORM_TIERPSY.json
+"""
+import time
+import argparse
+
+import numpy as np
+
+from tierpsy.analysis.compress.compressVideo import getROIMask, reduceBuffer, selectVideoReader
+from tierpsy.analysis.compress import args_
+from tierpsy.helper.params import TrackerParams
+
+def check_mask_engines(video_file, json_file = '', buffer_size = 25, max_buffers = 20):
+    param = TrackerParams(json_file)
+    mask_param = args_({'original_video':video_file, 'masked_image':''}, param)['argkws']['compress_vid_param']['mask_param']
+    mask_param.pop('engine')
+
+    vid = selectVideoReader(video_file)
+    tot_time = {'CONTOURS':0, 'COMPONENTS':0}
+    for n_buff in range(max_buffers):
+        Ibuff = []
+        for _ in range(buffer_size):
+            ret, image = vid.read()
+            if ret == 0:
+                break
+            Ibuff.append(np.clip(image, 1, 255))
+        if not Ibuff:
+            break
+        img_reduce = reduceBuffer(np.array(Ibuff), mask_param['is_light_background'])
+
+        masks = {}
+        for engine in tot_time:
+            tic = time.time()
+            masks[engine] = getROIMask(img_reduce, engine = engine, **mask_param)
+            tot_time[engine] += time.time() - tic
+
+        m1, m2 = masks['CONTOURS'] > 0, masks['COMPONENTS'] > 0
+        n_union = max(1, np.sum(m1 | m2))
+        print('buffer {} IoU {:.4f} different pixels {}'.format(n_buff, np.sum(m1 & m2)/n_union, np.sum(m1 != m2)))
+    vid.release()
+
+    for engine, t in tot_time.items():
+        print('{} total time {:.3f}s'.format(engine, t))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('video_file', help='original video')
+    parser.add_argument('--json_file', default='', help='tracker parameters file')
+    parser.add_argument('--buffer_size', type=int, default=25)
+    parser.add_argument('--max_buffers', type=int, default=20)
+    args = parser.parse_args()
+
+    check_mask_engines(**vars(args))
@@ -60,8 +60,7 @@ def _curvature_angles(skeletons, window_length = None, lengths=None):
             warnings.simplefilter("ignore")
             ang = np.unwrap(ang_r-ang_l, axis=1);
         
-        for ii in range(ang.shape[1]):
-            ang[:, ii] = nanunwrap(ang[:, ii])
+        ang = nanunwrap(ang, axis=0)
         return ang
     
     if lengths is None:
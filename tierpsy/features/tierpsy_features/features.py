@@ -8,16 +8,18 @@ Created on Tue Aug 22 22:01:03 2017
 import pandas as pd
 import numpy as np
 import warnings
+from collections import OrderedDict
 
-from .helper import get_delta_in_frames, add_derivatives
+from .helper import get_delta_in_frames, add_derivatives, add_derivatives_batch, get_worm_ids
 
-from .velocities import get_velocity_features, velocities_columns
+from .velocities import get_velocity_features, get_velocity_features_batch, velocities_columns
 from .postures import get_morphology_features, morphology_columns, \
-get_posture_features, posture_columns, posture_aux
+get_posture_features, posture_columns, posture_aux, \
+get_length, get_area, get_widths, get_head_tail_dist, get_quirkiness, get_eigen_projections
 
 from .curvatures import get_curvature_features, curvature_columns
 from .food import get_cnt_feats, food_columns
-from .path import get_path_curvatures, path_curvature_columns, path_curvature_columns_aux
+from .path import get_path_curvatures, get_path_curvatures_batch, path_curvature_columns, path_curvature_columns_aux
 
 from .events import get_events, event_columns
 
@@ -127,4 +129,124 @@ def get_timeseries_features(skeletons,
 
     features_df = features_df[all_columns]
             
-    return features_df
\ No newline at end of file
+    return features_df
+
+def get_timeseries_features_batch(skeletons,
+                                  widths = None,
+                                  dorsal_contours = None,
+                                  ventral_contours = None,
+                                  worm_offsets = None,
+                                  fps = 1,
+                                  derivate_delta_time = 1/3,
+                                  ventral_side = '',
+                                  timestamp = None,
+                                  food_cnt = None,
+                                  is_smooth_food_cnt = False
+                                  ):
+    '''
+    Same as get_timeseries_features but for a batch of worms concatenated along the first axis.
+    
+    skeletons -> n_rows x n_segments x 2
+    worm_offsets -> indexes of the first row of each worm followed by the total number of rows (n_worms + 1).
+                    If it is None all the rows belong to the same worm.
+    timestamp -> n_rows
+    food_cnt -> food contour coordinates or a FoodContourIndex, so it can be built once and reused for all the batches.
+    
+    The rows are sorted by timestamp within each worm. Return a structured array with
+    the timestamp (int32) and the timeseries_all_columns (float32).
+    '''
+    assert ventral_side in valid_ventral_side
+    
+    n_rows = skeletons.shape[0]
+    if worm_offsets is None:
+        worm_offsets = [0, n_rows]
+    worm_offsets = np.asarray(worm_offsets)
+    assert worm_offsets[0] == 0 and worm_offsets[-1] == n_rows
+    
+    worm_ids = get_worm_ids(worm_offsets)
+    if timestamp is None:
+        timestamp = np.arange(n_rows) - worm_offsets[worm_ids]
+        warnings.warn('`timestamp` was not given. I will assign an arbritary one.')
+    
+    #sort each worm by timestamp
+    ind = np.lexsort((timestamp, worm_ids))
+    if np.any(ind != np.arange(n_rows)):
+        skeletons, timestamp = skeletons[ind], timestamp[ind]
+        widths, dorsal_contours, ventral_contours = [x if x is None else x[ind]
+            for x in (widths, dorsal_contours, ventral_contours)]
+    
+    derivate_delta_frames = get_delta_in_frames(derivate_delta_time, fps)
+    worm_sizes = np.diff(worm_offsets)
+    
+    #features of each frame
+    feats = OrderedDict()
+    lengths = get_length(skeletons)
+    feats['length'] = lengths
+    if ventral_contours is not None and dorsal_contours is not None:
+        feats['area'] = get_area(ventral_contours, dorsal_contours)
+    if widths is not None:
+        for p, val in get_widths(widths).items():
+            feats['width_' + p] = val
+    
+    feats['head_tail_distance'] = get_head_tail_dist(skeletons)
+    feats['quirkiness'], feats['major_axis'], feats['minor_axis'] = get_quirkiness(skeletons)
+    eigen_projections = get_eigen_projections(skeletons)
+    for n in range(eigen_projections.shape[1]):
+        feats['eigen_projection_' + str(n+1)] = eigen_projections[:, n]
+    
+    curvatures = get_curvature_features(skeletons)
+    #the curvature is not calculated for worms with four or less frames
+    is_small = (worm_sizes <= 4)[worm_ids]
+    for col in curvatures:
+        val = curvatures[col].values.copy()
+        val[is_small] = np.nan
+        feats[col] = val
+    
+    if food_cnt is not None:
+        food = get_cnt_feats(skeletons, food_cnt, is_smooth_food_cnt)
+        for col in food:
+            feats[col] = food[col].values
+    
+    #features that depend on the previous frames of the same worm
+    feats.update(get_velocity_features_batch(skeletons, worm_offsets, derivate_delta_frames, fps))
+    feats.update(get_path_curvatures_batch(skeletons, worm_offsets, lengths))
+    
+    #the events are calculated worm by worm (get_velocity_features does not return anything for small worms)
+    events_cols = ['length', 'head_tail_distance', 'major_axis', 'speed', 'angular_velocity', 'dist_from_food_edge']
+    events_cols = [x for x in events_cols if x in feats]
+    events = {x : np.full(n_rows, np.nan) for x in event_columns}
+    for ini, fin in zip(worm_offsets[:-1], worm_offsets[1:]):
+        if fin == ini:
+            continue
+        worm_cols = events_cols if fin - ini >= derivate_delta_frames else \
+        [x for x in events_cols if not x in velocities_columns]
+
+        worm_df = pd.DataFrame({x : feats[x][ini:fin] for x in worm_cols})
+        worm_df['timestamp'] = timestamp[ini:fin]
+        events_df = get_events(worm_df, fps)
+        for col in event_columns:
+            if col in events_df:
+                events[col][ini:fin] = events_df[col].values
+    feats.update(events)
+    
+    #add the derivatives
+    feats = add_derivatives_batch(feats,
+                                  timeseries_feats_no_dev_columns, 
+                                  worm_offsets,
+                                  derivate_delta_frames, 
+                                  fps)
+    
+    #correct ventral side sign
+    if ventral_side == 'clockwise':
+        for col in ventral_signed_columns:
+            if col in feats:
+                feats[col] = -feats[col]
+    
+    #add any missing column
+    dtypes = [('timestamp', np.int32)] + [(x, np.float32) for x in timeseries_all_columns]
+    features = np.empty(n_rows, dtypes)
+    features['timestamp'] = timestamp
+    for col in timeseries_all_columns:
+        features[col] = feats[col] if col in feats else np.nan
+    
+    return features
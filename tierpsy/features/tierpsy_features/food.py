@@ -9,6 +9,7 @@ import pandas as pd
 import numpy as np
 import matplotlib.path as mplPath
 from scipy.interpolate import interp1d
+from scipy.spatial import cKDTree
 from scipy.signal import savgol_filter
 from .velocities import _h_segment_position
 
@@ -64,21 +65,57 @@ def _h_smooth_cnt(food_cnt, resampling_N = 1000, smooth_window=None, _is_debug=F
 def _h_get_unit_vec(x):
     return x/np.linalg.norm(x, axis=1)[:, np.newaxis]
 #%%
+class FoodContourIndex():
+    '''
+    Food contour together with a KD-tree to find the nearest contour point and the path
+    used for the inside test. It is built once per video and it can be shared by all the worms.
+    '''
+    def __init__(self, food_cnt, is_smooth_cnt = True):
+        if is_smooth_cnt:
+            food_cnt = _h_smooth_cnt(food_cnt)
+        self.food_cnt = food_cnt
+        self.tree = cKDTree(food_cnt)
+        self.path = mplPath.Path(food_cnt)
+    
+    def query(self, coords):
+        '''
+        Return the distance to the nearest contour point and its index for each row of coords.
+        Rows with nan have nan distance (and index 0).
+        '''
+        dist = np.full(coords.shape[0], np.nan)
+        ind = np.zeros(coords.shape[0], np.int64)
+        
+        valid = np.all(np.isfinite(coords), axis=1)
+        if np.any(valid):
+            #look for two neighbours so ties (e.g. closed contours) are resolved using the lowest index like np.argmin
+            k = min(2, self.food_cnt.shape[0])
+            dd, ii = self.tree.query(coords[valid], k = k)
+            if k == 2:
+                is_tie = dd[:, 1] == dd[:, 0]
+                dd, ii = dd[:, 0], np.where(is_tie, ii.min(axis=1), ii[:, 0])
+            dist[valid], ind[valid] = dd, ii
+        return dist, ind
+    
+    def is_inside(self, coords):
+        return self.path.contains_points(coords)
+
 def get_cnt_feats(skeletons, 
                   food_cnt,
                   is_smooth_cnt = True,
                   _is_debug = False):
-    
-    if is_smooth_cnt:
-        food_cnt = _h_smooth_cnt(food_cnt)
+    '''
+    food_cnt -> food contour coordinates or a FoodContourIndex (is_smooth_cnt is then ignored).
+    '''
+    if isinstance(food_cnt, FoodContourIndex):
+        food_index = food_cnt
+    else:
+        food_index = FoodContourIndex(food_cnt, is_smooth_cnt)
+    food_cnt = food_index.food_cnt
     #%%
     worm_coords, orientation_v = _h_segment_position(skeletons, partition = 'body')
     
-    rr = np.linalg.norm(worm_coords[:, None, :] - food_cnt[None, ...], axis=2)
-    cnt_ind = np.argmin(rr, axis=1)
-    dist_from_cnt = np.array([x[i] for i,x in zip(cnt_ind, rr)])
-    bbPath = mplPath.Path(food_cnt)
-    outside = ~bbPath.contains_points(worm_coords)
+    dist_from_cnt, cnt_ind = food_index.query(worm_coords)
+    outside = ~food_index.is_inside(worm_coords)
     dist_from_cnt[outside] = -dist_from_cnt[outside]
     worm_u = _h_get_unit_vec(orientation_v)
     #%%
@@ -28,38 +28,127 @@ def load_eigen_projections(n_projections = 7):
     return eigen_worms
 
 
-@numba.jit
-def fillfnan(arr):
-    '''
-    fill foward nan values (iterate using the last valid nan)
-    I define this function so I do not have to call pandas DataFrame
-    '''
+@numba.njit
+def _fillfnan_2d(arr):
     out = arr.copy()
     for idx in range(1, out.shape[0]):
-        if np.isnan(out[idx]):
-            out[idx] = out[idx - 1]
+        for jj in range(out.shape[1]):
+            if np.isnan(out[idx, jj]):
+                out[idx, jj] = out[idx - 1, jj]
     return out
 
-@numba.jit
-def fillbnan(arr):
+@numba.njit
+def _fillbnan_2d(arr):
+    out = arr.copy()
+    for idx in range(out.shape[0]-2, -1, -1):
+        for jj in range(out.shape[1]):
+            if np.isnan(out[idx, jj]):
+                out[idx, jj] = out[idx + 1, jj]
+    return out
+
+@numba.njit
+def _unwrap_2d(arr):
+    #same as np.unwrap(arr, axis=0) but in a single pass over the rows
+    out = np.empty_like(arr)
+    correct = np.zeros(arr.shape[1])
+    if arr.shape[0] > 0:
+        out[0] = arr[0]
+    for idx in range(1, arr.shape[0]):
+        for jj in range(arr.shape[1]):
+            dd = arr[idx, jj] - arr[idx - 1, jj]
+            ddmod = np.mod(dd + np.pi, 2*np.pi) - np.pi
+            if ddmod == -np.pi and dd > 0:
+                ddmod = np.pi
+            if abs(dd) < np.pi:
+                ph_correct = 0.
+            else:
+                ph_correct = ddmod - dd
+            correct[jj] += ph_correct
+            out[idx, jj] = arr[idx, jj] + correct[jj]
+    return out
+
+def _apply_along_rows(func, arr, axis):
+    #apply a nopython function that works on the rows of a 2-D array along any axis of arr
+    arr = np.moveaxis(np.asarray(arr, dtype=np.float64), axis, 0)
+    n_cols = int(np.prod(arr.shape[1:]))
+    out = func(np.ascontiguousarray(arr.reshape(arr.shape[0], n_cols)))
+    return np.moveaxis(out.reshape(arr.shape), 0, axis)
+
+def fillfnan(arr, axis=0):
     '''
-    fill foward nan values (iterate using the last valid nan)
+    fill foward nan values along an axis (iterate using the last valid nan)
     I define this function so I do not have to call pandas DataFrame
     '''
-    out = arr.copy()
-    for idx in range(out.shape[0]-2, -1, -1):
-        if np.isnan(out[idx]):
-            out[idx] = out[idx + 1]
+    return _apply_along_rows(_fillfnan_2d, arr, axis)
+
+def fillbnan(arr, axis=0):
+    '''
+    fill backward nan values along an axis (iterate using the next valid nan)
+    I define this function so I do not have to call pandas DataFrame
+    '''
+    return _apply_along_rows(_fillbnan_2d, arr, axis)
+
+def nanunwrap(x, axis=0):
+    '''correct for phase change along an axis for an array with nan values     '''
+    x = np.asarray(x, dtype=np.float64)
+
+    bad = np.isnan(x)
+    x = fillfnan(x, axis)
+    x = fillbnan(x, axis)
+    x = _apply_along_rows(_unwrap_2d, x, axis)
+    x[bad] = np.nan
+    return x
+
+def get_worm_ids(worm_offsets):
+    '''
+    Get the worm (position in worm_offsets) of each row of a batch of worms concatenated along the first axis.
+    worm_offsets are the indexes of the first row of each worm followed by the total number of rows.
+    '''
+    return np.repeat(np.arange(len(worm_offsets) - 1), np.diff(worm_offsets))
+
+@numba.njit
+def _cumsum_by_worm(x, worm_offsets):
+    '''cumulative sum of x restarting at the first row of each worm'''
+    out = np.empty_like(x)
+    for ii in range(worm_offsets.size - 1):
+        tot = 0.
+        for jj in range(worm_offsets[ii], worm_offsets[ii + 1]):
+            tot += x[jj]
+            out[jj] = tot
     return out
 
-def nanunwrap(x):
-    '''correct for phase change for a vector with nan values     '''
-    x = x.astype(np.float)
+def nanunwrap_batch(x, worm_offsets):
+    '''
+    nanunwrap of a vector with a batch of worms concatenated (see get_worm_ids). The nan values are
+    only filled using values of the same worm, and the phase corrections are not propagated between worms.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    worm_offsets = np.asarray(worm_offsets, dtype=np.int64)
+    n_rows = x.size
 
+    worm_ids = get_worm_ids(worm_offsets)
+    worm_ini, worm_fin = worm_offsets[worm_ids], worm_offsets[worm_ids + 1]
+
+    #fill the nan values with the last (or next) valid value of the same worm
     bad = np.isnan(x)
-    x = fillfnan(x)
-    x = fillbnan(x)
-    x = np.unwrap(x)
+    rows = np.arange(n_rows)
+    prev_valid = np.maximum.accumulate(np.where(bad, -1, rows))
+    next_valid = np.minimum.accumulate(np.where(bad, n_rows, rows)[::-1])[::-1]
+    ind = np.where(prev_valid >= worm_ini, prev_valid,
+                   np.where(next_valid < worm_fin, next_valid, rows))
+    x = x[ind]
+
+    #same as np.unwrap but the correction is restarted at the first row of each worm
+    dd = np.diff(x)
+    ddmod = np.mod(dd + np.pi, 2*np.pi) - np.pi
+    ddmod[(ddmod == -np.pi) & (dd > 0)] = np.pi
+    ph_correct = ddmod - dd
+    ph_correct[np.abs(dd) < np.pi] = 0
+
+    ph_correct = np.concatenate(([0.], ph_correct))
+    ph_correct[worm_offsets[worm_offsets < n_rows]] = 0
+    x = x + _cumsum_by_worm(ph_correct, worm_offsets)
+
     x[bad] = np.nan
     return x
 
@@ -109,6 +198,36 @@ def add_derivatives(feats, cols2deriv, delta_frames, fps):
     #%%
     return feats
 
+def get_batch_derivative(x, worm_offsets, delta_frames, fps):
+    '''
+    Calculate (x[t + delta_frames] - x[t])/(delta_frames/fps) only between rows of the same worm, in a batch
+    of worms concatenated along the first axis. The results are centered as in add_derivatives and
+    _h_get_velocity, and the rows where it cannot be calculated are nan.
+    '''
+    out = np.full(x.shape, np.nan)
+    if x.shape[0] > delta_frames:
+        worm_ids = get_worm_ids(worm_offsets)
+        valid = np.flatnonzero(worm_ids[delta_frames:] == worm_ids[:-delta_frames])
+        out[valid + delta_frames//2] = (x[valid + delta_frames] - x[valid])/(delta_frames/fps)
+    return out
+
+def add_derivatives_batch(feats, cols2deriv, worm_offsets, delta_frames, fps):
+    '''
+    Same as add_derivatives but feats is a dictionary of arrays containing a batch of worms
+    concatenated along the first axis. The rows must be sorted by timestamp within each worm.
+    '''
+    val_cols = [x for x in cols2deriv if x in feats]
+    
+    #add_derivatives keeps the original values if the series is too small to calculate the derivative
+    worm_sizes = np.diff(worm_offsets)
+    is_small = (worm_sizes <= delta_frames)[get_worm_ids(worm_offsets)]
+    
+    for col in val_cols:
+        d_col = get_batch_derivative(feats[col], worm_offsets, delta_frames, fps)
+        d_col[is_small] = feats[col][is_small]
+        feats['d_' + col] = d_col
+    return feats
+
 class DataPartition():
     def __init__(self, partitions=None, n_segments=49):
 
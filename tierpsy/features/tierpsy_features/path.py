@@ -8,6 +8,7 @@ Created on Tue Aug 29 15:54:00 2017
 import numpy as np
 import cv2
 import pandas as pd
+from collections import OrderedDict
 from scipy.interpolate import interp1d
 
 from .curvatures import curvature_grad
@@ -172,6 +173,37 @@ def get_path_curvatures(skeletons, **argkws):
     path_coords_df = pd.DataFrame(np.array(dat).T, columns=cols)
     return path_curvatures_df, path_coords_df
 
+def get_path_curvatures_batch(skeletons, worm_offsets, lengths = None, **argkws):
+    '''
+    Same as get_path_curvatures, but skeletons contains a batch of worms concatenated along the first axis
+    and the path of each worm is calculated independently. Return a dictionary with the
+    path_curvature_columns and path_curvature_columns_aux.
+    '''
+    if lengths is None:
+        lengths = get_length(skeletons)
+    
+    n_rows = skeletons.shape[0]
+    path_data = OrderedDict((x, np.full(n_rows, np.nan)) for x in path_curvature_columns + path_curvature_columns_aux)
+    
+    for ini, fin in zip(worm_offsets[:-1], worm_offsets[1:]):
+        if fin == ini:
+            continue
+        
+        worm_skeletons = skeletons[ini:fin]
+        body_length = np.nanmedian(lengths[ini:fin])
+        for partition_str in ['body', 'tail', 'midbody', 'head']:
+            path_curv, coords = \
+                _h_path_curvature(worm_skeletons,
+                                  body_length,
+                                  partition_str = partition_str,
+                                  **argkws
+                                  )
+            path_data['path_curvature_' + partition_str][ini:fin] = path_curv
+            path_data['coord_x_' + partition_str][ini:fin] = coords[...,0]
+            path_data['coord_y_' + partition_str][ini:fin] = coords[...,1]
+    
+    return path_data
+
 def _test_plot_cnts_maps(ventral_contour, dorsal_contour):
     import matplotlib.pylab as plt
     pix2microns = 10
@@ -10,7 +10,7 @@ from collections import OrderedDict
 import matplotlib.pylab as plt
 from matplotlib import animation, patches
 
-from .helper import DataPartition, nanunwrap
+from .helper import DataPartition, nanunwrap, nanunwrap_batch, get_worm_ids, get_batch_derivative
 
 # i am including an excess of subdivisions with the hope to later reduce them
 velocities_columns = ['speed', 
@@ -86,6 +86,47 @@ def _h_get_velocity(x, delta_frames, fps):
     
     return v
 
+def _h_get_velocity_batch(x, worm_offsets, delta_frames, fps):
+    '''
+    Same as _h_get_velocity, but x contains a batch of worms concatenated along the first axis
+    (see get_worm_ids). The velocity is only calculated between rows of the same worm.
+    '''
+    if delta_frames < 1:
+        raise ValueError('Invalid number of delta frames %i' % delta_frames)
+    return get_batch_derivative(x, worm_offsets, delta_frames, fps)
+
+def _h_interp_nan_batch(x, nan_frames, worm_offsets):
+    '''
+    Replace in place the nan_frames rows of x by a linear interpolation between the valid rows of the same worm,
+    as np.interp does in get_velocity. Worms with two or less valid rows are not interpolated.
+    '''
+    worm_ids = get_worm_ids(worm_offsets)
+    n_valid = np.concatenate(([0], np.cumsum(~nan_frames)))[worm_offsets]
+    n_valid = np.diff(n_valid)
+    
+    ind = np.flatnonzero(nan_frames & (n_valid[worm_ids] > 2))
+    if ind.size == 0:
+        return x
+    
+    #closest valid row before and after each row
+    rows = np.arange(x.shape[0])
+    prev_valid = np.maximum.accumulate(np.where(nan_frames, -1, rows))[ind]
+    next_valid = np.minimum.accumulate(np.where(nan_frames, x.shape[0], rows)[::-1])[::-1][ind]
+    
+    has_prev = prev_valid >= worm_offsets[worm_ids[ind]]
+    has_next = next_valid < worm_offsets[worm_ids[ind] + 1]
+    
+    #outside the valid range np.interp uses the first or last valid value
+    x_i = x[np.where(has_prev, prev_valid, next_valid)]
+    
+    good = has_prev & has_next
+    prev_valid, next_valid = prev_valid[good], next_valid[good]
+    slope = (x[next_valid] - x[prev_valid])/(next_valid - prev_valid).astype(np.float64)[:, None]
+    x_i[good] = slope*(ind[good] - prev_valid).astype(np.float64)[:, None] + x[prev_valid]
+    
+    x[ind] = x_i
+    return x
+
 #%%
 def _h_center_skeleton(skeletons, orientation, coords):
     
@@ -144,6 +185,32 @@ def get_velocity(skeletons, partition, delta_frames, fps):
     
     return signed_speed, angular_velocity, centered_skeleton
 
+def get_velocity_batch(skeletons, partition, worm_offsets, delta_frames, fps):
+    '''
+    Same as get_velocity, but skeletons contains a batch of worms concatenated along the first axis.
+    '''
+    coords, orientation_v = _h_segment_position(skeletons, partition = partition)
+    
+    nan_frames = np.isnan(coords[:, 0])
+    _h_interp_nan_batch(coords, nan_frames, worm_offsets)
+    _h_interp_nan_batch(orientation_v, nan_frames, worm_offsets)
+    
+    velocity = _h_get_velocity_batch(coords, worm_offsets, delta_frames, fps)
+    speed = np.linalg.norm(velocity, axis=1)
+    s_sign = np.sign(np.sum(velocity*orientation_v, axis=1))
+    signed_speed = speed *s_sign
+    
+    orientation = np.arctan2(orientation_v[:, 0], orientation_v[:, 1])
+    orientation = nanunwrap_batch(orientation, worm_offsets)
+    angular_velocity = _h_get_velocity_batch(orientation, worm_offsets, delta_frames, fps)
+    
+    centered_skeleton = _h_center_skeleton(skeletons, orientation, coords)
+    
+    signed_speed[nan_frames] = np.nan
+    angular_velocity[nan_frames] = np.nan
+    
+    return signed_speed, angular_velocity, centered_skeleton
+
 #%%
 def _h_relative_velocity(segment_coords, delta_frames, fps):
     x = segment_coords[:, 0]
@@ -158,6 +225,17 @@ def _h_relative_velocity(segment_coords, delta_frames, fps):
 
 
 
+def _h_relative_velocity_batch(segment_coords, worm_offsets, delta_frames, fps):
+    x = segment_coords[:, 0]
+    y = segment_coords[:, 1]
+    r = np.sqrt(x**2+y**2)
+    theta = nanunwrap_batch(np.arctan2(y,x), worm_offsets)
+    
+    r_radial_velocity = _h_get_velocity_batch(r, worm_offsets, delta_frames, fps)
+    r_angular_velocity = _h_get_velocity_batch(theta, worm_offsets, delta_frames, fps)
+    
+    return r_radial_velocity, r_angular_velocity
+
 #%%
 def get_relative_velocities(centered_skeleton, partitions, delta_frames, fps):
     p_obj = DataPartition(partitions, n_segments=centered_skeleton.shape[1])
@@ -303,6 +381,46 @@ def get_velocity_features(skeletons, delta_frames, fps):
     return velocities
 
 
+def get_velocity_features_batch(skeletons, worm_offsets, delta_frames, fps):
+    '''
+    Same as get_velocity_features, but skeletons contains a batch of worms concatenated along the first axis.
+    Return a dictionary with the velocities_columns. The worms with less than delta_frames rows are nan.
+    '''
+    assert isinstance(delta_frames, int)
+    
+    n_segments = skeletons.shape[1]
+    velocities = OrderedDict()
+    for part, partitions in relative_to_dict.items():
+        signed_speed, angular_velocity, centered_skeleton = \
+        get_velocity_batch(skeletons, part, worm_offsets, delta_frames, fps)
+        
+        if part == 'body':
+            velocities['speed'] = signed_speed
+            velocities['angular_velocity'] = angular_velocity
+            
+            p_obj = DataPartition(['midbody'], n_segments=n_segments)
+            segment_coords = p_obj.apply(centered_skeleton, 'midbody', func=np.nanmean)
+            velocities['relative_to_body_speed_midbody'] = \
+            _h_get_velocity_batch(segment_coords[:, 0], worm_offsets, delta_frames, fps)
+        else:
+            velocities['speed_' + part] = signed_speed
+            velocities['angular_velocity_' + part] = angular_velocity
+        
+        p_obj = DataPartition(partitions, n_segments=n_segments)
+        for p in partitions:
+            segment_coords = p_obj.apply(centered_skeleton, p, func=np.nanmean)
+            r_radial_velocity, r_angular_velocity = \
+            _h_relative_velocity_batch(segment_coords, worm_offsets, delta_frames, fps)
+            velocities['relative_to_{}_radial_velocity_{}'.format(part, p)] = r_radial_velocity
+            velocities['relative_to_{}_angular_velocity_{}'.format(part, p)] = r_angular_velocity
+    
+    #get_velocity_features does not calculate the velocities of worms with less than delta_frames
+    is_small = (np.diff(worm_offsets) < delta_frames)[get_worm_ids(worm_offsets)]
+    for val in velocities.values():
+        val[is_small] = np.nan
+    
+    return velocities
+
 #%%
 if __name__ == '__main__':
     #data = np.load('worm_example_small_W1.npz')
@@ -25,6 +25,15 @@ dflt_param_list = [
         int(1e8), 
         'Maximum area in pixels for an object to be included in the compression mask.'
         ),
+    ('mask_engine', 
+        'CONTOURS', 
+        '''
+        Method used to select the objects included in the compression mask. 
+        CONTOURS tests each contour found in the thresholded image, 
+        COMPONENTS uses connected components and it is much faster if there are many objects 
+        (e.g. condensation or debris). Both methods give the same mask.
+        '''
+        ),
     ('thresh_C', 
         15, 
         '''
@@ -61,6 +70,33 @@ dflt_param_list = [
         If the value is negative it would be set using the value of expected_fps.
         '''
         ),
+    ('compression_queue_size', 
+        4, 
+        '''
+        Maximum number of buffers (of size compression_buff) held in memory 
+        when the compression runs in parallel (n_cores_used larger than one).
+        '''
+        ),
+    ('compression_codec', 
+        'zlib', 
+        '''
+        Compression library used to store the images in /mask and /full_data. 
+        The blosc codecs are faster to read and write than zlib, but produce larger files 
+        and require pytables compiled with blosc to read the file.
+        '''
+        ),
+    ('compression_level', 
+        5, 
+        'Compression level (0-9) used to store the images in /mask and /full_data.'
+        ),
+    ('compression_chunk_frames', 
+        1, 
+        '''
+        Number of frames stored per chunk in /mask. Values larger than one 
+        (e.g. compression_buff) speed up the steps that read whole buffers, 
+        but make reading individual frames slower.
+        '''
+        ),
     ('keep_border_data', 
         False, 
         '''
@@ -155,7 +191,15 @@ dflt_param_list = [
         5, 
         'Minimum width of bounding box in pixels for an object to be considered as a part of a trajectory.'
         ),
-    
+    ('traj_thresh_cache_tol',
+        0.,
+        '''
+        Reuse the threshold calculated for a region in the previous buffer if the region overlaps
+        with it and the fraction of pixels that changed its intensity distribution is smaller than this value.
+        Set it to 0 to calculate the threshold of every region.
+        '''
+        ),
+
     ('traj_max_allowed_dist', 
         25, 
         'Maximum displacement between frames for two particles to consider part of the same track.'
@@ -169,6 +213,17 @@ dflt_param_list = [
         2, 
         'Area ratio between blob areas in different frames to be considered part of the same trajectory.'
         ),
+    ('traj_link_method', 
+        'ARGMIN', 
+        '''
+        Method used to link the particles between consecutive frames. 
+        ARGMIN links each particle to the closest particle of the previous frame, 
+        and leaves unlinked the particles involved in a merge or a split.
+        LINEAR_ASSIGNMENT solves an assignment problem (minimum total displacement) using only the pairs 
+        closer than traj_max_allowed_dist, so it scales better with the number of particles 
+        and keeps one of the tracks in a merge or split event.
+        '''
+        ),
 
 
     ('roi_size', 
@@ -196,6 +251,28 @@ dflt_param_list = [
         49, 
         'Number of segments used to normalize the worm skeleton and contours.'
         ),
+
+    ('ske_block_size', 
+        10000, 
+        '''
+        Number of consecutive rows of the skeletons arrays that are kept in memory and written together 
+        by SKE_CREATE. If SKE_CREATE is interrupted, it is resumed from the blocks already written.
+        '''
+        ),
+
+    ('ske_max_buffer_mb', 
+        1024, 
+        'Maximum memory (in MB) used by SKE_CREATE to keep the blocks of skeletons before writing them.'
+        ),
+
+    ('ske_pool_type', 
+        'PROCESS', 
+        '''
+        Pool used by SKE_CREATE when n_cores_used is larger than one. THREAD shares the worm ROIs 
+        with the workers instead of copying them to other processes. It scales because the 
+        compiled skeletonization releases the GIL.
+        '''
+        ),
     
     ('max_gap_allowed_block', 
         -1, 
@@ -245,8 +322,33 @@ dflt_param_list = [
         Useful to detect pair of worms detected as a single particle.
         '''
         ),
-    
-    
+    ('filt_max_rows_fit',
+        0,
+        '''
+        Maximum number of skeletons used to fit the robust covariance of the population morphology.
+        If there are more valid skeletons, a random subsample stratified by worm and time block is used.
+        Set it to zero to use all the valid skeletons.
+        '''
+        ),
+    ('filt_fit_time_blocks',
+        10,
+        'Number of time blocks used to stratify the subsample of skeletons in filt_max_rows_fit.'
+        ),
+    ('filt_fit_seed',
+        0,
+        'Seed of the random subsample of skeletons in filt_max_rows_fit.'
+        ),
+    ('filt_population_model',
+        '',
+        '''
+        Path to a json file with the population morphology model. If the file exists, the model
+        is used instead of fitting the robust covariance of each video (e.g. to share the model between
+        videos of the same strain and setup). If the file does not exist, the model fitted in
+        the video is saved there, unless the fit failed.
+        '''
+        ),
+
+
     ('int_save_maps', 
         False, 
         '**true** to save the intensity maps and not only the profile along the worm major axis.'
@@ -310,7 +412,18 @@ dflt_param_list = [
         1, 
         '''
         EXPERIMENTAL. Number of core used. 
-        Currently it is only suported by TRAJ_CREATE and it is only recommended at high particle densities.
+        Currently it is only suported by COMPRESS, TRAJ_CREATE, SKE_CREATE, SKE_ORIENT and FEAT_TIERPSY. 
+        In TRAJ_CREATE it is only recommended at high particle densities.
+        '''),
+
+    ('use_roi_cache', 
+        False, 
+        '''
+        EXPERIMENTAL. Save the worm ROIs extracted by BLOB_FEATS into a temporary file (*_rois.hdf5), so 
+        SKE_CREATE and INT_PROFILE read them instead of decoding the masked video again. 
+        The file is an output of BLOB_FEATS that is deleted by INT_PROFILE or, if the sequence does not
+        include INT_PROFILE or stops earlier, at the end of the analysis. It is not used if
+        is_full_bgnd_subtraction is true.
         '''),
 
     ('use_nn_filter', 
@@ -357,6 +470,10 @@ valid_options = {
     'analysis_type': valid_analysis_types,
     'ventral_side':['','clockwise','anticlockwise', 'unknown'],
     'head_tail_int_method':['MEDIAN_INT', 'HEAD_BRIGHTER'],
+    'mask_engine':['CONTOURS', 'COMPONENTS'],
+    'compression_codec':['zlib', 'blosc:lz4', 'blosc:zstd'],
+    'traj_link_method':['ARGMIN', 'LINEAR_ASSIGNMENT'],
+    'ske_pool_type':['PROCESS', 'THREAD'],
     'MWP_total_n_wells':[-1, 24, 48, 96], # caveat: whether the analysis will work or not depends on the code in tierpsy.analysis.compress.FOVMultiWellSplitter 
     'MWP_whichsideup':['upright','upside-down'],
     'MWP_well_shape':['circle','square'],
@@ -45,6 +45,10 @@ class CheckPoints(object):
             self.args[point]['provenance_file'] = self.args[point]['output_files'][0]
             assert self.args[point]['provenance_file'].endswith('.hdf5')
 
+        #temporary files created by the point that must be deleted at the end of the analysis
+        if not 'tmp_files' in self.args[point]:
+            self.args[point]['tmp_files'] = []
+
         #assert all the required fields exist
         expected_arguments = set(['func', 'argkws', 'input_files', 'output_files', 'requirements'])
         missing_fields = expected_arguments - set(self.args[point].keys())
@@ -101,6 +105,8 @@ class AnalysisPoints(object):
         for ext in ext2add:
             output[ext] = os.path.join(results_dir, base_name + '_' + ext + '.hdf5')
         
+        #temporary file with the ROIs shared by BLOB_FEATS, SKE_CREATE and INT_PROFILE
+        output['roi_cache'] = os.path.join(results_dir, base_name + '_rois.hdf5')
         output['subsample'] = getSubSampleVidName(output['masked_image'])
         output['wcon'] = getWCOName(output['features'])
 
@@ -47,23 +47,26 @@ class ProcessWorker(object):
         
         print_flush('%s Starting checkpoint: %s' % (base_name, self.analysis_checkpoints[0]))
         initial_time = time.time()
-        for current_point in self.analysis_checkpoints:
-            print(current_point)
-            unmet_requirements = self.ap.hasRequirements(current_point)
+        try:
+            for current_point in self.analysis_checkpoints:
+                print(current_point)
+                unmet_requirements = self.ap.hasRequirements(current_point)
 
-            if len(unmet_requirements) != 0:
-                print(unmet_requirements)
-                break
-            
-            this_point_exists = self.ap.checker.get(current_point)
-            if this_point_exists:
-                print('this_point_exists', current_point)
-                break
-            
-            execThisPoint(current_point, 
-                    **self.ap.getArgs(current_point),
-                    pkgs_versions = pkgs_versions,
-                    cmd_original = self.cmd_original)
+                if len(unmet_requirements) != 0:
+                    print(unmet_requirements)
+                    break
+
+                this_point_exists = self.ap.checker.get(current_point)
+                if this_point_exists:
+                    print('this_point_exists', current_point)
+                    break
+
+                execThisPoint(current_point,
+                        **self.ap.getArgs(current_point),
+                        pkgs_versions = pkgs_versions,
+                        cmd_original = self.cmd_original)
+        finally:
+            self.deleteTmpFiles()
     
         time_str = str(datetime.timedelta(seconds = round(time.time() -initial_time)))
         
@@ -80,6 +83,13 @@ class ProcessWorker(object):
             print_flush('{}  Finished in {}. Total time {}.'.format(base_name, current_point, time_str))
         
 
+    def deleteTmpFiles(self):
+        #remove the temporary files (e.g. the ROIs cache) even if the sequence finished early
+        tmp_files = self.ap.getField('tmp_files', self.analysis_checkpoints)
+        for fname in set(sum(tmp_files.values(), [])):
+            if os.path.exists(fname):
+                os.remove(fname)
+
 
 class ProcessWorkerParser(argparse.ArgumentParser):
     def __init__(self):
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks of the pipelined (n_cores_used > 1) mode of compressVideo.
+
+python -m pytest tierpsy/tests/test_compress_pipeline.py
+"""
+import time
+import threading
+
+import cv2
+import numpy as np
+import pytest
+import tables
+
+from tierpsy.analysis.compress.compressVideo import _iterPipelined, compressVideo
+
+def _run_with_timeout(func, timeout = 20):
+    #run func in a separate thread so a deadlock fails the test instead of hanging it
+    output = {}
+    def _target():
+        try:
+            output['result'] = func()
+        except Exception as e:
+            output['error'] = e
+
+    t = threading.Thread(target = _target, daemon = True)
+    t.start()
+    t.join(timeout)
+    assert not t.is_alive(), 'the pipeline did not finish'
+    return output
+
+def test_pipelined_order():
+    buffers = [(ii,) for ii in range(50)]
+    output = _run_with_timeout(lambda : list(_iterPipelined(buffers, lambda x : x*2, n_workers = 3, queue_size = 4)))
+    assert output['result'] == [x*2 for x, in buffers]
+
+@pytest.mark.parametrize('bad_ind', [0, 5, 49])
+@pytest.mark.parametrize('n_workers', [1, 2, 4])
+def test_pipelined_mask_error(bad_ind, n_workers):
+    def mask_func(x):
+        if x == bad_ind:
+            #let the other workers consume the queued buffers before failing
+            time.sleep(0.2)
+            raise ValueError('bad buffer')
+        return x
+
+    buffers = [(ii,) for ii in range(50)]
+    output = _run_with_timeout(lambda : list(_iterPipelined(buffers, mask_func, n_workers = n_workers, queue_size = 4)))
+    assert isinstance(output.get('error'), ValueError)
+
+def test_pipelined_read_error():
+    def buffers_iter():
+        for ii in range(10):
+            yield (ii,)
+        raise IOError('bad frame')
+
+    output = _run_with_timeout(lambda : list(_iterPipelined(buffers_iter(), lambda x : x, n_workers = 2, queue_size = 4)))
+    assert isinstance(output.get('error'), IOError)
+
+def test_pipelined_consumer_stops():
+    #the consumer (writer) stops early, the threads must finish anyway
+    buffers = [(ii,) for ii in range(50)]
+    def _consume():
+        gen = _iterPipelined(buffers, lambda x : x, n_workers = 2, queue_size = 4)
+        next(gen)
+        gen.close()
+        return threading.active_count()
+
+    n_threads = threading.active_count()
+    _run_with_timeout(_consume)
+    for _ in range(100):
+        if threading.active_count() <= n_threads:
+            break
+        threading.Event().wait(0.05)
+    assert threading.active_count() <= n_threads
+
+def _write_synthetic_video(video_file, n_frames = 60, im_h = 120, im_w = 160, seed = 0):
+    #dark worm-like blobs moving over a noisy light background
+    rng = np.random.RandomState(seed)
+    writer = cv2.VideoWriter(str(video_file), cv2.VideoWriter_fourcc(*'MJPG'), 25, (im_w, im_h), False)
+    centers = rng.uniform(20, 100, (5, 2))
+    for _ in range(n_frames):
+        img = rng.normal(180, 10, (im_h, im_w)).clip(0, 255).astype(np.uint8)
+        centers += rng.normal(0, 2, centers.shape)
+        for x, y in centers:
+            cv2.ellipse(img, (int(x), int(y)), (12, 3), float(rng.uniform(0, 180)), 0, 360, 60, -1)
+        writer.write(img)
+    writer.release()
+
+def test_pipelined_output(tmp_path):
+    video_file = tmp_path / 'synthetic.avi'
+    _write_synthetic_video(video_file)
+
+    mask_param = dict(min_area = 20,
+                      max_area = 1e8,
+                      thresh_block_size = 31,
+                      thresh_C = 15,
+                      dilation_size = 5,
+                      keep_border_data = False,
+                      is_light_background = True)
+
+    output = {}
+    for n_cores_used in [1, 3]:
+        masked_file = str(tmp_path / 'masked_{}.hdf5'.format(n_cores_used))
+        compressVideo(str(video_file), masked_file, mask_param,
+                      buffer_size = 7,
+                      save_full_interval = 20,
+                      n_cores_used = n_cores_used)
+        with tables.File(masked_file, 'r') as fid:
+            output[n_cores_used] = {x : fid.get_node(x)[:] for x in ['/mask', '/full_data', '/mean_intensity']}
+
+    for field, serial_data in output[1].items():
+        assert serial_data.size > 0
+        assert np.array_equal(serial_data, output[3][field]), field
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that the chunked coil filter of SKE_FILT (_h_isGoodSkelArray) flags the
+same skeletons as the original row by row implementation, using synthetic worms.
+
+python -m pytest tierpsy/tests/test_filter_coils.py
+"""
+import numpy as np
+
+from tierpsy.analysis.ske_filt.getFilteredSkels import _h_isGoodSkelRow, _h_isGoodSkelArray
+
+def _get_synthetic_worms(n_worms, sample_N = 49, seed = 0):
+    '''
+    Worms with a sinusoidal or spiral (coiled) skeleton and a width profile that
+    can be swollen in random places. The contours are displaced along the normals.
+    '''
+    rng = np.random.RandomState(seed)
+    tt = np.linspace(0, 1, sample_N)
+
+    skeletons = np.zeros((n_worms, sample_N, 2))
+    widths = np.zeros((n_worms, sample_N))
+    for ii in range(n_worms):
+        length = rng.uniform(50, 100)
+        if rng.rand() < 0.3:
+            #coiled worm
+            ang = rng.uniform(1.5, 3)*2*np.pi*tt
+            rad = length/(2*np.pi)*rng.uniform(0.3, 0.6)*(1 + rng.uniform(-0.3, 0.3)*tt)
+            skel = np.stack((rad*np.cos(ang), rad*np.sin(ang)), axis=1)
+        else:
+            amp = rng.uniform(0, 15)
+            skel = np.stack((length*tt, amp*np.sin(2*np.pi*rng.uniform(0.5, 2)*tt + rng.uniform(0, 2*np.pi))), axis=1)
+        skeletons[ii] = skel + rng.normal(0, 0.3, skel.shape)
+
+        width = rng.uniform(4, 8)*np.sin(np.pi*np.clip(tt, 0.02, 0.98))**0.5
+        if rng.rand() < 0.3:
+            #swollen region, like the one produced by a coil
+            width *= 1 + rng.uniform(0.5, 3)*np.exp(-((tt - rng.uniform(0, 1))/0.1)**2)
+        widths[ii] = width
+
+    dR = np.gradient(skeletons, axis=1)
+    normals = np.stack((-dR[..., 1], dR[..., 0]), axis=2)
+    normals /= np.linalg.norm(normals, axis=2)[..., np.newaxis]
+    contour_side1 = skeletons + normals*widths[..., np.newaxis]/2
+    contour_side2 = skeletons - normals*widths[..., np.newaxis]/2
+    contour_width = np.linalg.norm(contour_side1 - contour_side2, axis=2)
+
+    return [x.astype(np.float32) for x in (skeletons, contour_side1, contour_side2, contour_width)]
+
+def test_coil_filter_array_vs_row():
+    max_width_ratio = 2.25
+    max_area_ratio = 6
+
+    skeletons, contour_side1, contour_side2, contour_width = _get_synthetic_worms(500)
+    is_good_row = np.array([_h_isGoodSkelRow(*x, max_width_ratio = max_width_ratio, max_area_ratio = max_area_ratio)
+                            for x in zip(skeletons, contour_side1, contour_side2, contour_width)])
+    is_good_array = _h_isGoodSkelArray(skeletons, contour_side1, contour_side2, contour_width,
+                                       max_width_ratio = max_width_ratio,
+                                       max_area_ratio = max_area_ratio)
+
+    #make sure the synthetic data exercises both outcomes
+    assert 0 < is_good_row.sum() < is_good_row.size
+    assert np.array_equal(is_good_row, is_good_array)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Check that the CONTOURS and COMPONENTS engines of getROIMask select the same
+blobs, using seeded synthetic binary images.
+
+python -m pytest tierpsy/tests/test_mask_engines.py
+"""
+import cv2
+import numpy as np
+import pytest
+
+from tierpsy.analysis.compress.compressVideo import _getBlobsMaskContours, _getBlobsMaskComponents, getROIMask
+
+def _nested_rings(rng, im_h = 150, im_w = 150):
+    #concentric rings and holes, some of them cut by the image border
+    bw = np.zeros((im_h, im_w), np.uint8)
+    for _ in range(rng.randint(1, 4)):
+        center = (int(rng.randint(0, im_w)), int(rng.randint(0, im_h)))
+        radius = int(rng.randint(10, 70))
+        color = 255
+        while radius > 1:
+            cv2.circle(bw, center, radius, color, -1)
+            color = 255 - color
+            radius -= int(rng.randint(1, 8))
+    return bw
+
+def _ellipses(rng, im_h = 120, im_w = 160):
+    #filled ellipses and thin rings (one pixel wide parts), some touching the border
+    bw = np.zeros((im_h, im_w), np.uint8)
+    for _ in range(15):
+        center = (int(rng.randint(-5, im_w + 5)), int(rng.randint(-5, im_h + 5)))
+        axes = (int(rng.randint(1, 25)), int(rng.randint(1, 25)))
+        thickness = -1 if rng.rand() < 0.5 else int(rng.randint(1, 4))
+        color = 255 if rng.rand() < 0.8 else 0
+        cv2.ellipse(bw, center, axes, float(rng.uniform(0, 180)), 0, 360, color, thickness)
+    return bw
+
+def _debris(rng, im_h = 100, im_w = 100):
+    #small rectangles with areas around min_area, some cut by a line or touching the border
+    bw = np.zeros((im_h, im_w), np.uint8)
+    for _ in range(40):
+        h, w = rng.randint(1, 12, 2)
+        y, x = rng.randint(-2, im_h), rng.randint(-2, im_w)
+        bw[max(0, y):y + h, max(0, x):x + w] = 255
+        if rng.rand() < 0.3:
+            bw[max(0, y):y + h, min(im_w - 1, max(0, x + w//2))] = 0
+    return bw
+
+def _noise(rng, im_h = 80, im_w = 100):
+    #many small blobs and holes
+    bw = ((rng.rand(im_h, im_w) < rng.uniform(0.2, 0.6))*255).astype(np.uint8)
+    if rng.rand() < 0.5:
+        bw = cv2.medianBlur(bw, 3)
+    return bw
+
+@pytest.mark.parametrize('keep_border_data', [True, False])
+@pytest.mark.parametrize('min_area, max_area', [(50, 1e8), (10, 400)])
+@pytest.mark.parametrize('gen_func', [_nested_rings, _ellipses, _debris, _noise])
+def test_mask_engines_blobs(gen_func, min_area, max_area, keep_border_data):
+    rng = np.random.RandomState(0)
+    for _ in range(50):
+        bw = gen_func(rng)
+        mask_contours = _getBlobsMaskContours(bw, min_area, max_area, keep_border_data)
+        mask_components = _getBlobsMaskComponents(bw, min_area, max_area, keep_border_data)
+        assert np.array_equal(mask_contours, mask_components)
+
+@pytest.mark.parametrize('keep_border_data', [True, False])
+def test_mask_engines_roi_mask(keep_border_data):
+    mask_param = dict(min_area = 50,
+                      max_area = 1e8,
+                      thresh_block_size = 61,
+                      thresh_C = 15,
+                      dilation_size = 9,
+                      keep_border_data = keep_border_data,
+                      is_light_background = True)
+
+    rng = np.random.RandomState(0)
+    for _ in range(10):
+        #dark worm-like lines over a noisy light background
+        img = rng.normal(180, 12, (256, 320)).clip(0, 255).astype(np.uint8)
+        img = cv2.GaussianBlur(img, (0, 0), 1.5)
+        for _ in range(rng.randint(5, 20)):
+            pts = np.cumsum(rng.normal(0, 4, (40, 2)), axis=0) + rng.randint(-20, 340, 2)
+            cv2.polylines(img, [pts.astype(np.int32)], False, int(rng.randint(40, 120)), int(rng.randint(2, 8)))
+
+        mask_contours = getROIMask(img, engine = 'CONTOURS', **mask_param)
+        mask_components = getROIMask(img, engine = 'COMPONENTS', **mask_param)
+        assert np.array_equal(mask_contours, mask_components)